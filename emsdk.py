@@ -4,12 +4,20 @@
 # University of Illinois/NCSA Open Source License.  Both these licenses can be
 # found in the LICENSE file.
 
+import contextlib
 import copy
+import errno
+import fnmatch
+import hashlib
+import heapq
+import io
 import json
+import marshal
 import multiprocessing
 import os
 import os.path
 import platform
+import random
 import re
 import shutil
 import stat
@@ -17,24 +25,32 @@ import subprocess
 import sys
 import sysconfig
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
 
 if os.name == 'nt':
   import ctypes.wintypes
+  import msvcrt
   import winreg
+else:
+  import fcntl
 
-from urllib.parse import urljoin
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
 
 if sys.version_info < (3, 10):  # ruff: ignore[outdated-version-block]
   print(f'error: emsdk requires python 3.10 or above ({sys.executable} {sys.version})', file=sys.stderr)
   sys.exit(1)
 
-emsdk_packages_url = 'https://storage.googleapis.com/webassembly/emscripten-releases-builds/deps/'
+emscripten_releases_builds_url = 'https://storage.googleapis.com/webassembly/emscripten-releases-builds/'
+
+emsdk_packages_url = emscripten_releases_builds_url + 'deps/'
 
 emscripten_releases_repo = 'https://chromium.googlesource.com/emscripten-releases'
 
-emscripten_releases_download_url_template = "https://storage.googleapis.com/webassembly/emscripten-releases-builds/%s/%s/wasm-binaries%s.%s"
+emscripten_releases_download_url_template = emscripten_releases_builds_url + "%s/%s/wasm-binaries%s.%s"
 
 # This was previously `master.zip` but we are transitioning to `main` and
 # `HEAD.zip` works for both cases.  In future we could switch this to
@@ -161,6 +177,24 @@ CMAKE_BUILD_TYPE_OVERRIDE = None
 # If true, perform a --shallow clone of git.
 GIT_CLONE_SHALLOW = False
 
+# Named sets of options for `emsdk install --profile=<name>`, for installs that
+# don't need everything in the release archives (e.g. CI machines and
+# containers).  'include' and 'exclude' are fnmatch patterns that are matched
+# against paths relative to the installation directory of each tool; a pattern
+# that matches a directory applies to everything in it.  Files that are
+# excluded are skipped during extraction rather than deleted afterwards.  If
+# 'strip' is set, symbols are stripped from the ELF binaries that are installed.
+INSTALL_PROFILES = {
+  'full': {},
+  'minimal': {
+    # The emscripten test suite is not needed to use emscripten.
+    'exclude': ['emscripten/test', 'emscripten/tests'],
+    'strip': True,
+  },
+}
+
+INSTALL_PROFILE = 'full'
+
 # If true, LLVM backend is built with tests enabled, and Binaryen is built with
 # Visual Studio static analyzer enabled.
 BUILD_FOR_TESTING = False
@@ -173,6 +207,111 @@ ENABLE_LLVM_ASSERTIONS = 'auto'
 # If true, keeps the downloaded archive files.
 KEEP_DOWNLOADS = get_env_boolean('EMSDK_KEEP_DOWNLOADS')
 
+# Number of byte ranges to fetch in parallel when downloading large files from
+# servers that support range requests.  Set to 1 to always download using a
+# single connection.
+DOWNLOAD_SEGMENTS = int(os.getenv('EMSDK_DOWNLOAD_SEGMENTS', '4'))
+
+# Files smaller than this are always downloaded using a single connection,
+# since the extra round trips would outweigh any gains.
+DOWNLOAD_SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+
+# Range of the number of bytes read from the network at a time.
+DOWNLOAD_MIN_BLOCK_SIZE = 64 * 1024
+DOWNLOAD_MAX_BLOCK_SIZE = 1024 * 1024
+
+# If set, downloaded archives are stored in (and reused from) this directory,
+# which can be shared between several emsdk checkouts and users on the same
+# machine.
+DOWNLOAD_CACHE_DIR = os.getenv('EMSDK_DOWNLOAD_CACHE')
+
+# Maximum number of tools that are downloaded and installed at the same time.
+INSTALL_JOBS = int(os.getenv('EMSDK_INSTALL_JOBS', '4'))
+
+# Number of threads that write out files when extracting archives.  With a
+# single job, files from tar archives are written on the thread that reads the
+# archive.
+EXTRACT_JOBS = int(os.getenv('EMSDK_EXTRACT_JOBS', str(min(os.cpu_count() or 1, 8))))
+
+# Which external program to decompress tar archives with: 'auto' picks a
+# multi-threaded one (see EXTERNAL_DECOMPRESSORS) if there is one and the host
+# has more than one CPU, 'none' always decompresses in Python, and a program
+# name, e.g. 'pigz', uses that program for the archives it supports.
+DECOMPRESSOR = os.getenv('EMSDK_DECOMPRESSOR', 'auto')
+
+# Set when an install fails or is interrupted, to stop any downloads that are
+# still running on other threads.
+downloads_cancelled = threading.Event()
+
+# If true, tar archives are extracted while they are being downloaded, instead
+# of first being written to the downloads directory in full.
+STREAM_EXTRACT = get_env_boolean('EMSDK_STREAM_EXTRACT')
+
+# Maximum total size of the download cache. The least recently used archives
+# are evicted once the cache grows beyond this.
+DOWNLOAD_CACHE_SIZE = os.getenv('EMSDK_DOWNLOAD_CACHE_SIZE', '10G')
+
+# If set, the trees extracted from release archives are kept in this directory
+# (see TreeCache), so that installing them again doesn't need to download or
+# extract anything.
+TREE_CACHE_DIR = os.getenv('EMSDK_TREE_CACHE')
+
+# Maximum total size of the files in the extracted tree cache.
+TREE_CACHE_SIZE = os.getenv('EMSDK_TREE_CACHE_SIZE', '20G')
+
+# If true, installing a tar archive into a directory that holds a different
+# version of the same tool (e.g. one emscripten release over another in
+# `upstream`) only writes the files that changed, instead of deleting the old
+# tree and extracting everything (see TarExtractor).
+INCREMENTAL_UPGRADE = get_env_boolean('EMSDK_INCREMENTAL_UPGRADE')
+
+# If true, emscripten releases are installed side by side, each into
+# upstream/<hash>/, instead of one after another into upstream/, and
+# `emsdk activate` points the upstream/current link at the one to use (see
+# Tool.in_release_store()).  Once a release has been installed this way, this
+# layout stays in use even without this setting.
+RELEASE_STORE = get_env_boolean('EMSDK_RELEASE_STORE')
+
+# If true (the default), the tools and SDKs that load_sdk_manifest() expands
+# from the manifest and the tag files are cached in MANIFEST_CACHE_FILE, so
+# that commands (in particular `construct_env`, which runs each time
+# emsdk_env.sh is sourced) don't need to parse and expand them every time.
+MANIFEST_CACHE = os.getenv('EMSDK_MANIFEST_CACHE', '1') != '0'
+MANIFEST_CACHE_FILE = '.emsdk_manifest_cache'
+
+# Mirrors of emscripten_releases_builds_url, separated by commas or spaces.
+# Downloads come from whichever mirror responded fastest to a probe, and fail
+# over to the other mirrors (in the given order, with upstream last) if that
+# one fails or stalls.
+MIRRORS = [m.rstrip('/') + '/' for m in re.split(r'[,\s]+', os.getenv('EMSDK_MIRRORS', '')) if m]
+
+# A file listing the digests of archives that only the mirrors have (i.e. the
+# .tar.zst ones), which are then trusted like the ones in
+# emscripten-releases-tags.json.  See load_mirror_checksums().
+MIRROR_CHECKSUMS = os.getenv('EMSDK_MIRROR_CHECKSUMS')
+
+# How long (in seconds) the result of probing the mirrors is remembered.
+MIRROR_PROBE_TTL = 60 * 60
+
+# Network requests that make no progress for this many seconds are abandoned.
+DOWNLOAD_TIMEOUT = 60
+
+# Maximum number of connections that transfer data at the same time.
+DOWNLOAD_CONNECTIONS = int(os.getenv('EMSDK_DOWNLOAD_CONNECTIONS', '16'))
+
+# Caps on the download bandwidth (bytes per second, e.g. 10M) used by this
+# process, and by all emsdk processes on this machine together.  Unlimited by
+# default.
+DOWNLOAD_RATE = os.getenv('EMSDK_DOWNLOAD_RATE')
+DOWNLOAD_HOST_RATE = os.getenv('EMSDK_DOWNLOAD_HOST_RATE')
+
+mirrors_lock = threading.Lock()
+
+# Probes for the archive format of wasm-binaries downloads, see
+# resolve_archive_url().
+archive_probes = {}
+archive_probes_lock = threading.Lock()
+
 
 def os_name_short():
   if WINDOWS:
@@ -242,7 +381,7 @@ def parse_github_url_and_refspec(url):
     return (url, 'main', None)  # Assume the default branch is main in the absence of a refspec
 
 
-ARCHIVE_SUFFIXES = ('zip', '.tar', '.gz', '.xz', '.tbz2', '.bz2')
+ARCHIVE_SUFFIXES = ('zip', '.tar', '.gz', '.xz', '.tbz2', '.bz2', '.zst')
 
 
 def vswhere(version):
@@ -316,6 +455,82 @@ def remove_tree(d):
     debug_print('remove_tree threw an exception, ignoring: ' + str(e))
 
 
+def trash_dir():
+  return sdk_path('.trash')
+
+
+def discard_tree(d):
+  """Removes a directory tree like remove_tree(), but without waiting for it to
+  be deleted: the tree is renamed into the trash directory, and deleted from
+  there by a background process.  Falls back to remove_tree() if the tree
+  can't be moved, e.g. because it is on a different file system.
+  """
+  debug_print(f'discard_tree({d})')
+  if not os.path.isdir(d) or os.path.islink(d):
+    remove_tree(d)
+    return
+  target = os.path.join(trash_dir(), f'{os.path.basename(os.path.normpath(d))}-{os.getpid()}-{time.time_ns()}')
+  try:
+    mkdir_p(trash_dir())
+    os.rename(d, target)
+  except OSError as e:
+    debug_print(f'cannot move {d} to the trash ({e}), deleting it in place')
+    remove_tree(d)
+    return
+  empty_trash_in_background()
+
+
+def empty_trash():
+  """Deletes everything in the trash directory (see discard_tree()).  Returns
+  immediately if another process is already doing that.
+  """
+  trash = trash_dir()
+  if not os.path.isdir(trash):
+    return
+  try:
+    with file_lock(os.path.join(trash, '.lock'), wait=False):
+      # Keep going until the trash is empty, since other processes may add to
+      # it in the meantime, but give up on anything that can't be deleted.
+      previous = None
+      while True:
+        entries = sorted(e for e in os.listdir(trash) if e != '.lock')
+        if not entries or entries == previous:
+          break
+        for entry in entries:
+          remove_tree(os.path.join(trash, entry))
+        previous = entries
+  except BlockingIOError:
+    debug_print('the trash is already being emptied by another process')
+
+
+def empty_trash_in_background(check_lock=False):
+  """Runs empty_trash() in a detached process, so that it can carry on after
+  this process exits.  If `check_lock` is True, only does so if there is
+  something in the trash and no other process is emptying it already.
+  """
+  trash = trash_dir()
+  if check_lock:
+    try:
+      if not any(e != '.lock' for e in os.listdir(trash)):
+        return
+      with file_lock(os.path.join(trash, '.lock'), wait=False):
+        pass
+    except (OSError, BlockingIOError):
+      return
+  start_detached_process([sys.executable, os.path.abspath(__file__), 'empty_trash'])
+
+
+def start_detached_process(cmd, log=subprocess.DEVNULL):
+  """Starts a process that keeps running after this one exits, with its
+  output going to `log`.
+  """
+  if WINDOWS:
+    kwargs = {'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+  else:
+    kwargs = {'start_new_session': True}
+  return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+
+
 def win_set_environment_variable_direct(key, value, system=True):
   folder = None
   try:
@@ -472,11 +687,57 @@ def rmfile(filename):
     os.remove(filename)
 
 
+def thread_pool(max_workers=None):
+  """Returns a concurrent.futures.ThreadPoolExecutor.  concurrent.futures is
+  only imported once it is needed, since it takes a while to load (it imports
+  logging), and most commands (e.g. construct_env) never start any threads.
+  """
+  import concurrent.futures
+  return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+
 def mkdir_p(path):
   debug_print(f'mkdir_p({path})')
   os.makedirs(path, exist_ok=True)
 
 
+def parse_size(size):
+  """Parses a size such as '500M' or '10G' into a number of bytes."""
+  units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+  size = size.strip().upper().removesuffix('B')
+  if size and size[-1] in units:
+    return int(float(size[:-1]) * units[size[-1]])
+  return int(size)
+
+
+@contextlib.contextmanager
+def file_lock(path, wait=True):
+  """Holds an exclusive lock on the given file for the duration of the `with`
+  block.  This is used to coordinate between several emsdk processes.  If
+  `wait` is False, BlockingIOError is raised if another process holds the lock.
+  """
+  with open(path, 'a+') as f:
+    if os.name == 'nt':
+      while True:
+        try:
+          msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK, 1)
+          break
+        except OSError:
+          if not wait:
+            raise BlockingIOError(f'{path} is locked') from None
+          # LK_LOCK gives up after 10 seconds, keep waiting.
+    else:
+      fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    try:
+      yield
+    finally:
+      if os.name == 'nt':
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+      else:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def is_nonempty_directory(path):
   if not os.path.isdir(path):
     return False
@@ -491,13 +752,458 @@ def run(cmd, cwd=None, check=True):
   return returncode
 
 
-def untargz(source_filename, dest_dir):
+def untargz(source_filename, dest_dir, manifest=None, member_filter=None):
   print(f"Unpacking '{source_filename}' to '{dest_dir}'")
-  mkdir_p(dest_dir)
-  returncode = run(['tar', '-xvf' if VERBOSE else '-xf', sdk_path(source_filename), '--strip', '1'], cwd=dest_dir)
-  # tfile = tarfile.open(source_filename, 'r:gz')
-  # tfile.extractall(dest_dir)
-  return returncode == 0
+  fresh = not os.path.exists(dest_dir) or not os.listdir(dest_dir)
+  try:
+    with open(sdk_path(source_filename), 'rb') as f:
+      try:
+        extract_tar_stream(f, dest_dir, source_filename, manifest, member_filter)
+      except DecompressorError as e:
+        if e.cmd != find_external_decompressor(source_filename):
+          raise
+        errlog(f'Warning: {e}. Retrying with the built-in decompressor.')
+        failed_decompressors.add(e.cmd[0])
+        # Every member is written again, so whatever was extracted already is
+        # replaced.  If the directory was empty to begin with, start over from
+        # an empty one, so that no partially written file can remain.
+        if fresh:
+          remove_tree(dest_dir)
+        f.seek(0)
+        extract_tar_stream(f, dest_dir, source_filename, manifest, member_filter)
+  except (OSError, tarfile.TarError, EOFError) as e:
+    errlog(f"Error: Unpacking '{source_filename}' failed: {e}")
+    return False
+  return True
+
+
+def open_for_write(path, mode=0o666):
+  """Opens `path` for writing as a new file, and returns the file descriptor.
+  Whatever is in the way (e.g. a read-only file or a symlink) is replaced, like
+  tar does.  An existing file is never written to, since it may be a hard link
+  that shares its contents with other files (see clone_file()).
+  """
+  flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+  try:
+    return os.open(path, flags, mode)
+  except OSError:
+    if not os.path.lexists(path):
+      raise
+    os.unlink(path)
+    return os.open(path, flags, mode)
+
+
+def strip_first_path_component(name):
+  """Implements `tar --strip 1` for a single archive member name.  Returns an
+  empty string for the top level directory itself.
+  """
+  parts = [p for p in name.split('/') if p and p != '.']
+  return '/'.join(parts[1:])
+
+
+class TarExtractor:
+  """Extracts a (possibly compressed) tar archive into a directory, with the
+  same result as `tar -xf <archive> --strip 1`, except that the directory also
+  gets the modification time of the top level directory of the archive (which
+  tar leaves alone, since that directory is stripped).
+
+  The archive is read as a stream, so it can come straight from a download.
+  Decompressing and parsing it happens on the calling thread, since that is
+  inherently sequential, while the contents of regular files are written out by
+  a pool of writer threads.  Release archives contain tens of thousands of
+  small files, and writing them in parallel hides most of the per-file
+  filesystem overhead.
+
+  Each directory is only created once, however many members it contains.
+  Links are created once all regular files have been written, since a hard
+  link needs its target to exist, and directory permissions and modification
+  times are applied at the very end so that read-only directories can still be
+  written into, and their times aren't changed by creating the entries in them.
+
+  Files are hashed as they are written, and recorded in `manifest` (an
+  InstallManifest) if one is given.  If `member_filter` is given, only the
+  members whose (stripped) name it returns True for are extracted.
+
+  If `manifest.previous` is set, the archive is an upgrade of the tree that is
+  already installed in `dest_dir` (see EMSDK_INCREMENTAL_UPGRADE): files whose
+  contents didn't change are left alone, changed files are written next to the
+  old ones and then renamed over them, and files that are no longer in the
+  archive are removed at the end.
+  """
+
+  # Files up to this size are read into memory and handed to the writer
+  # threads, larger ones are streamed to disk on the calling thread.
+  MAX_BUFFERED_FILE_SIZE = 8 * 1024 * 1024
+
+  # Maximum amount of file data held in memory waiting to be written.
+  MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+  # Suffix of the files that changed files are written to during an upgrade.
+  UPGRADE_SUFFIX = '.emsdk-upgrade'
+
+  def __init__(self, dest_dir, jobs=None, manifest=None, member_filter=None):
+    self.dest_dir = os.path.abspath(dest_dir)
+    self.jobs = max(jobs or EXTRACT_JOBS, 1)
+    self.manifest = manifest
+    self.member_filter = member_filter
+    self.previous = manifest.previous if manifest else None
+    self.unchanged = []
+    self.created_dirs = set()
+    self.dirs = []
+    self.root_member = None
+    self.links = []
+    self.pending_bytes = 0
+    self.pending_cond = threading.Condition()
+    self.errors = []
+
+  def target_path(self, name):
+    if '..' in name.split('/'):
+      raise tarfile.TarError(f"refusing to extract '{name}' outside of '{self.dest_dir}'")
+    return os.path.join(self.dest_dir, *name.split('/'))
+
+  def ensure_dir(self, path):
+    if path not in self.created_dirs:
+      os.makedirs(path, exist_ok=True)
+      self.created_dirs.add(path)
+
+  def extract(self, fileobj):
+    mkdir_p(self.dest_dir)
+    if self.previous:
+      self.previous.begin_upgrade(self.manifest.archive)
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar, \
+         (thread_pool(max_workers=self.jobs) if self.jobs > 1 else contextlib.nullcontext()) as executor:
+      for member in tar:
+        if self.errors:
+          raise self.errors[0]
+        name = strip_first_path_component(member.name)
+        if not name and member.isdir():
+          self.root_member = member
+        if not name or (self.member_filter and not self.member_filter(name)):
+          continue
+        if VERBOSE:
+          print(name)
+        path = self.target_path(name)
+        if member.isdir():
+          self.ensure_dir(path)
+          self.dirs.append((path, member))
+          continue
+        self.ensure_dir(os.path.dirname(path))
+        if member.isreg():
+          src = tar.extractfile(member)
+          if member.size > self.MAX_BUFFERED_FILE_SIZE:
+            self.write_file(path, member, src=src)
+          elif executor:
+            data = src.read()
+            self.reserve(len(data))
+            executor.submit(self.write_buffered_file, path, member, data)
+          else:
+            self.write_file(path, member, data=src.read())
+        elif member.issym() or member.islnk():
+          self.links.append((path, member))
+        else:
+          debug_print(f'skipping special file {name}')
+    if self.errors:
+      raise self.errors[0]
+    self.create_links()
+    if self.previous:
+      stale = self.manifest.remove_stale_files(self.previous)
+      print(f'Kept {len(self.unchanged)} unchanged file(s), removed {stale} file(s) that are no longer in the archive.')
+    self.apply_dir_attributes()
+
+  def reserve(self, num_bytes):
+    """Waits until there is room for `num_bytes` more file data in memory."""
+    with self.pending_cond:
+      while self.pending_bytes and self.pending_bytes + num_bytes > self.MAX_PENDING_BYTES and not self.errors:
+        self.pending_cond.wait()
+      self.pending_bytes += num_bytes
+
+  def write_buffered_file(self, path, member, data):
+    try:
+      self.write_file(path, member, data=data)
+    except Exception as e:
+      self.errors.append(e)
+    finally:
+      with self.pending_cond:
+        self.pending_bytes -= len(data)
+        self.pending_cond.notify_all()
+
+  def previous_entry(self, path, member):
+    """During an upgrade, returns the manifest entry of the file that is
+    installed at `path` if it may have the same contents as `member`, i.e. it
+    has the same size and permissions (other than write permissions, which
+    files linked into the tree cache don't have) and wasn't modified since it
+    was installed."""
+    entry = self.previous.files.get(self.previous.relpath(path))
+    if not entry or entry[0] != member.size or (entry[1] | 0o222) != (member.mode & 0o755 | 0o222):
+      return None
+    try:
+      st = os.lstat(path)
+    except OSError:
+      return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size != entry[0] or st.st_mtime_ns != entry[3]:
+      return None
+    return entry
+
+  def write_file(self, path, member, data=None, src=None):
+    # Drop setuid/setgid/sticky bits and group/other write permissions, as
+    # tar does for unprivileged users with the default umask.
+    mode = member.mode & 0o755
+    sha = hashlib.sha256()
+    # Number of bytes at the start of a streamed file that are the same as in
+    # the file it replaces.
+    same = 0
+    if self.previous and self.previous_entry(path, member):
+      with open(path, 'rb') as old:
+        if src:
+          while True:
+            data = src.read(1024 * 1024)
+            if not data or old.read(len(data)) != data:
+              break
+            sha.update(data)
+            same += len(data)
+          unchanged = not data
+        else:
+          unchanged = old.read() == data
+          if unchanged:
+            sha.update(data)
+      if unchanged:
+        self.manifest.record_file(path, os.lstat(path), sha.hexdigest())
+        self.unchanged.append(path)
+        return
+
+    target = path
+    if self.previous:
+      path += self.UPGRADE_SUFFIX
+    fd = open_for_write(path, 0o600)
+    try:
+      if same:
+        with open(target, 'rb') as old:
+          while same:
+            view = memoryview(old.read(min(same, 1024 * 1024)))
+            same -= len(view)
+            while view:
+              view = view[os.write(fd, view):]
+      if src:
+        if data is None:
+          data = src.read(1024 * 1024)
+        with open(fd, 'wb', closefd=False) as f:
+          while data:
+            sha.update(data)
+            f.write(data)
+            data = src.read(1024 * 1024)
+      else:
+        sha.update(data)
+        view = memoryview(data)
+        while view:
+          view = view[os.write(fd, view):]
+      if hasattr(os, 'fchmod'):
+        os.fchmod(fd, mode)
+      else:
+        os.chmod(path, mode)
+      os.utime(fd if os.utime in os.supports_fd else path, (member.mtime, member.mtime))
+      if self.manifest:
+        self.manifest.record_file(target, os.fstat(fd), sha.hexdigest())
+    finally:
+      os.close(fd)
+    if path != target:
+      os.replace(path, target)
+
+  def create_links(self):
+    for path, member in self.links:
+      if member.issym():
+        if not (os.path.islink(path) and os.readlink(path) == member.linkname):
+          if os.path.lexists(path):
+            os.unlink(path)
+          os.symlink(member.linkname, path)
+        if os.utime in os.supports_follow_symlinks:
+          os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+        if self.manifest:
+          self.manifest.record_link(path, member.linkname)
+        continue
+      if os.path.lexists(path):
+        os.unlink(path)
+      # Hard link targets are archive member names, so strip them too.
+      target = self.target_path(strip_first_path_component(member.linkname))
+      try:
+        os.link(target, path)
+      except OSError:
+        shutil.copy2(target, path)
+      if self.manifest:
+        self.manifest.record_copy(path, target)
+
+  def apply_dir_attributes(self):
+    # Deepest directories first, so that setting the mtime of a directory
+    # isn't undone by changes inside it.
+    for path, member in reversed(self.dirs):
+      os.chmod(path, member.mode & 0o755)
+      os.utime(path, (member.mtime, member.mtime))
+    if self.root_member:
+      os.utime(self.dest_dir, (self.root_member.mtime, self.root_member.mtime))
+
+
+def extract_tar_stream(fileobj, dest_dir, name='', manifest=None, member_filter=None):
+  """Extracts a (possibly compressed) tar archive from a non-seekable stream
+  into `dest_dir`, with the same `--strip 1` behaviour as untargz().  `name` is
+  the file name or URL of the archive, which tells how it is compressed.  See
+  TarExtractor for `manifest` and `member_filter`.
+  """
+  with contextlib.closing(open_decompressed(fileobj, name)) as stream:
+    try:
+      TarExtractor(dest_dir, manifest=manifest, member_filter=member_filter).extract(stream)
+    except Exception:
+      if isinstance(stream, DecompressorPipe):
+        stream.check()
+      raise
+
+
+class DecompressorError(OSError):
+  """Raised when the program that a DecompressorPipe runs fails."""
+
+  def __init__(self, cmd, message):
+    super().__init__(message)
+    self.cmd = cmd
+
+
+class DecompressorPipe:
+  """A file object that decompresses `fileobj` on the fly by piping it through
+  an external program, such as `zstd -dc`.
+  """
+
+  def __init__(self, cmd, fileobj):
+    self.cmd = cmd
+    self.fileobj = fileobj
+    self.error = None
+    self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.feeder = threading.Thread(target=self.feed, daemon=True)
+    self.feeder.start()
+
+  def feed(self):
+    try:
+      while True:
+        data = self.fileobj.read(1024 * 1024)
+        if not data:
+          break
+        self.process.stdin.write(data)
+    except BrokenPipeError:
+      # The program exited early, finish() will find out why.
+      pass
+    except Exception as e:
+      self.error = e
+    finally:
+      try:
+        self.process.stdin.close()
+      except OSError:
+        pass
+
+  def read(self, size=-1):
+    data = self.process.stdout.read(size)
+    if not data:
+      self.finish()
+    return data
+
+  def finish(self):
+    """Waits for the program to exit, and raises if anything went wrong."""
+    self.feeder.join()
+    if self.error:
+      raise self.error
+    if self.process.wait() != 0:
+      message = self.process.stderr.read().decode(errors='replace').strip()
+      raise DecompressorError(self.cmd, f"'{' '.join(self.cmd)}' failed with exit code {self.process.returncode}: {message}")
+
+  def check(self):
+    """Raises DecompressorError if the program has exited with an error.  A
+    program that crashes mid-stream makes the archive look truncated or
+    corrupt, which tarfile may notice before finish() is called."""
+    try:
+      returncode = self.process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+      return
+    if returncode != 0:
+      self.finish()
+
+  def close(self):
+    if self.process.poll() is None:
+      self.process.kill()
+    self.process.wait()
+    self.feeder.join()
+    self.process.stdout.close()
+    self.process.stderr.close()
+
+
+# External programs that decompress tar archives faster than Python does, by
+# archive suffix, in order of preference.  Except for plain xz (which only
+# uses several threads for archives that were compressed with several), these
+# spread decompression over all cores, and in any case decompression runs in
+# parallel with extraction.
+EXTERNAL_DECOMPRESSORS = [
+  (('.xz',), [['pixz', '-d'], ['xz', '-dc', '-T0']]),
+  (('.gz', '.tgz'), [['pigz', '-dc']]),
+  (('.bz2', '.tbz2'), [['pbzip2', '-dc']]),
+]
+
+# The programs that have failed to decompress an archive (see untargz()), and
+# are not used again.
+failed_decompressors = set()
+
+
+def find_external_decompressor(name):
+  """Returns the command to decompress the archive `name` with, read from
+  stdin and written to stdout, or None if it should be decompressed in Python.
+  See EMSDK_DECOMPRESSOR.
+  """
+  if DECOMPRESSOR == 'none' or (DECOMPRESSOR == 'auto' and (os.cpu_count() or 1) == 1):
+    return None
+  for suffixes, commands in EXTERNAL_DECOMPRESSORS:
+    if name.endswith(suffixes):
+      for cmd in commands:
+        if DECOMPRESSOR in {'auto', cmd[0]} and cmd[0] not in failed_decompressors and shutil.which(cmd[0]):
+          return cmd
+  return None
+
+
+def find_zstd_decoder():
+  """Returns how .zst archives can be decompressed on this host: with the
+  `compression.zstd` module (Python 3.14+), the `zstandard` package, or the
+  `zstd` program.  Returns None if there is no way to.
+  """
+  if not hasattr(find_zstd_decoder, 'decoder'):
+    find_zstd_decoder.decoder = None
+    for module in ('compression.zstd', 'zstandard'):
+      try:
+        __import__(module)
+        find_zstd_decoder.decoder = module
+        break
+      except ImportError:
+        pass
+    else:
+      if shutil.which('zstd'):
+        find_zstd_decoder.decoder = 'zstd'
+  return find_zstd_decoder.decoder
+
+
+def open_decompressed(fileobj, name):
+  """Returns a file object with the decompressed contents of `fileobj`, if
+  `name` is an archive that is decompressed by an external program (see
+  find_external_decompressor()), or a .zst archive, which tarfile cannot
+  decompress by itself.  Other archives are returned as they are, for tarfile
+  to decompress.
+  """
+  cmd = find_external_decompressor(name)
+  if cmd:
+    debug_print(f"Decompressing '{name}' with '{' '.join(cmd)}'")
+    return DecompressorPipe(cmd, fileobj)
+  if not name.endswith('.zst'):
+    return fileobj
+  decoder = find_zstd_decoder()
+  if decoder == 'compression.zstd':
+    from compression import zstd
+    return zstd.ZstdFile(fileobj)
+  if decoder == 'zstandard':
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+  if decoder == 'zstd':
+    return DecompressorPipe(['zstd', '-dc'], fileobj)
+  raise OSError(f"cannot decompress '{name}': install the zstandard Python package or the zstd program")
 
 
 def fix_potentially_long_windows_pathname(pathname):
@@ -536,65 +1242,438 @@ def move_with_overwrite(src, dest):
   os.rename(src, dest)
 
 
+def hash_files(paths):
+  """Returns the SHA-256 of each of the given files (or None for files that
+  can't be read), hashing several files at a time.
+  """
+  def hash_file(path):
+    try:
+      return sha256_file(path)
+    except OSError:
+      return None
+
+  with thread_pool() as executor:
+    return list(executor.map(hash_file, paths))
+
+
+def path_matches(relpath, patterns):
+  """Returns True if `relpath`, or one of the directories it is in, matches
+  one of the given fnmatch patterns."""
+  parts = relpath.split('/')
+  for i in range(1, len(parts) + 1):
+    prefix = '/'.join(parts[:i])
+    if any(fnmatch.fnmatchcase(prefix, pattern) for pattern in patterns):
+      return True
+  return False
+
+
+def profile_member_filter(profile):
+  """Returns a member_filter for TarExtractor and unzip() that applies the
+  include and exclude patterns of the given install profile, or None if it
+  doesn't have any."""
+  include = INSTALL_PROFILES[profile].get('include')
+  exclude = INSTALL_PROFILES[profile].get('exclude')
+  if not include and not exclude:
+    return None
+
+  # The directories that lead to included files are created by the extractors
+  # as needed, so they don't have to match `include` themselves.
+  def member_filter(relpath):
+    if include and not path_matches(relpath, include):
+      return False
+    return not (exclude and path_matches(relpath, exclude))
+
+  return member_filter
+
+
+def is_elf_file(path):
+  try:
+    with open(path, 'rb') as f:
+      return f.read(4) == b'\x7fELF'
+  except OSError:
+    return False
+
+
+def strip_binaries(paths):
+  """Strips symbols from the ELF binaries among the given files, with the
+  `strip` program.  Returns the binaries that were stripped."""
+  strip = shutil.which('strip')
+  if not strip:
+    errlog('Warning: `strip` was not found, so installed binaries are not stripped.')
+    return []
+  with thread_pool() as executor:
+    binaries = [path for path, elf in zip(paths, executor.map(is_elf_file, paths), strict=True) if elf]
+    if not binaries:
+      return []
+    debug_print(f'Stripping {len(binaries)} binaries')
+
+    def run_strip(batch):
+      # strip carries on with the other files if one of them can't be
+      # stripped; those are simply left as they are.
+      proc = subprocess.run([strip, '-s', *batch], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False)
+      if proc.returncode:
+        debug_print(f'strip: {proc.stderr.strip()}')
+
+    batch_size = -(-len(binaries) // max(EXTRACT_JOBS, 1))
+    list(executor.map(run_strip, [binaries[i:i + batch_size] for i in range(0, len(binaries), batch_size)]))
+  return binaries
+
+
+class InstallManifest:
+  """Records the files that were installed into a tool's installation
+  directory: the size, mode, SHA-256 and mtime of each regular file, and the
+  target of each symlink.  It is stored next to .emsdk_version, and lets
+  `emsdk verify` find damaged files, `emsdk repair` restore only those, and
+  `emsdk uninstall` remove exactly the files that were installed.
+
+  Paths are relative to the installation directory, with '/' separators.
+  `profile` is the install profile (see INSTALL_PROFILES) that the tool was
+  installed with.
+  """
+
+  FILE_NAME = '.emsdk_manifest'
+
+  # Present while the installation directory is being upgraded in place, see
+  # begin_upgrade().
+  UPGRADE_JOURNAL = '.emsdk_upgrade'
+
+  def __init__(self, root, archive=None, profile='full'):
+    self.root = root
+    self.archive = archive
+    self.profile = profile
+    # The manifest of the tree that this install upgrades in place, if any.
+    self.previous = None
+    self.files = {}
+    self.links = {}
+
+  @staticmethod
+  def file_path(root):
+    return os.path.join(root, InstallManifest.FILE_NAME)
+
+  @classmethod
+  def load(cls, root):
+    """Returns the manifest of the given installation directory, or None if
+    it doesn't have one."""
+    try:
+      data = json.loads(read_file(cls.file_path(root)))
+    except (OSError, ValueError):
+      return None
+    manifest = cls(root, data.get('archive'), data.get('profile', 'full'))
+    manifest.files = data['files']
+    manifest.links = data['links']
+    return manifest
+
+  def save(self):
+    data = {'archive': self.archive, 'profile': self.profile, 'files': self.files, 'links': self.links}
+    write_file(self.file_path(self.root), json.dumps(data, separators=(',', ':'), sort_keys=True))
+
+  def relpath(self, path):
+    if path.startswith(('\\\\?\\', '//?/')):
+      path = path[4:]
+    return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+  def path(self, relpath):
+    return os.path.join(self.root, *relpath.split('/'))
+
+  def record_file(self, path, st, sha256):
+    self.files[self.relpath(path)] = [st.st_size, stat.S_IMODE(st.st_mode), sha256, st.st_mtime_ns]
+
+  def record_link(self, path, target):
+    self.links[self.relpath(path)] = target
+
+  def record_copy(self, path, source):
+    """Records `path` as having the same contents as `source`, e.g. because it
+    is a hard link to it."""
+    entry = self.files.get(self.relpath(source))
+    self.record_file(path, os.lstat(path), entry[2] if entry else sha256_file(path))
+
+  def refresh(self):
+    """Brings the manifest up to date with the installation directory, to pick
+    up files that were added, changed or removed after extraction (e.g. by
+    post-install steps).  Only files whose size or mtime changed are hashed
+    again.
+    """
+    files = {}
+    links = {}
+    changed = []
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      for name in dirnames + filenames:
+        path = os.path.join(dirpath, name)
+        relpath = self.relpath(path)
+        if relpath in {self.FILE_NAME, self.UPGRADE_JOURNAL, '.emsdk_version'}:
+          continue
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+          links[relpath] = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+          entry = self.files.get(relpath)
+          if entry and entry[0] == st.st_size and entry[3] == st.st_mtime_ns:
+            files[relpath] = [st.st_size, stat.S_IMODE(st.st_mode), entry[2], st.st_mtime_ns]
+          else:
+            changed.append((relpath, st))
+    for (relpath, st), sha256 in zip(changed, hash_files([self.path(relpath) for relpath, _ in changed]), strict=True):
+      files[relpath] = [st.st_size, stat.S_IMODE(st.st_mode), sha256, st.st_mtime_ns]
+    self.files = files
+    self.links = links
+
+  def check(self):
+    """Compares the installation directory with the manifest.  Returns a dict
+    from the paths that don't match to a description of what is wrong with
+    them.  Files that are not in the manifest are not reported.
+    """
+    problems = {}
+    to_hash = []
+    for relpath, (size, mode, _sha256, _mtime) in self.files.items():
+      try:
+        st = os.lstat(self.path(relpath))
+      except FileNotFoundError:
+        problems[relpath] = 'missing'
+        continue
+      if not stat.S_ISREG(st.st_mode):
+        problems[relpath] = 'not a regular file'
+      elif st.st_size != size:
+        problems[relpath] = f'size is {st.st_size} instead of {size}'
+      elif stat.S_IMODE(st.st_mode) != mode:
+        problems[relpath] = f'mode is {stat.S_IMODE(st.st_mode):o} instead of {mode:o}'
+      else:
+        to_hash.append(relpath)
+    for relpath, sha256 in zip(to_hash, hash_files([self.path(relpath) for relpath in to_hash]), strict=True):
+      if sha256 != self.files[relpath][2]:
+        problems[relpath] = 'contents differ' if sha256 else 'cannot be read'
+    for relpath, target in self.links.items():
+      try:
+        actual = os.readlink(self.path(relpath))
+      except OSError:
+        problems[relpath] = 'missing'
+        continue
+      if actual != target:
+        problems[relpath] = f"links to '{actual}' instead of '{target}'"
+    return problems
+
+  def begin_upgrade(self, archive):
+    """Marks the installation directory as being upgraded in place to the
+    given archive.  Until finish_upgrade() is called, no tool counts as
+    installed there, and this manifest (of the tree that is being upgraded)
+    stays in place.  If the upgrade is interrupted, running it again compares
+    the archive against this manifest once more, which rewrites the files that
+    the interrupted upgrade already changed, and gets the tree into the same
+    state as if it had completed.
+    """
+    journal = os.path.join(self.root, self.UPGRADE_JOURNAL)
+    if os.path.exists(journal):
+      debug_print(f'resuming interrupted upgrade of {self.root} ({read_file(journal).strip()})')
+      for dirpath, _, filenames in os.walk(self.root):
+        for name in filenames:
+          if name.endswith(TarExtractor.UPGRADE_SUFFIX):
+            os.unlink(os.path.join(dirpath, name))
+    print(f"Upgrading '{self.root}' in place from '{self.archive}'")
+    write_file(journal + '.tmp', json.dumps({'from': self.archive, 'to': archive}) + '\n')
+    os.replace(journal + '.tmp', journal)
+    rmfile(os.path.join(self.root, '.emsdk_version'))
+
+  def finish_upgrade(self):
+    rmfile(os.path.join(self.root, self.UPGRADE_JOURNAL))
+
+  def remove_stale_files(self, previous):
+    """Removes the files and links of the `previous` manifest that are not in
+    this one, and the directories that this leaves empty.  Returns the number of
+    files that were removed."""
+    stale = [relpath for relpath in [*previous.files, *previous.links] if relpath not in self.files and relpath not in self.links]
+    for relpath in stale:
+      path = self.path(relpath)
+      if os.path.lexists(path) and (os.path.islink(path) or not os.path.isdir(path)):
+        os.unlink(path)
+    for d in sorted({os.path.dirname(self.path(relpath)) for relpath in stale}, key=len, reverse=True):
+      while d != self.root and os.path.isdir(d) and not os.listdir(d):
+        os.rmdir(d)
+        d = os.path.dirname(d)
+    return len(stale)
+
+  def only_installed_files(self):
+    """Returns True if the installation directory contains nothing but the
+    files in the manifest."""
+    known = {*self.files, *self.links, self.FILE_NAME, self.UPGRADE_JOURNAL, '.emsdk_version'}
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      for name in dirnames + filenames:
+        path = os.path.join(dirpath, name)
+        if (os.path.islink(path) or not os.path.isdir(path)) and self.relpath(path) not in known:
+          return False
+    return True
+
+  def remove_files(self):
+    """Removes the files in the manifest, the manifest itself, and then any
+    directories that this leaves empty.  Returns the number of files that were
+    left behind because they weren't installed by emsdk.
+    """
+    if self.only_installed_files():
+      # Nothing else lives in the directory, so it can go as a whole.
+      discard_tree(self.root)
+      return 0
+    for relpath in [*self.files, *self.links, self.FILE_NAME, self.UPGRADE_JOURNAL, '.emsdk_version']:
+      path = self.path(relpath)
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      except PermissionError:
+        # The file, or on Windows the directory it is in, may be read-only.
+        os.chmod(os.path.dirname(path), stat.S_IRWXU)
+        if not os.path.islink(path):
+          os.chmod(path, stat.S_IWRITE)
+        os.unlink(path)
+    left_behind = 0
+    for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+      left_behind += len(filenames) + len([d for d in dirnames if os.path.islink(os.path.join(dirpath, d))])
+      if os.listdir(dirpath):
+        continue
+      parent = os.path.dirname(dirpath)
+      if dirpath != self.root and not os.access(parent, os.W_OK):
+        os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+      try:
+        os.rmdir(dirpath)
+      except OSError:
+        pass
+    return left_behind
+
+
+def zip_common_subdir(members):
+  """Returns the top level directory that all members of a zip archive reside
+  in, or None if there is no such directory.
+  """
+  common_subdir = None
+  for member in members:
+    words = member.filename.split('/')
+    if len(words) == 1:  # No directory component
+      return None
+    if common_subdir is None:
+      common_subdir = words[0]
+    elif common_subdir != words[0]:
+      return None
+  return common_subdir
+
+
 # http://stackoverflow.com/questions/12886768/simple-way-to-unzip-file-in-python-on-all-oses
-def unzip(source_filename, dest_dir):
+def unzip(source_filename, dest_dir, manifest=None, member_filter=None):
+  """Extracts a zip archive into `dest_dir`.  See TarExtractor for `manifest`
+  and `member_filter`.
+  """
   print(f"Unpacking '{source_filename}' to '{dest_dir}'")
   mkdir_p(dest_dir)
-  common_subdir = None
   try:
     with zipfile.ZipFile(source_filename) as zf:
+      members = zf.infolist()
+
       # Implement '--strip 1' behavior to unzipping by testing if all the files
-      # in the zip reside in a common subdirectory, and if so, we move the
-      # output tree at the end of uncompression step.
-      for member in zf.infolist():
-        words = member.filename.split('/')
-        if len(words) > 1:  # If there is a directory component?
-          if common_subdir is None:
-            common_subdir = words[0]
-          elif common_subdir != words[0]:
-            common_subdir = None
-            break
+      # in the zip reside in a common subdirectory, and if so, we extract each
+      # member directly to its path without the base directory name.
+      common_subdir = zip_common_subdir(members)
+
+      def target_path(member):
+        """Returns the path that `member` is extracted to, or None for the
+        common subdirectory itself and members that are filtered out."""
+        parts = [p for p in member.filename.split('/') if p and p != '.']
+        if common_subdir:
+          assert parts[0] == common_subdir, f'unexpected filename {member.filename}'
+          parts = parts[1:]
+        if not parts or (member_filter and not member_filter('/'.join(parts))):
+          return None
+        if '..' in parts:
+          raise ValueError(f"refusing to extract '{member.filename}' outside of '{dest_dir}'")
+        return fix_potentially_long_windows_pathname(os.path.join(dest_dir, *parts))
+
+      def extract_member(zf, member):
+        path = target_path(member)
+        # See: https://stackoverflow.com/questions/42326428/zipfile-in-python-file-permission
+        unix_attributes = member.external_attr >> 16
+        sha = hashlib.sha256()
+        with zf.open(member) as src, open(open_for_write(path), 'wb') as dst:
+          while True:
+            data = src.read(1024 * 1024)
+            if not data:
+              break
+            sha.update(data)
+            dst.write(data)
+          dst.flush()
+          if unix_attributes:
+            mode = stat.S_IMODE(unix_attributes)
+            os.chmod(dst.fileno() if os.chmod in os.supports_fd else path, mode)
+          if manifest:
+            manifest.record_file(path, os.fstat(dst.fileno()), sha.hexdigest())
+
+      # Create all directories up front, so that the files can then be
+      # extracted in any order without racing to create their parents.
+      # Directory permissions are applied at the end, so that read-only
+      # directories can still be written into.
+      files = []
+      dirs = []
+      links = []
+      parent_dirs = set()
+      for member in members:
+        path = target_path(member)
+        if not path:
+          continue
+        if member.is_dir():
+          dirs.append((path, member))
+          parent_dirs.add(path)
+        elif stat.S_ISLNK(member.external_attr >> 16) and not WINDOWS:
+          # Symlinks are stored as members whose contents are the link target.
+          # On Windows they are extracted as regular files, like before.
+          links.append((path, member))
+          parent_dirs.add(os.path.dirname(path))
         else:
-          common_subdir = None
-          break
-
-      unzip_to_dir = dest_dir
-      if common_subdir:
-        unzip_to_dir = os.path.join(os.path.dirname(dest_dir), 'unzip_temp')
-
-      # Now do the actual decompress.
-      unzip_to_dir = fix_potentially_long_windows_pathname(unzip_to_dir)
-      for member in zf.infolist():
-        zf.extract(member, unzip_to_dir)
-        dst_filename = os.path.join(unzip_to_dir, os.path.normpath(member.filename))
+          files.append(member)
+          parent_dirs.add(os.path.dirname(path))
+      for d in parent_dirs:
+        os.makedirs(d, exist_ok=True)
+
+      # Zip members are compressed independently of each other and zlib
+      # releases the GIL, so decompress them on a pool of threads.  A ZipFile
+      # can only read one member at a time, so each thread opens its own, and
+      # takes the next member from a shared queue whenever it is done with one.
+      # Start with the largest members, so that the pool doesn't end up
+      # waiting on a single big file at the end.
+      files.sort(key=lambda member: member.file_size, reverse=True)
+      pending = iter(files)
+      pending_lock = threading.Lock()
+      failed = threading.Event()
+
+      def extract_files():
+        try:
+          with zipfile.ZipFile(source_filename) as zf:
+            while not failed.is_set():
+              with pending_lock:
+                member = next(pending, None)
+              if member is None:
+                return
+              extract_member(zf, member)
+        except Exception:
+          failed.set()
+          raise
 
-        # See: https://stackoverflow.com/questions/42326428/zipfile-in-python-file-permission
+      jobs = min(max(EXTRACT_JOBS, 1), len(files))
+      if jobs <= 1:
+        extract_files()
+      else:
+        with thread_pool(max_workers=jobs) as executor:
+          for future in [executor.submit(extract_files) for _ in range(jobs)]:
+            future.result()
+
+      for path, member in links:
+        target = zf.read(member).decode('utf-8')
+        if os.path.lexists(path):
+          os.unlink(path)
+        os.symlink(target, path)
+        if manifest:
+          manifest.record_link(path, target)
+
+      for path, member in dirs:
         unix_attributes = member.external_attr >> 16
         if unix_attributes:
-          os.chmod(dst_filename, unix_attributes)
-
-        # Move the extracted file to its final location without the base
-        # directory name, if we are stripping that away.
-        if common_subdir:
-          assert member.filename.startswith(common_subdir), f'unexpected filename {member.filename}'
-          stripped_filename = '.' + member.filename[len(common_subdir):]
-          final_dst_filename = os.path.join(dest_dir, stripped_filename)
-          # Check if a directory
-          if stripped_filename.endswith('/'):
-            d = fix_potentially_long_windows_pathname(final_dst_filename)
-            if not os.path.isdir(d):
-              os.mkdir(d)
-          else:
-            parent_dir = os.path.dirname(fix_potentially_long_windows_pathname(final_dst_filename))
-            if parent_dir and not os.path.exists(parent_dir):
-              os.makedirs(parent_dir)
-            move_with_overwrite(fix_potentially_long_windows_pathname(dst_filename), fix_potentially_long_windows_pathname(final_dst_filename))
-
-      if common_subdir:
-        remove_tree(unzip_to_dir)
+          os.chmod(path, stat.S_IMODE(unix_attributes))
   except zipfile.BadZipfile as e:
     errlog(f"Unzipping file '{source_filename}' failed due to reason: {e}! Removing the corrupted zip file.")
     rmfile(source_filename)
+    DownloadJournal.remove(source_filename)
     return False
   except Exception as e:
     errlog(f"Unzipping file '{source_filename}' failed due to reason: {e}")
@@ -632,100 +1711,1550 @@ def get_content_length(download):
     return 0
 
 
-def get_download_target(url, dstpath, filename_prefix=''):
-  file_name = filename_prefix + url.split('/')[-1]
-  if path_points_to_directory(dstpath):
-    file_name = os.path.join(dstpath, file_name)
-  else:
-    file_name = dstpath
+def get_download_target(url, dstpath, filename_prefix=''):
+  file_name = filename_prefix + url.split('/')[-1]
+  if path_points_to_directory(dstpath):
+    file_name = os.path.join(dstpath, file_name)
+  else:
+    file_name = dstpath
+
+  # Treat all relative destination paths as relative to the SDK root directory,
+  # not the current working directory.
+  file_name = sdk_path(file_name)
+
+  return file_name
+
+
+class DownloadJournal:
+  """Records the progress of a download in a small JSON file that lives next to
+  the file being downloaded.
+
+  While a download is in progress the data is written to `<file>.part`, and the
+  journal remembers the expected length, the ETag reported by the server and
+  the byte ranges that have been written so far.  This allows an interrupted
+  download to be resumed with HTTP range requests.  Once the download is
+  complete the `.part` file is renamed into place and the journal is marked as
+  complete, which lets us tell a full download apart from a truncated one.  The
+  SHA-256 of a complete download is recorded too, so that it never needs to be
+  hashed again.
+  """
+
+  def __init__(self, file_name, url, length=None, etag=None, accept_ranges=False):
+    self.file_name = file_name
+    self.url = url
+    self.length = length
+    self.etag = etag
+    self.accept_ranges = accept_ranges
+    self.ranges = []
+    self.complete = False
+    self.sha256 = None
+    self.lock = threading.Lock()
+    self.last_save = 0
+    self.hasher = DownloadHasher(self)
+
+  @staticmethod
+  def path(file_name):
+    return file_name + '.journal'
+
+  @staticmethod
+  def part_path(file_name):
+    return file_name + '.part'
+
+  @staticmethod
+  def load(file_name):
+    try:
+      data = json.loads(read_file(DownloadJournal.path(file_name)))
+      journal = DownloadJournal(file_name, data['url'], data['length'], data['etag'], data['accept_ranges'])
+      journal.ranges = [tuple(r) for r in data['ranges']]
+      journal.complete = data['complete']
+      journal.sha256 = data.get('sha256')
+    except Exception:
+      return None
+    return journal
+
+  @staticmethod
+  def remove(file_name):
+    rmfile(DownloadJournal.path(file_name))
+    rmfile(DownloadJournal.part_path(file_name))
+
+  def save(self):
+    with self.lock:
+      data = {
+        'url': self.url,
+        'length': self.length,
+        'etag': self.etag,
+        'accept_ranges': self.accept_ranges,
+        'ranges': self.ranges,
+        'complete': self.complete,
+        'sha256': self.sha256,
+      }
+      # Write to a temporary file first so that a crash while saving never
+      # leaves behind a corrupt journal.
+      tmp = self.path(self.file_name) + '.tmp'
+      write_file(tmp, json.dumps(data))
+      os.replace(tmp, self.path(self.file_name))
+      self.last_save = time.monotonic()
+
+  def add_range(self, start, end):
+    """Marks the bytes [start, end) as written to disk."""
+    with self.lock:
+      merged = []
+      for s, e in sorted([*self.ranges, (start, end)]):
+        if merged and s <= merged[-1][1]:
+          merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+          merged.append((s, e))
+      self.ranges = merged
+      save_due = time.monotonic() - self.last_save > 1
+    if save_due:
+      self.save()
+
+  def add_data(self, offset, data):
+    """Marks `data`, which has just been written to disk at `offset`, as
+    downloaded.
+    """
+    self.add_range(offset, offset + len(data))
+    self.hasher.update(offset, data)
+
+  def contiguous_length(self):
+    """Returns the number of bytes downloaded from the start of the file without
+    any gaps.
+    """
+    with self.lock:
+      if self.ranges and self.ranges[0][0] == 0:
+        return self.ranges[0][1]
+      return 0
+
+  def finish(self):
+    """Marks the download as complete, once the `.part` file is fully written,
+    and moves it into place.
+    """
+    self.sha256 = self.hasher.hexdigest()
+    move_with_overwrite(self.part_path(self.file_name), self.file_name)
+    self.complete = True
+    self.save()
+
+  def bytes_done(self):
+    with self.lock:
+      return sum(e - s for s, e in self.ranges)
+
+  def missing_ranges(self):
+    with self.lock:
+      missing = []
+      pos = 0
+      for s, e in self.ranges:
+        if s > pos:
+          missing.append((pos, s))
+        pos = e
+      if self.length is None or pos < self.length:
+        missing.append((pos, self.length))
+      return missing
+
+  def can_resume(self, url):
+    part_file = self.part_path(self.file_name)
+    return (not self.complete and self.url == url and self.length and self.accept_ranges and self.ranges and
+            os.path.isfile(part_file) and os.path.getsize(part_file) == self.length)
+
+  def is_complete_download(self):
+    """Returns True if the journal records a finished download, and the file on
+    disk still has the recorded length.
+    """
+    return (self.complete and os.path.isfile(self.file_name) and
+            (self.length is None or os.path.getsize(self.file_name) == self.length))
+
+
+class DownloadHasher:
+  """Computes the SHA-256 of a download while it is being written.
+
+  Data that arrives in order is hashed straight from memory.  When a file is
+  downloaded in several segments at once, data beyond the current hash position
+  is hashed later by reading it back from the partial file, as soon as the gap
+  before it has been filled.  Either way the digest is ready when the download
+  finishes, without another pass over the whole file.
+  """
+
+  def __init__(self, journal):
+    self.journal = journal
+    self.sha = hashlib.sha256()
+    self.pos = 0
+    self.lock = threading.Lock()
+
+  def update(self, offset, data):
+    with self.lock:
+      if offset == self.pos:
+        self.sha.update(data)
+        self.pos += len(data)
+      self.catch_up()
+
+  def catch_up(self):
+    end = self.journal.contiguous_length() if self.journal else self.pos
+    if end <= self.pos:
+      return
+    with open(DownloadJournal.part_path(self.journal.file_name), 'rb') as f:
+      f.seek(self.pos)
+      while self.pos < end:
+        buffer = f.read(min(1024 * 1024, end - self.pos))
+        if not buffer:
+          break
+        self.sha.update(buffer)
+        self.pos += len(buffer)
+
+  def hexdigest(self):
+    with self.lock:
+      self.catch_up()
+      return self.sha.hexdigest()
+
+
+def is_download_complete(file_name, sha256=None):
+  """Returns True if `file_name` has been fully downloaded.  If `sha256` is
+  given the file must also match it.
+  """
+  journal = DownloadJournal.load(file_name)
+  if journal is None or not journal.is_complete_download():
+    return False
+  if sha256 and not journal.sha256:
+    # Downloads that completed before digests were recorded are hashed once.
+    journal.sha256 = sha256_file(file_name)
+    journal.save()
+  return not sha256 or journal.sha256 == sha256
+
+
+def download_with_curl(url, file_name):
+  part_file = DownloadJournal.part_path(file_name)
+  journal = DownloadJournal.load(file_name)
+  # curl can only continue a download by appending to the end of the file, so
+  # only resume if the journal says the data on disk is one contiguous prefix.
+  if not (journal and journal.url == url and not journal.complete and os.path.isfile(part_file) and
+          journal.ranges == [(0, os.path.getsize(part_file))]):
+    DownloadJournal.remove(file_name)
+    journal = DownloadJournal(file_name, url)
+
+  if os.path.isfile(part_file):
+    print("Resuming download: %s from %s, %s Bytes already downloaded" % (file_name, url, os.path.getsize(part_file)))
+  else:
+    print("Downloading: %s from %s" % (file_name, url))
+  if not shutil.which('curl'):
+    exit_with_error('curl not found in PATH')
+  try:
+    # -#: show progress bar
+    # -L: Follow HTTP 3XX redirections
+    # -f: Fail on HTTP errors
+    # -C -: Continue from the end of an existing partial download
+    # -y/-Y: Give up when the download stalls for DOWNLOAD_TIMEOUT seconds
+    cmd = ['curl', '-#', '-f', '-L', '-C', '-', '-y', str(DOWNLOAD_TIMEOUT), '-Y', '1', '-o', part_file, url]
+    scheduler = get_download_scheduler()
+    with scheduler.slot(journal.length):
+      rate = scheduler.current_rate()
+      if rate:
+        cmd += ['--limit-rate', str(rate)]
+      subprocess.check_call(cmd)
+  finally:
+    if os.path.isfile(part_file):
+      journal.ranges = [(0, os.path.getsize(part_file))]
+      journal.save()
+
+  journal.length = os.path.getsize(part_file)
+  # curl writes the file itself, so it has to be hashed afterwards.
+  journal.sha256 = sha256_file(part_file)
+  move_with_overwrite(part_file, file_name)
+  journal.complete = True
+  journal.save()
+  return journal
+
+
+class PooledResponse:
+  """An HTTP response whose connection goes back to its ConnectionPool once the
+  body has been read in full.  Behaves like the responses returned by urlopen.
+  """
+
+  def __init__(self, pool, key, conn, response, url):
+    self.pool = pool
+    self.key = key
+    self.conn = conn
+    self.response = response
+    self.url = url
+    self.status = response.status
+    self.headers = response.headers
+
+  def geturl(self):
+    return self.url
+
+  def read(self, size=-1):
+    if size is None or size < 0:
+      data = self.response.read()
+    else:
+      data = self.response.read(size)
+    if self.response.isclosed():
+      self.release()
+    return data
+
+  def readinto(self, buffer):
+    n = self.response.readinto(buffer)
+    if self.response.isclosed():
+      self.release()
+    return n
+
+  def release(self):
+    if self.conn:
+      if self.response.will_close:
+        self.conn.close()
+      else:
+        self.pool.release(self.key, self.conn)
+      self.conn = None
+
+  def close(self):
+    # Responses without a body (e.g. to HEAD requests) are complete as soon as
+    # the headers have been read.
+    if self.response.length == 0:
+      self.response.read()
+    if self.response.isclosed():
+      self.release()
+    elif self.conn:
+      # The rest of the body was not read, so the connection can't be reused.
+      self.response.close()
+      self.conn.close()
+      self.conn = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class ConnectionPool:
+  """Keeps HTTP connections open between requests, so that the requests made
+  during one run of emsdk don't each pay for a new TCP connection and TLS
+  handshake.  Idle connections are kept per host, and handed out to one request
+  at a time, so the pool can be used from several threads.
+  """
+
+  def __init__(self, max_idle_per_host=8):
+    # Loading the CA certificates takes a while, which is why the pool is only
+    # created once a request is made (see get_connection_pool()).
+    import ssl
+    self.max_idle_per_host = max_idle_per_host
+    self.idle = {}
+    self.lock = threading.Lock()
+    self.ssl_context = ssl.create_default_context()
+
+  def connect(self, key, timeout):
+    import http.client
+    scheme, netloc = key
+    if scheme == 'https':
+      return http.client.HTTPSConnection(netloc, timeout=timeout, context=self.ssl_context)
+    return http.client.HTTPConnection(netloc, timeout=timeout)
+
+  def release(self, key, conn):
+    with self.lock:
+      conns = self.idle.setdefault(key, [])
+      if len(conns) < self.max_idle_per_host:
+        conns.append(conn)
+        return
+    conn.close()
+
+  def send(self, key, method, path, headers, timeout):
+    with self.lock:
+      conns = self.idle.get(key)
+      conn = conns.pop() if conns else None
+    if conn:
+      conn.timeout = timeout
+      if conn.sock:
+        conn.sock.settimeout(timeout)
+      try:
+        conn.request(method, path, headers=headers)
+        return conn, conn.getresponse()
+      except ConnectionError:
+        # The server has closed the idle connection in the meantime; fall
+        # through and retry on a new one.
+        conn.close()
+      except BaseException:
+        conn.close()
+        raise
+    conn = self.connect(key, timeout)
+    try:
+      conn.request(method, path, headers=headers)
+      return conn, conn.getresponse()
+    except BaseException:
+      conn.close()
+      raise
+
+  def request(self, url, headers, method, timeout):
+    headers = {'User-Agent': 'Python-urllib/%d.%d' % sys.version_info[:2], **headers}
+    # Follow redirects, like urlopen does.
+    for _ in range(10):
+      parts = urlsplit(url)
+      key = (parts.scheme, parts.netloc)
+      path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+      conn, response = self.send(key, method, path, headers, timeout)
+      pooled = PooledResponse(self, key, conn, response, url)
+      location = response.headers.get('Location')
+      if response.status in {301, 302, 303, 307, 308} and location:
+        pooled.read()
+        url = urljoin(url, location)
+        if response.status == 303 and method != 'HEAD':
+          method = 'GET'
+        continue
+      if response.status >= 400:
+        pooled.read()
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+      return pooled
+    raise HTTPError(url, response.status, 'too many redirects', response.headers, None)
+
+
+def get_connection_pool():
+  if not hasattr(get_connection_pool, 'pool'):
+    get_connection_pool.pool = ConnectionPool()
+  return get_connection_pool.pool
+
+
+def preallocate(f, length):
+  """Sets the size of the open file `f` to `length`, reserving the disk space
+  for it where the OS supports it.  That keeps the file in one piece on disk,
+  and makes a full disk show up before the download rather than halfway
+  through.
+  """
+  f.truncate(length)
+  if hasattr(os, 'posix_fallocate'):
+    try:
+      os.posix_fallocate(f.fileno(), 0, length)
+    except OSError as e:
+      # Not all filesystems support this.
+      debug_print(f'posix_fallocate failed: {e}')
+
+
+def open_url(url, headers=None, method=None, timeout=DOWNLOAD_TIMEOUT):
+  """Makes an HTTP request and returns the response.  Connections are reused
+  between requests via get_connection_pool(), except when going through a
+  proxy, which is left to urlopen.
+  """
+  # Like http.client, which it imports, urllib.request takes a while to load,
+  # and most commands (e.g. construct_env) never get here.
+  from urllib.request import Request, getproxies, proxy_bypass, urlopen
+  parts = urlsplit(url)
+  if parts.scheme not in {'http', 'https'} or (getproxies().get(parts.scheme) and not proxy_bypass(parts.hostname)):
+    return urlopen(Request(url, headers=headers or {}, method=method), timeout=timeout)
+  return get_connection_pool().request(url, headers or {}, method or 'GET', timeout)
+
+
+def probe_mirror(mirror, path):
+  """Returns the number of seconds it takes `mirror` to serve the first 256 KiB
+  of `path`, or None if it could not be reached.
+  """
+  start = time.monotonic()
+  try:
+    with open_url(mirror + path, headers={'Range': 'bytes=0-262143'}, timeout=5) as u:
+      # Servers that don't support range requests send the whole file.
+      u.read(256 * 1024)
+  except HTTPError:
+    # The mirror is up, even if it does not have this particular file.
+    pass
+  except Exception as e:
+    debug_print(f'mirror {mirror} is unreachable: {e}')
+    return None
+  return time.monotonic() - start
+
+
+def rank_mirrors(mirrors, path):
+  """Returns the given mirrors ordered fastest first, with any that cannot be
+  reached at the end.  The mirrors are probed by fetching the start of `path`,
+  and the result is remembered for MIRROR_PROBE_TTL seconds.
+  """
+  if len(mirrors) == 1:
+    return mirrors
+  probe_file = sdk_path(download_dir + 'mirrors.json')
+  with mirrors_lock:
+    try:
+      probe = json.loads(read_file(probe_file))
+      if probe['mirrors'] == mirrors and time.time() - probe['time'] < MIRROR_PROBE_TTL:
+        return probe['ranking']
+    except Exception:
+      pass
+
+    with thread_pool(max_workers=len(mirrors)) as executor:
+      timings = list(executor.map(lambda m: probe_mirror(m, path), mirrors))
+    for mirror, timing in zip(mirrors, timings, strict=True):
+      debug_print(f'mirror {mirror}: ' + ('unreachable' if timing is None else '%.3fs' % timing))
+    order = sorted(range(len(mirrors)), key=lambda i: (timings[i] is None, timings[i] or 0))
+    ranking = [mirrors[i] for i in order]
+    mkdir_p(os.path.dirname(probe_file))
+    write_file(probe_file, json.dumps({'mirrors': mirrors, 'time': time.time(), 'ranking': ranking}))
+    return ranking
+
+
+def get_mirror_urls(url):
+  """Returns the list of URLs that `url` can be downloaded from, in the order
+  they should be tried.
+  """
+  if not url.startswith(emscripten_releases_builds_url):
+    return [url]
+  path = url[len(emscripten_releases_builds_url):]
+  mirrors = MIRRORS + [m for m in [emscripten_releases_builds_url] if m not in MIRRORS]
+  return [m + path for m in rank_mirrors(mirrors, path)]
+
+
+class DownloadProgress:
+  """Tracks the number of bytes downloaded so far and draws a progress bar.
+
+  Updates may come from several threads at once when a file is downloaded in
+  multiple segments.
+  """
+
+  def __init__(self, file_size, downloaded=0):
+    self.file_size = file_size
+    self.downloaded = downloaded
+    self.lock = threading.Lock()
+    # Draw a progress bar 80 chars wide (in non-TTY mode)
+    self.progress_max = 80 - 4
+    self.progress_shown = 0
+    # In TTY mode the status line is redrawn at most ten times a second, so
+    # that printing doesn't slow down fast downloads.
+    self.last_draw = 0
+    # When several tools are installing at once the bar is drawn in one go at
+    # the end, since updates arrive from segment threads that don't own the
+    # current output line.
+    self.deferred = isinstance(sys.stdout, LineBufferedOutput)
+    if not TTY_OUTPUT and not self.deferred:
+      print(' [', end='')
+
+  def update(self, num_bytes):
+    with self.lock:
+      self.downloaded += num_bytes
+      if not self.file_size:
+        return
+      percent = self.downloaded * 100.0 / self.file_size
+      if TTY_OUTPUT:
+        now = time.monotonic()
+        if now - self.last_draw >= 0.1:
+          self.last_draw = now
+          self.draw_status()
+      elif not self.deferred:
+        while self.progress_shown < self.progress_max * percent / 100:
+          print('-', end='')
+          sys.stdout.flush()
+          self.progress_shown += 1
+
+  def draw_status(self):
+    percent = self.downloaded * 100.0 / self.file_size
+    status = r" %10d  [%3.02f%%]" % (self.downloaded, percent)
+    print(status, end='\r')
+
+  def finish(self):
+    if TTY_OUTPUT:
+      if self.file_size:
+        self.draw_status()
+      return
+    if self.deferred:
+      shown = self.progress_max
+      if self.file_size:
+        shown = min(shown, self.progress_max * self.downloaded // self.file_size)
+      print(' [' + '-' * shown + ']')
+    else:
+      print(']')
+    sys.stdout.flush()
+
+
+class DownloadScheduler:
+  """Decides when data may be transferred, for all the downloads made by this
+  process.
+
+  At most `max_connections` transfers run at the same time.  When more are
+  waiting, the ones for the largest files go first, since they take longest to
+  finish.  The bandwidth used is capped at `rate` bytes per second for this
+  process, and at `host_rate` for all emsdk processes on the machine together.
+  The latter is shared out evenly between the processes that are currently
+  downloading, which each mark themselves as active with a file in a common
+  temporary directory.
+  """
+
+  def __init__(self, max_connections, rate=None, host_rate=None):
+    self.max_connections = max(max_connections, 1)
+    self.rate = rate
+    self.host_rate = host_rate
+    self.active = 0
+    self.waiting = []
+    self.tickets = 0
+    self.cond = threading.Condition()
+    # Guards the token bucket for the bandwidth caps, and the count of
+    # downloading processes.
+    self.lock = threading.Lock()
+    self.allowance = 0
+    self.last_update = time.monotonic()
+    self.host_dir = os.path.join(tempfile.gettempdir(), 'emsdk-downloads')
+    self.host_processes = 1
+    self.last_host_check = 0
+
+  def busy(self):
+    """Returns True if a new transfer would have to wait for a connection."""
+    with self.cond:
+      return self.active >= self.max_connections or bool(self.waiting)
+
+  @contextlib.contextmanager
+  def slot(self, size):
+    """Waits for a free connection for transferring a file of `size` bytes,
+    and holds it for the duration of the `with` block.  The connection should
+    only be opened once the slot has been taken.  The block is given a function
+    that gives the slot back early, e.g. before waiting for other transfers that
+    need one.
+    """
+    with self.cond:
+      self.tickets += 1
+      ticket = (-(size or 0), self.tickets)
+      heapq.heappush(self.waiting, ticket)
+      try:
+        while self.active >= self.max_connections or self.waiting[0] != ticket:
+          if downloads_cancelled.is_set():
+            raise Exception('download aborted')
+          self.cond.wait(1)
+      finally:
+        self.waiting.remove(ticket)
+        heapq.heapify(self.waiting)
+        self.cond.notify_all()
+      self.active += 1
+    released = False
+
+    def release():
+      nonlocal released
+      if not released:
+        released = True
+        with self.cond:
+          self.active -= 1
+          self.cond.notify_all()
+
+    try:
+      yield release
+    finally:
+      release()
+
+  def current_rate(self):
+    rate = self.rate
+    if self.host_rate:
+      # Every segment thread gets here, but only one of them recounts the
+      # processes, while the others wait for its result.
+      with self.lock:
+        now = time.monotonic()
+        if now - self.last_host_check > 1:
+          self.last_host_check = now
+          self.host_processes = self.count_host_processes()
+        share = self.host_rate // self.host_processes
+      rate = min(rate, share) if rate else share
+    return rate
+
+  def count_host_processes(self):
+    """Marks this process as downloading, and returns how many emsdk processes
+    on this machine are currently downloading.
+    """
+    try:
+      if not os.path.isdir(self.host_dir):
+        os.makedirs(self.host_dir, exist_ok=True)
+        os.chmod(self.host_dir, 0o1777)
+      marker = os.path.join(self.host_dir, str(os.getpid()))
+      with open(marker, 'w'):
+        pass
+      now = time.time()
+      count = 0
+      for name in os.listdir(self.host_dir):
+        age = now - os.path.getmtime(os.path.join(self.host_dir, name))
+        if age < 3:
+          count += 1
+        elif age > 60:
+          rmfile(os.path.join(self.host_dir, name))
+      return max(count, 1)
+    except OSError as e:
+      debug_print(f'failed to count downloading processes: {e}')
+      return 1
+
+  def throttle(self, num_bytes):
+    """Called after `num_bytes` have been received.  Sleeps as long as needed to
+    stay within the bandwidth caps.
+    """
+    rate = self.current_rate()
+    if not rate:
+      return
+    with self.lock:
+      now = time.monotonic()
+      # Allow bursts of up to a second's worth of data.
+      self.allowance = min(rate, self.allowance + (now - self.last_update) * rate) - num_bytes
+      self.last_update = now
+      delay = -self.allowance / rate
+    if delay > 0:
+      time.sleep(delay)
+
+
+def get_download_scheduler():
+  if not hasattr(get_download_scheduler, 'scheduler'):
+    get_download_scheduler.scheduler = DownloadScheduler(
+      DOWNLOAD_CONNECTIONS,
+      parse_size(DOWNLOAD_RATE) if DOWNLOAD_RATE else None,
+      parse_size(DOWNLOAD_HOST_RATE) if DOWNLOAD_HOST_RATE else None)
+  return get_download_scheduler.scheduler
+
+
+def download_queue_size(url):
+  """Returns the size to queue a new download of `url` under (see
+  DownloadScheduler.slot()).  It is only known once the server has been asked,
+  so if the download has to wait for a connection, a HEAD request finds out,
+  rather than holding a response open while the download is queued.
+  """
+  if not get_download_scheduler().busy():
+    return None
+  try:
+    with open_url(url, method='HEAD', timeout=10) as u:
+      return get_content_length(u) or None
+  except Exception as e:
+    debug_print(f'failed to get the size of {url}: {e}')
+    return None
+
+
+def copy_response(response, f, progress, journal, offset=0, length=None, abort=None):
+  """Copies the body of an HTTP response into the file object `f`, which must
+  already be positioned at `offset`.  If `length` is given, stop after that many
+  bytes.  Each chunk is recorded in the journal once it has been flushed to the
+  file.
+
+  The data is read into one buffer that is reused for every chunk.  The chunk
+  size adapts to the throughput: it grows while chunks arrive quickly, so that
+  fast links aren't held back by the per-chunk overhead, and shrinks when they
+  are slow, so that progress and cancellation are still checked regularly.
+  """
+  buffer = memoryview(bytearray(DOWNLOAD_MAX_BLOCK_SIZE))
+  block_sz = DOWNLOAD_MIN_BLOCK_SIZE
+  scheduler = get_download_scheduler()
+  while length is None or length > 0:
+    if downloads_cancelled.is_set() or (abort and abort.is_set()):
+      raise Exception('download aborted')
+    start = time.monotonic()
+    n = response.readinto(buffer[:block_sz if length is None else min(block_sz, length)])
+    if not n:
+      break
+    elapsed = time.monotonic() - start
+    chunk = buffer[:n]
+    f.write(chunk)
+    f.flush()
+    journal.add_data(offset, chunk)
+    offset += n
+    progress.update(n)
+    scheduler.throttle(n)
+    if length is not None:
+      length -= n
+    if n == block_sz and elapsed < 0.01:
+      block_sz = min(block_sz * 2, DOWNLOAD_MAX_BLOCK_SIZE)
+    elif elapsed > 0.25:
+      block_sz = max(block_sz // 2, DOWNLOAD_MIN_BLOCK_SIZE)
+
+  if length:
+    raise Exception(f'connection closed with {length} bytes still to go')
+
+
+def supports_range_requests(response):
+  return response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+
+def get_content_range_length(response):
+  """Returns the total file length from the Content-Range header of a 206
+  response, or None if it is not known.
+  """
+  content_range = response.headers.get('Content-Range', '')
+  if '/' not in content_range:
+    return None
+  try:
+    return int(content_range.split('/')[-1])
+  except ValueError:
+    return None
+
+
+def split_into_segments(ranges, num_segments):
+  """Splits the given list of (start, end) byte ranges (end exclusive) into
+  at least `num_segments` pieces, by repeatedly cutting the largest range in
+  half.  Ranges smaller than 1 MiB are not split any further.
+  """
+  segments = sorted(ranges)
+  while len(segments) < num_segments:
+    largest = max(segments, key=lambda r: r[1] - r[0])
+    start, end = largest
+    if end - start < 2 * 1024 * 1024:
+      break
+    middle = start + (end - start) // 2
+    i = segments.index(largest)
+    segments[i:i + 1] = [(start, middle), (middle, end)]
+  return segments
+
+
+def download_segment(url, journal, start, end, progress, abort):
+  debug_print(f'download_segment({url}, bytes={start}-{end - 1})')
+  headers = {'Range': f'bytes={start}-{end - 1}'}
+  if journal.etag:
+    headers['If-Range'] = journal.etag
+  with get_download_scheduler().slot(journal.length), open_url(url, headers=headers) as u:
+    content_range = u.headers.get('Content-Range', '')
+    if u.status != 206 or not content_range.startswith(f'bytes {start}-'):
+      raise Exception(f'server ignored range request for bytes {start}-{end - 1} (status {u.status})')
+    with open(DownloadJournal.part_path(journal.file_name), 'r+b') as f:
+      f.seek(start)
+      copy_response(u, f, progress, journal, offset=start, length=end - start, abort=abort)
+
+
+def download_segments(u, journal, progress, release_slot):
+  """Downloads all the byte ranges of a file that are still missing, using up
+  to DOWNLOAD_SEGMENTS parallel connections.  `u` is an already open response
+  whose body starts at the beginning of the first missing range.  It is used to
+  fetch the first segment on this thread, so that the initial request is not
+  wasted, in the connection slot that the caller holds for it.  That slot is
+  given back with `release_slot` once the first segment is done.
+  """
+  # Requests for the remaining segments go straight to the final URL, after any
+  # redirects.
+  url = u.geturl()
+  ranges = journal.missing_ranges()
+  if journal.length >= DOWNLOAD_SEGMENT_MIN_SIZE:
+    segments = split_into_segments(ranges, DOWNLOAD_SEGMENTS)
+  else:
+    segments = ranges
+  debug_print(f'downloading {journal.file_name} in {len(segments)} segments')
+
+  abort = threading.Event()
+
+  with thread_pool(max_workers=max(DOWNLOAD_SEGMENTS - 1, 1)) as executor:
+    futures = [executor.submit(download_segment, url, journal, start, end, progress, abort)
+               for start, end in segments[1:]]
+    try:
+      try:
+        start, end = segments[0]
+        with u, open(DownloadJournal.part_path(journal.file_name), 'r+b') as f:
+          f.seek(start)
+          copy_response(u, f, progress, journal, offset=start, length=end - start, abort=abort)
+      finally:
+        # The other segments may be waiting for this slot.
+        release_slot()
+      for future in futures:
+        future.result()
+    except BaseException:
+      # Stop the other segments as soon as one of them fails (or the user
+      # interrupts us), rather than waiting for them to finish.
+      abort.set()
+      raise
+
+
+def resume_download(url, journal):
+  """Attempts to continue the download recorded in the journal.  Returns the
+  open response for the first missing byte range, or None if the file on the
+  server no longer matches the partial download.
+  """
+  start, end = journal.missing_ranges()[0]
+  headers = {'Range': f'bytes={start}-{end - 1}'}
+  if journal.etag:
+    headers['If-Range'] = journal.etag
+  u = open_url(url, headers=headers)
+  if u.status == 206 and get_content_range_length(u) == journal.length and \
+     u.headers.get('Content-Range', '').startswith(f'bytes {start}-'):
+    return u
+  debug_print(f'cannot resume download of {url} (status {u.status}), starting over')
+  u.close()
+  return None
+
+
+def download_with_urllib(url, file_name):
+  part_file = DownloadJournal.part_path(file_name)
+  journal = DownloadJournal.load(file_name)
+  if not (journal and journal.can_resume(url)):
+    journal = None
+  size = journal.length if journal else download_queue_size(url)
+
+  with get_download_scheduler().slot(size) as release_slot:
+    u = resume_download(url, journal) if journal else None
+    if u:
+      print("Resuming download: %s from %s, %s of %s Bytes already downloaded" % (file_name, url, journal.bytes_done(), journal.length))
+    else:
+      DownloadJournal.remove(file_name)
+      u = open_url(url)
+      file_size = get_content_length(u)
+      journal = DownloadJournal(file_name, url, file_size or None, u.headers.get('ETag'), supports_range_requests(u))
+      if file_size > 0:
+        print("Downloading: %s from %s, %s Bytes" % (file_name, url, file_size))
+      else:
+        print("Downloading: %s from %s" % (file_name, url))
+      # Allocate the whole file up front so that ranges can be written at their
+      # own offsets, both now and when resuming later.
+      with open(part_file, 'wb') as f:
+        if journal.length:
+          preallocate(f, journal.length)
+      journal.save()
+
+    progress = DownloadProgress(journal.length or 0, journal.bytes_done())
+    try:
+      if journal.length and journal.accept_ranges:
+        download_segments(u, journal, progress, release_slot)
+      else:
+        with u, open(part_file, 'r+b') as f:
+          copy_response(u, f, progress, journal)
+        if journal.length is None:
+          journal.length = progress.downloaded
+    finally:
+      journal.save()
+  progress.finish()
+
+  if journal.missing_ranges():
+    raise Exception(f'download incomplete, missing byte ranges {journal.missing_ranges()}')
+
+  journal.finish()
+  debug_print('finished downloading (%d bytes, sha256 %s)' % (progress.downloaded, journal.sha256))
+  return journal
+
+
+def sha256_file(filename):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    while True:
+      buffer = f.read(1024 * 1024)
+      if not buffer:
+        break
+      h.update(buffer)
+  return h.hexdigest()
+
+
+class DownloadCache:
+  """A content-addressed store of downloaded archives, shared between emsdk
+  checkouts.
+
+  The archives themselves are stored under `objects/` named by their SHA-256,
+  and `index.json` maps each download URL to the hash of its content.  Since
+  an object is only ever stored under its own digest, a download whose expected
+  SHA-256 is known can be served from the cache without hashing it again, even
+  if it was originally fetched from another URL.  The
+  index also records when each archive was last used, so that the least
+  recently used ones can be evicted when the cache exceeds its size limit, and
+  keeps a count of cache hits and misses.  All updates to the index are made
+  while holding a lock file, since several emsdk processes (possibly run by
+  different users) may use the cache at the same time.
+
+  Since other users can write to the cache, an object is only used without
+  hashing it again if its expected SHA-256 is known and it belongs to this
+  user (or root).  The object directories are sticky, so that nobody can
+  replace other users' objects.
+  """
+
+  def __init__(self, root, max_size):
+    self.root = os.path.abspath(root)
+    self.max_size = max_size
+    self.objects_dir = os.path.join(self.root, 'objects')
+    self.index_file = os.path.join(self.root, 'index.json')
+    self.lock_file = os.path.join(self.root, 'lock')
+    # Serializes access from threads within this process; the lock file only
+    # guards against other processes.
+    self.thread_lock = threading.Lock()
+
+  def make_shared(self, path, mode):
+    # The cache may be shared by all users on the machine, so don't let the
+    # umask of whoever happens to create a file lock everyone else out.
+    try:
+      os.chmod(path, mode)
+    except OSError:
+      pass
+
+  def object_path(self, sha256):
+    return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+  @staticmethod
+  def owned_by_others(path):
+    if not hasattr(os, 'getuid'):
+      return False
+    return os.stat(path).st_uid not in {0, os.getuid()}
+
+  @contextlib.contextmanager
+  def locked_index(self):
+    """Locks the cache and yields its index, which is written back to disk at
+    the end of the `with` block.
+    """
+    with self.thread_lock:
+      if not os.path.isdir(self.objects_dir):
+        mkdir_p(self.objects_dir)
+        self.make_shared(self.root, 0o777)
+        self.make_shared(self.objects_dir, 0o1777)
+      with file_lock(self.lock_file):
+        self.make_shared(self.lock_file, 0o666)
+        try:
+          index = json.loads(read_file(self.index_file))
+        except Exception:
+          index = {'urls': {}, 'objects': {}, 'stats': {'hits': 0, 'misses': 0}}
+        try:
+          yield index
+        finally:
+          tmp = self.index_file + '.tmp'
+          write_file(tmp, json.dumps(index, indent=2))
+          self.make_shared(tmp, 0o666)
+          os.replace(tmp, self.index_file)
+
+  def contains(self, url, sha256=None):
+    # The index is always replaced atomically, so it is safe to read it without
+    # taking the lock.
+    try:
+      index = json.loads(read_file(self.index_file))
+    except Exception:
+      return False
+    if sha256:
+      return sha256 in index['objects']
+    return url in index['urls']
+
+  def fetch(self, url, file_name, sha256=None):
+    """If the content of `url` is in the cache, place a copy of it at
+    `file_name` and return True.  If `sha256` is given, the cached content must
+    have that digest.
+    """
+    with self.locked_index() as index:
+      verify = not sha256
+      if not sha256:
+        sha256 = index['urls'].get(url)
+      entry = index['objects'].get(sha256)
+      obj = self.object_path(sha256) if sha256 else None
+      valid = entry and os.path.isfile(obj) and os.path.getsize(obj) == entry['size']
+      if valid and (verify or self.owned_by_others(obj)) and sha256_file(obj) != sha256:
+        errlog(f"Warning: ignoring '{obj}' in the download cache, its contents don't match its name")
+        valid = False
+      if not valid:
+        index['stats']['misses'] += 1
+        debug_print(f'download cache miss for {url} (hits: {index["stats"]["hits"]}, misses: {index["stats"]["misses"]})')
+        return False
+      entry['last_used'] = time.time()
+      index['stats']['hits'] += 1
+      debug_print(f'download cache hit for {url} (hits: {index["stats"]["hits"]}, misses: {index["stats"]["misses"]})')
+
+      # Prefer a hard link, which is instant, and fall back to copying when the
+      # cache lives on a different filesystem.  Do this while still holding the
+      # lock so that the object cannot be evicted from under us.  On Windows the
+      # read-only attribute of the object would be shared by the link, and
+      # prevent it from being deleted, so copy it there.
+      DownloadJournal.remove(file_name)
+      rmfile(file_name)
+      if WINDOWS:
+        shutil.copyfile(obj, file_name)
+      else:
+        try:
+          os.link(obj, file_name)
+        except OSError:
+          shutil.copyfile(obj, file_name)
+
+    print(f"Using cached download of '{url}' from '{self.root}'")
+    journal = DownloadJournal(file_name, url, entry['size'])
+    journal.ranges = [(0, entry['size'])]
+    journal.complete = True
+    journal.sha256 = sha256
+    journal.save()
+    return True
+
+  def store(self, url, file_name, sha256=None):
+    """Adds the downloaded file `file_name`, fetched from `url`, to the cache.
+    `sha256` is the digest of the file, if it is already known.
+    """
+    size = os.path.getsize(file_name)
+    if size > self.max_size:
+      debug_print(f'not caching {file_name}: larger than the download cache size limit')
+      return
+    if not sha256:
+      sha256 = sha256_file(file_name)
+    obj = self.object_path(sha256)
+    with self.locked_index() as index:
+      if not os.path.isfile(obj):
+        obj_dir = os.path.dirname(obj)
+        if not os.path.isdir(obj_dir):
+          mkdir_p(obj_dir)
+          self.make_shared(obj_dir, 0o1777)
+        tmp = f'{obj}.{os.getpid()}.tmp'
+        shutil.copyfile(file_name, tmp)
+        # Cached archives are never modified in place.
+        self.make_shared(tmp, 0o444)
+        os.replace(tmp, obj)
+      index['urls'][url] = sha256
+      index['objects'][sha256] = {'size': size, 'last_used': time.time()}
+      self.evict(index)
+
+  def evict(self, index):
+    """Removes the least recently used objects until the cache fits within its
+    size limit.  Must be called with the index locked.
+    """
+    objects = index['objects']
+    total = sum(entry['size'] for entry in objects.values())
+    for sha256 in sorted(objects, key=lambda k: objects[k]['last_used']):
+      if total <= self.max_size:
+        break
+      debug_print(f'evicting {sha256} from the download cache')
+      try:
+        rmfile(self.object_path(sha256))
+      except OSError as e:
+        # Objects of other users can't be removed from the sticky directories.
+        debug_print(f'cannot remove {sha256} from the download cache: {e}')
+      total -= objects.pop(sha256)['size']
+    index['urls'] = {url: sha256 for url, sha256 in index['urls'].items() if sha256 in objects}
+
+
+def get_download_cache():
+  if not DOWNLOAD_CACHE_DIR:
+    return None
+  if not hasattr(get_download_cache, 'cache'):
+    get_download_cache.cache = DownloadCache(DOWNLOAD_CACHE_DIR, parse_size(DOWNLOAD_CACHE_SIZE))
+  return get_download_cache.cache
+
+
+# ioctl that makes a file share the data blocks of another one (copy-on-write)
+# on Linux filesystems that support it, such as btrfs and xfs.
+FICLONE = 0x40049409
 
-  # Treat all relative destination paths as relative to the SDK root directory,
-  # not the current working directory.
-  file_name = sdk_path(file_name)
 
-  return file_name
+def reflink_file(src, dst):
+  import fcntl
+  with open(src, 'rb') as f:
+    fd = open_for_write(dst, 0o600)
+    try:
+      fcntl.ioctl(fd, FICLONE, f.fileno())
+    except OSError:
+      os.close(fd)
+      os.unlink(dst)
+      raise
+    os.close(fd)
+
+
+# The files of installed trees that the toolchain writes to later on: emcc
+# (re)builds the system libraries in its cache directory.  These must not be
+# hard links (see clone_file()), which would make them read-only, and share
+# whatever is written to them with every other copy.
+TOOLCHAIN_WRITTEN_PATHS = ('emscripten/cache/',)
+
+
+def clone_methods():
+  """Returns the ways in which clone_file() may copy files on this system, in
+  order of preference."""
+  return ['reflink', 'link', 'copy'] if LINUX else ['link', 'copy']
+
+
+def clone_file(src, dst, mode, methods):
+  """Copies the file `src` to the new file `dst` with the given mode, as
+  cheaply as the filesystem allows: as a copy-on-write reflink where that is
+  supported, otherwise as a hard link, and otherwise as an actual copy.  A hard
+  link shares its inode with `src`, so it gets `mode` without the write
+  permissions, to protect `src` from changes made through `dst`.  Files that
+  are written to after they are installed (TOOLCHAIN_WRITTEN_PATHS) must
+  therefore be cloned without 'link'.
+
+  `methods` is a list from clone_methods(), from which the methods that turn
+  out not to work between the two directories are removed.  Returns the method
+  that was used.
+  """
+  for method in list(methods):
+    try:
+      if method == 'reflink':
+        reflink_file(src, dst)
+      elif method == 'link':
+        os.link(src, dst)
+        os.chmod(dst, mode & ~0o222)
+        return method
+      else:
+        shutil.copyfile(src, dst)
+    except OSError as e:
+      if method == 'copy':
+        raise
+      # A single file can fail to be linked (e.g. because it has too many
+      # links already), but anything else means that this method doesn't
+      # work here at all.
+      if e.errno != errno.EMLINK:
+        debug_print(f"cannot {method} '{src}' to '{dst}' ({e}), not trying that again")
+        with contextlib.suppress(ValueError):
+          methods.remove(method)
+      continue
+    st = os.stat(src)
+    os.chmod(dst, mode)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return method
+
+
+def clone_tree(manifest, dest_dir, src_root=None, mode_mask=0o7777):
+  """Copies the files and links of `manifest` (an InstallManifest) from
+  `src_root` (by default the manifest's own root) into the new directory
+  `dest_dir`, with clone_file().  Empty directories are copied too.  The files
+  get the modes recorded in the manifest, masked with `mode_mask`, except that
+  hard links are read-only.  The files in TOOLCHAIN_WRITTEN_PATHS are never
+  hard linked.  Returns the number of files that were copied with each method.
+  """
+  src_root = src_root or manifest.root
+  for dirpath, dirnames, _ in os.walk(src_root):
+    for name in dirnames:
+      if not os.path.islink(os.path.join(dirpath, name)):
+        os.makedirs(os.path.join(dest_dir, os.path.relpath(os.path.join(dirpath, name), src_root)), exist_ok=True)
+  mkdir_p(dest_dir)
+  methods = clone_methods()
+  unlinked_methods = [method for method in methods if method != 'link']
+
+  def clone(item):
+    relpath, entry = item
+    parts = relpath.split('/')
+    return clone_file(os.path.join(src_root, *parts), os.path.join(dest_dir, *parts), entry[1] & mode_mask,
+                      unlinked_methods if relpath.startswith(TOOLCHAIN_WRITTEN_PATHS) else methods)
+
+  counts = {}
+  with thread_pool(max(EXTRACT_JOBS, 1)) as executor:
+    for method in executor.map(clone, manifest.files.items()):
+      counts[method] = counts.get(method, 0) + 1
+  for relpath, target in manifest.links.items():
+    os.symlink(target, os.path.join(dest_dir, *relpath.split('/')))
+  return counts
+
+
+def dedupe_files(manifests, dry_run=False):
+  """Replaces the files in the given install manifests that have the same
+  contents (e.g. the headers and JS libraries that consecutive releases share)
+  with reflinks or hard links to a single copy of them, see clone_file().
+  Files that were modified since they were installed are left alone.  Returns
+  the number of files that were replaced, and the number of bytes that this
+  freed.  With `dry_run`, only reports what would be done.
+  """
+  # Hard links share their mode, so only files with the same permissions (other
+  # than write permissions, which clone_file() removes anyway) are linked.
+  groups = {}
+  for manifest in manifests:
+    for relpath, (size, mode, sha256, _mtime) in manifest.files.items():
+      if size and not relpath.startswith(TOOLCHAIN_WRITTEN_PATHS):
+        groups.setdefault((sha256, size, mode & ~0o222), []).append((manifest, relpath))
+
+  methods = [method for method in clone_methods() if method != 'copy']
+  replaced = 0
+  reclaimed = 0
+  touched = []
+  for (_sha256, size, _mode), members in groups.items():
+    if len(members) < 2:
+      continue
+    canonical = None
+    for manifest, relpath in members:
+      path = manifest.path(relpath)
+      entry = manifest.files[relpath]
+      try:
+        st = os.lstat(path)
+      except OSError:
+        continue
+      if not stat.S_ISREG(st.st_mode) or st.st_size != entry[0] or st.st_mtime_ns != entry[3]:
+        debug_print(f"not deduplicating '{path}': modified since it was installed")
+        continue
+      if not canonical:
+        canonical = (manifest, relpath, path, st)
+        continue
+      if (st.st_dev, st.st_ino) == (canonical[3].st_dev, canonical[3].st_ino) or st.st_dev != canonical[3].st_dev:
+        continue
+      if not dry_run:
+        # Put the copy next to the file first, so that the file is replaced
+        # atomically.
+        tmp = f'{path}.emsdk-dedupe'
+        try:
+          method = clone_file(canonical[2], tmp, entry[1], methods)
+          if not method:
+            break
+          os.replace(tmp, path)
+        except OSError as e:
+          debug_print(f"cannot deduplicate '{path}': {e}")
+          rmfile(tmp)
+          continue
+        touched += [(manifest, relpath), canonical[:2]]
+      replaced += 1
+      if st.st_nlink == 1:
+        reclaimed += size
+
+  for manifest, relpath in touched:
+    path = manifest.path(relpath)
+    manifest.record_file(path, os.lstat(path), manifest.files[relpath][2])
+  for manifest in {manifest for manifest, _ in touched}:
+    manifest.save()
+  return replaced, reclaimed
+
+
+class TreeCache:
+  """A store of the trees that were extracted from release archives, so that
+  a tool that was installed before (e.g. when switching back to a previous
+  release) can be installed again without downloading or extracting anything.
+
+  Each tree lives in `trees/`, named by the SHA-256 of the archive it was
+  extracted from (and the install profile, if it wasn't 'full'), together with
+  its InstallManifest.  `index.json` maps archive URLs to their digests, and
+  records the size of each tree and when it was last used, so that the least
+  recently used trees can be evicted when the cache exceeds its size limit.
+
+  Trees are copied in and out with clone_tree(), so where the filesystem
+  supports it they share their data with the installed tools.  The files in
+  the cache are read-only and never modified in place; files that are installed
+  as hard links into the cache are read-only too, and are recorded as such in
+  the install manifest (so that `emsdk verify` doesn't report their mode).  The
+  files that the toolchain writes to (TOOLCHAIN_WRITTEN_PATHS) are installed as
+  reflinks or copies instead, and stay writable.
+  """
+
+  def __init__(self, root, max_size):
+    self.root = os.path.abspath(root)
+    self.max_size = max_size
+    self.trees_dir = os.path.join(self.root, 'trees')
+    self.index_file = os.path.join(self.root, 'index.json')
+    self.lock_file = os.path.join(self.root, 'lock')
+    # Serializes access from threads within this process; the lock file only
+    # guards against other processes.
+    self.thread_lock = threading.Lock()
+
+  @staticmethod
+  def tree_key(digest, profile):
+    return digest if profile == 'full' else f'{digest}-{profile}'
+
+  def tree_dir(self, key):
+    return os.path.join(self.trees_dir, key)
+
+  @contextlib.contextmanager
+  def locked_index(self):
+    """Locks the cache and yields its index, which is written back to disk at
+    the end of the `with` block.
+    """
+    with self.thread_lock:
+      mkdir_p(self.trees_dir)
+      with file_lock(self.lock_file):
+        try:
+          index = json.loads(read_file(self.index_file))
+        except Exception:
+          index = {'urls': {}, 'trees': {}}
+        try:
+          yield index
+        finally:
+          tmp = self.index_file + '.tmp'
+          write_file(tmp, json.dumps(index, indent=2))
+          os.replace(tmp, self.index_file)
+
+  def install(self, url, manifest):
+    """If the tree extracted from the archive at `url` with the install
+    profile of `manifest` is in the cache, replaces `manifest.root` with a copy
+    of it, fills in `manifest` and returns True.
+    """
+    with self.locked_index() as index:
+      digest = index['urls'].get(url)
+      key = self.tree_key(digest, manifest.profile) if digest else None
+      cached = InstallManifest.load(self.tree_dir(key)) if key in index['trees'] else None
+      if not cached:
+        debug_print(f'tree cache miss for {url}')
+        return False
+      index['trees'][key]['last_used'] = time.time()
+
+      # Copy the tree while still holding the lock, so that it cannot be
+      # evicted from under us.
+      print(f"Installing '{url}' from the extracted tree cache in '{self.root}'")
+      discard_tree(manifest.root)
+      counts = clone_tree(cached, manifest.root)
+    debug_print(f'copied tree {key} from the cache: {counts}')
+    manifest.archive = cached.archive
+    manifest.files = cached.files
+    manifest.links = cached.links
+    return True
 
+  def store(self, url, digest, manifest):
+    """Adds the installed tree of `manifest`, which was extracted from the
+    archive at `url` with the given SHA-256, to the cache.
+    """
+    size = sum(entry[0] for entry in manifest.files.values())
+    if size > self.max_size:
+      debug_print(f'not caching {manifest.root}: larger than the tree cache size limit')
+      return
+    key = self.tree_key(digest, manifest.profile)
+    tree = self.tree_dir(key)
+    with self.locked_index() as index:
+      if key not in index['trees'] or not os.path.isdir(tree):
+        debug_print(f'adding {manifest.root} to the tree cache as {key}')
+        remove_tree(tree)
+        tmp = f'{tree}.{os.getpid()}.tmp'
+        remove_tree(tmp)
+        clone_tree(manifest, tmp, mode_mask=~0o222)
+        cached = InstallManifest(tmp, manifest.archive, manifest.profile)
+        cached.files = manifest.files
+        cached.links = manifest.links
+        cached.save()
+        os.rename(tmp, tree)
+      index['urls'][url] = digest
+      index['trees'][key] = {'size': size, 'last_used': time.time()}
+      self.evict(index)
+
+  def evict(self, index):
+    """Removes the least recently used trees until the cache fits within its
+    size limit.  Must be called with the index locked.
+    """
+    trees = index['trees']
+    total = sum(entry['size'] for entry in trees.values())
+    for key in sorted(trees, key=lambda k: trees[k]['last_used']):
+      if total <= self.max_size:
+        break
+      debug_print(f'evicting {key} from the tree cache')
+      remove_tree(self.tree_dir(key))
+      total -= trees.pop(key)['size']
+    digests = {key.split('-')[0] for key in trees}
+    index['urls'] = {url: digest for url, digest in index['urls'].items() if digest in digests}
 
-def download_with_curl(url, file_name):
-  print("Downloading: %s from %s" % (file_name, url))
-  if not shutil.which('curl'):
-    exit_with_error('curl not found in PATH')
-  # -#: show progress bar
-  # -L: Follow HTTP 3XX redirections
-  # -f: Fail on HTTP errors
-  subprocess.check_call(['curl', '-#', '-f', '-L', '-o', file_name, url])
 
+def get_tree_cache():
+  if not TREE_CACHE_DIR:
+    return None
+  if not hasattr(get_tree_cache, 'cache'):
+    get_tree_cache.cache = TreeCache(TREE_CACHE_DIR, parse_size(TREE_CACHE_SIZE))
+  return get_tree_cache.cache
 
-def download_with_urllib(url, file_name):
-  u = urlopen(url)
-  file_size = get_content_length(u)
-  if file_size > 0:
-    print("Downloading: %s from %s, %s Bytes" % (file_name, url, file_size))
-  else:
-    print("Downloading: %s from %s" % (file_name, url))
 
-  file_size_dl = 0
-  # Draw a progress bar 80 chars wide (in non-TTY mode)
-  progress_max = 80 - 4
-  progress_shown = 0
-  block_sz = 256 * 1024
-  if not TTY_OUTPUT:
-      print(' [', end='')
+class DownloadStream:
+  """A file-like wrapper around an HTTP response that reports progress, and
+  optionally tees everything that is read into a (journaled) partial download,
+  so that the data can be kept once the stream has been consumed.
+  """
 
-  with open(file_name, 'wb') as f:
-    while True:
-        buffer = u.read(block_sz)
-        if not buffer:
-            break
+  def __init__(self, response, progress, journal=None):
+    self.response = response
+    self.progress = progress
+    self.journal = journal
+    self.hasher = journal.hasher if journal else DownloadHasher(None)
+    self.sink = None
+    if journal:
+      # Allocate the whole file, like download_with_urllib() does, so that a
+      # regular download can resume from where the stream stopped.
+      self.sink = open(DownloadJournal.part_path(journal.file_name), 'wb')
+      if journal.length:
+        preallocate(self.sink, journal.length)
+      journal.save()
+    self.offset = 0
+
+  def read(self, size=-1):
+    if downloads_cancelled.is_set():
+      raise Exception('download aborted')
+    data = self.response.read(size)
+    if self.sink and data:
+      self.sink.write(data)
+      self.sink.flush()
+      self.journal.add_data(self.offset, data)
+    elif data:
+      self.hasher.update(self.offset, data)
+    self.offset += len(data)
+    self.progress.update(len(data))
+    get_download_scheduler().throttle(len(data))
+    return data
+
+  def close(self):
+    self.response.close()
+    if self.sink:
+      self.sink.close()
+      self.journal.save()
+
+
+def stream_download_and_extract(url, dest_dir, file_name, clobber, sha256=None, manifest=None, member_filter=None):
+  """Downloads a tar archive and extracts it at the same time, without waiting
+  for the whole archive to be written to disk first.  If the downloaded archive
+  needs to be kept (in the download cache, or because of EMSDK_KEEP_DOWNLOADS)
+  it is written to `file_name` as it is streamed.  If `sha256` is given and the
+  archive turns out not to match it, the extracted files are removed again and
+  an exception is raised.
+
+  Returns True on success.  Returns False, without touching dest_dir, if the
+  download could not be started, in which case the caller should fall back to
+  a regular download.
+
+  The archive is streamed from the fastest mirror only.  Failing over to the
+  other mirrors is left to the regular download that the caller falls back to.
+  """
+  source_url = get_mirror_urls(url)[0]
+  with get_download_scheduler().slot(download_queue_size(source_url)):
+    try:
+      u = open_url(source_url)
+    except Exception as e:
+      debug_print(f'failed to open {source_url} for streaming: {e}')
+      return False
 
-        file_size_dl += len(buffer)
-        f.write(buffer)
-        if file_size:
-            percent = file_size_dl * 100.0 / file_size
-            if TTY_OUTPUT:
-                status = r" %10d  [%3.02f%%]" % (file_size_dl, percent)
-                print(status, end='\r')
-            else:
-                while progress_shown < progress_max * percent / 100:
-                    print('-', end='')
-                    sys.stdout.flush()
-                    progress_shown += 1
-
-  if not TTY_OUTPUT:
-    print(']')
-    sys.stdout.flush()
+    file_size = get_content_length(u)
+    print("Downloading and unpacking: %s to '%s'%s" % (source_url, dest_dir, ', %s Bytes' % file_size if file_size else ''))
+    cache = get_download_cache()
+    journal = None
+    if cache or KEEP_DOWNLOADS:
+      mkdir_p(os.path.dirname(file_name))
+      DownloadJournal.remove(file_name)
+      journal = DownloadJournal(file_name, source_url, file_size or None, u.headers.get('ETag'), supports_range_requests(u))
+
+    if clobber:
+      discard_tree(dest_dir)
+
+    progress = DownloadProgress(file_size)
+    stream = DownloadStream(u, progress, journal)
+    try:
+      extract_tar_stream(stream, dest_dir, url, manifest, member_filter)
+      # Drain any trailing padding after the end-of-archive marker, so that the
+      # kept copy of the archive is complete.
+      while stream.read(256 * 1024):
+        pass
+    finally:
+      stream.close()
+  progress.finish()
 
-  debug_print('finished downloading (%d bytes)' % file_size_dl)
+  digest = stream.hasher.hexdigest()
+  if sha256 and digest != sha256:
+    remove_tree(dest_dir)
+    DownloadJournal.remove(file_name)
+    raise Exception(f'SHA-256 mismatch (expected {sha256}, got {digest})')
+
+  if journal:
+    if journal.length is None:
+      journal.length = stream.offset
+    journal.finish()
+    if cache:
+      cache.store(url, file_name, journal.sha256)
+  return True
 
 
-def download_file(url, dstpath, filename_prefix=''):
+def download_file(url, dstpath, filename_prefix='', sha256=None):
   """On success, returns the filename on the disk pointing to the destination file that was produced
   On failure, returns None.
+
+  If `sha256` is given, the downloaded file must match it.
+
+  Release archives are fetched from the mirrors in EMSDK_MIRRORS, moving on to
+  the next mirror if one fails, stalls or serves a file with the wrong digest.
+
+  Interrupted downloads leave behind a partial file and a journal, which are
+  used to resume the download the next time the same file is requested.
   """
-  debug_print(f'download_file(url={url}, dstpath={dstpath})')
+  debug_print(f'download_file(url={url}, dstpath={dstpath}, sha256={sha256})')
   file_name = get_download_target(url, dstpath, filename_prefix)
 
-  if KEEP_DOWNLOADS and os.path.exists(file_name):
+  # Complete downloads are only left behind with EMSDK_KEEP_DOWNLOADS, or by
+  # `emsdk fetch`.
+  if is_download_complete(file_name, sha256):
     print(f"File '{file_name}' already downloaded, skipping.")
     return file_name
 
   mkdir_p(os.path.dirname(file_name))
 
-  try:
-    # Use curl on macOS or when EMSDK_USE_CURL is set to avoid
-    # CERTIFICATE_VERIFY_FAILED issue with python's urllib:
-    # https://stackoverflow.com/questions/40684543/how-to-make-python-use-ca-certificates-from-mac-os-truststore
-    # Unlike on linux or windows, curl is always available on macOS systems.
-    if MACOS or 'EMSDK_USE_CURL' in os.environ:
-      download_with_curl(url, file_name)
-    else:
-      download_with_urllib(url, file_name)
-  except Exception as e:
-    errlog(f"Error: Downloading URL '{url}': {e}")
+  cache = get_download_cache()
+  if cache and cache.fetch(url, file_name, sha256):
+    return file_name
+
+  for source_url in get_mirror_urls(url):
+    if downloads_cancelled.is_set():
+      return None
+    try:
+      # Use curl on macOS or when EMSDK_USE_CURL is set to avoid
+      # CERTIFICATE_VERIFY_FAILED issue with python's urllib:
+      # https://stackoverflow.com/questions/40684543/how-to-make-python-use-ca-certificates-from-mac-os-truststore
+      # Unlike on linux or windows, curl is always available on macOS systems.
+      if MACOS or 'EMSDK_USE_CURL' in os.environ:
+        journal = download_with_curl(source_url, file_name)
+      else:
+        journal = download_with_urllib(source_url, file_name)
+    except Exception as e:
+      errlog(f"Error: Downloading URL '{source_url}': {e}")
+      continue
+
+    if sha256 and journal.sha256 != sha256:
+      errlog(f"Error: Downloading URL '{source_url}': SHA-256 mismatch (expected {sha256}, got {journal.sha256})")
+      DownloadJournal.remove(file_name)
+      rmfile(file_name)
+      continue
+    break
+  else:
     return None
-  except KeyboardInterrupt:
-    rmfile(file_name)
-    raise
+
+  if cache:
+    try:
+      cache.store(url, file_name, journal.sha256)
+    except OSError as e:
+      errlog(f"Warning: failed to add '{file_name}' to the download cache: {e}")
 
   return file_name
 
@@ -1440,11 +3969,14 @@ def emscripten_npm_setup(directory):
   return True
 
 
-def sdk_post_install():
+def sdk_post_install(sdk):
   """Older versions of the sdk did not include the node_modules directory
   and require `npm ci` to be run post-install
   """
   emscripten_dir = os.path.join(EMSDK_PATH, 'upstream', 'emscripten')
+  for tool in sdk.dependencies():
+    if tool.in_release_store():
+      emscripten_dir = os.path.join(tool.installation_path(), 'emscripten')
   if os.path.exists(os.path.join(emscripten_dir, 'node_modules')):
     return True
 
@@ -1523,43 +4055,228 @@ def build_binaryen_tool(tool):
   return success
 
 
-def download_and_extract(archive, dest_dir, filename_prefix='', clobber=True):
-  debug_print(f'download_and_extract(archive={archive}, dest_dir={dest_dir})')
+def measure_decode_speeds():
+  """Measures how fast this host decompresses the formats that release
+  archives can be offered in, in MB/s.  This takes a moment, so the result is
+  remembered in downloads/decode-benchmark.json.
+  """
+  decoder = find_zstd_decoder()
+  xz_decoder = find_external_decompressor('.tar.xz')
+  host = f'{platform.machine()} {os.cpu_count()} cpus, python {platform.python_version()}, zstd: {decoder}, xz: {xz_decoder}'
+  benchmark_file = sdk_path(download_dir + 'decode-benchmark.json')
+  try:
+    benchmark = json.loads(read_file(benchmark_file))
+    if benchmark['host'] == host:
+      return benchmark['speeds']
+  except Exception:
+    pass
+
+  import lzma
+  # Something that compresses about as well as the binaries in the archives.
+  rng = random.Random(0)
+  words = [rng.randbytes(rng.randint(1, 16)) for _ in range(4096)]
+  sample = b''.join(rng.choices(words, k=512 * 1024))[:4 * 1024 * 1024]
+
+  if decoder == 'compression.zstd':
+    from compression import zstd
+    zst = zstd.compress(sample)
+  elif decoder == 'zstandard':
+    import zstandard
+    zst = zstandard.ZstdCompressor().compress(sample)
+  else:
+    zst = subprocess.run(['zstd', '-c', '-q'], input=sample, stdout=subprocess.PIPE, check=True).stdout
+
+  def open_xz(f):
+    return DecompressorPipe(xz_decoder, f) if xz_decoder else lzma.LZMAFile(f)
+
+  # How hard the data was compressed hardly affects how fast it decompresses,
+  # so compress it quickly.
+  compressed = {'tar.xz': (lzma.compress(sample, preset=0), open_xz),
+                'tar.zst': (zst, lambda f: open_decompressed(f, '.zst'))}
+
+  speeds = {}
+  for fmt, (data, open_stream) in compressed.items():
+    best = float('inf')
+    for _ in range(3):
+      start = time.time()
+      with contextlib.closing(open_stream(io.BytesIO(data))) as f:
+        while f.read(1024 * 1024):
+          pass
+      best = min(best, time.time() - start)
+    speeds[fmt] = round(len(sample) / max(best, 1e-6) / 1e6, 1)
+  debug_print(f'decode speeds: {speeds}')
+  mkdir_p(os.path.dirname(benchmark_file))
+  write_file(benchmark_file, json.dumps({'host': host, 'speeds': speeds}, indent=2))
+  return speeds
+
+
+def archive_formats():
+  """Returns the formats to look for release archives in, in order of
+  preference.  Upstream publishes .tar.xz archives (and .tbz2 ones for older
+  releases), but mirrors may also offer .tar.zst versions, which are usually
+  a lot faster to decompress.  Those are preferred if they decode faster on
+  this host, but only when the release metadata or EMSDK_MIRROR_CHECKSUMS list
+  digests for them (see probe_archive_url()).
+  """
+  formats = ['tar.xz']
+  checksums = release_checksums()
+  if MIRRORS and any(name.endswith('.tar.zst') for name in checksums) and find_zstd_decoder():
+    with archive_probes_lock:
+      speeds = measure_decode_speeds()
+    formats.append('tar.zst')
+    formats.sort(key=lambda fmt: speeds.get(fmt, 0), reverse=True)
+  return [*formats, 'tbz2']
+
+
+def probe_archive_url(url):
+  """Release binaries were published as .tbz2 before switching to .tar.xz, and
+  nothing in the version tells us which one a given release has.  Mirrors may
+  also have .tar.zst versions of them.  Find out what is available by sending
+  HEAD requests, and return the URL of the preferred archive that exists (see
+  archive_formats()).  Whether an archive exists never changes, so that is
+  remembered in downloads/archive-formats.json.
+
+  A .tar.zst archive is only ever taken when its digest is known, since
+  upstream does not publish them and the mirror could serve anything.
+  """
+  base_url = url[:-len('.tar.xz')]
+  key = base_url
+  if key.startswith(emscripten_releases_builds_url):
+    key = key[len(emscripten_releases_builds_url):]
+  memo_file = sdk_path(download_dir + 'archive-formats.json')
+  try:
+    memo = json.loads(read_file(memo_file))
+  except Exception:
+    memo = {}
+  available = memo.get(key, {})
+  if isinstance(available, str):
+    # Older versions only recorded the format that was found.
+    available = {available: True}
+
+  found = None
+  probed = {}
+  for fmt in archive_formats():
+    candidate = f'{base_url}.{fmt}'
+    if get_expected_sha256(candidate):
+      # Only archives that exist have a digest in the release metadata.
+      found = candidate
+      break
+    if fmt == 'tar.zst':
+      continue
+    if fmt not in available:
+      try:
+        with open_url(get_mirror_urls(candidate)[0], method='HEAD', timeout=10):
+          probed[fmt] = True
+      except HTTPError:
+        probed[fmt] = False
+      except Exception as e:
+        # Leave it to the download to find out.
+        debug_print(f'failed to probe {candidate}: {e}')
+        break
+    if available.get(fmt, probed.get(fmt)):
+      found = candidate
+      break
+
+  if probed:
+    debug_print(f'{key} availability: {probed}')
+    with archive_probes_lock:
+      try:
+        memo = json.loads(read_file(memo_file))
+      except Exception:
+        memo = {}
+      memo[key] = {**available, **probed}
+      mkdir_p(os.path.dirname(memo_file))
+      write_file(memo_file, json.dumps(memo, indent=2))
+  return found or url
+
+
+def prefetch_archive_url(url):
+  """Starts working out the right URL for the archive `url` in the background,
+  so that it is already known by the time the archive is downloaded.
+  """
+  if 'wasm-binaries' not in url or not url.endswith('.tar.xz'):
+    return
+  with archive_probes_lock:
+    if url not in archive_probes:
+      if not hasattr(prefetch_archive_url, 'executor'):
+        prefetch_archive_url.executor = thread_pool(max_workers=4)
+      archive_probes[url] = prefetch_archive_url.executor.submit(probe_archive_url, url)
 
-  url = urljoin(emsdk_packages_url, archive)
 
+def resolve_archive_url(url):
+  """Returns the URL that the archive `url` should actually be downloaded from.
+  This only differs from `url` for wasm-binaries, see probe_archive_url().
+  """
+  prefetch_archive_url(url)
+  with archive_probes_lock:
+    probe = archive_probes.get(url)
+  return probe.result() if probe else url
+
+
+def download_archive(url, filename_prefix=''):
+  """Downloads the archive at `url` into the downloads directory, verifying it
+  if its digest is known.  Returns the path of the downloaded file, or None on
+  failure.
+  """
   def try_download(url):
-    return download_file(url, download_dir, filename_prefix)
+    return download_file(url, download_dir, filename_prefix, get_expected_sha256(url))
 
   # Special hack for the wasm-binaries we transitioned from `.bzip2` to
   # `.xz`, but we can't tell from the version/url which one to use, so
-  # try one and then fall back to the other.
-  success = False
-  if 'wasm-binaries' in archive and os.path.splitext(archive)[1] == '.xz':
-    success = try_download(url)
-    if not success:
-      alt_url = url.replace('.tar.xz', '.tbz2')
-      success = try_download(alt_url)
-      if success:
-        url = alt_url
-
-  if not success:
-    success = try_download(url)
+  # try one and then fall back to the other.  Normally resolve_archive_url()
+  # has already found the right one, and this is only needed when it could not
+  # reach the server.  Likewise, fall back from a mirror's .tar.zst to the
+  # .tar.xz that every mirror has, which is also what happens right away if
+  # the .tar.zst could not be verified.
+  if 'wasm-binaries' in url:
+    if url.endswith('.tar.zst') and not get_expected_sha256(url):
+      return download_archive(url[:-len('.tar.zst')] + '.tar.xz', filename_prefix)
+    for suffix, fallback in (('.tar.zst', '.tar.xz'), ('.tar.xz', '.tbz2')):
+      if url.endswith(suffix):
+        return try_download(url) or download_archive(url[:-len(suffix)] + fallback, filename_prefix)
+  return try_download(url)
+
+
+def download_and_extract(archive, dest_dir, filename_prefix='', clobber=True, manifest=None, member_filter=None):
+  """Downloads the given archive and extracts it into `dest_dir`, recording
+  the extracted files in `manifest` (an InstallManifest) if given.  Only the
+  files that `member_filter` accepts are extracted (see TarExtractor).
+  """
+  debug_print(f'download_and_extract(archive={archive}, dest_dir={dest_dir})')
 
-  if not success:
+  url = resolve_archive_url(urljoin(emsdk_packages_url, archive))
+  sha256 = get_expected_sha256(url)
+
+  if STREAM_EXTRACT and not archive.endswith('.zip'):
+    # Only stream when there is not already a local copy of the archive to
+    # extract from.
+    download_target = get_download_target(url, download_dir, filename_prefix)
+    cache = get_download_cache()
+    have_local_copy = is_download_complete(download_target, sha256) or (cache and cache.contains(url, sha256))
+    if not have_local_copy:
+      try:
+        if stream_download_and_extract(url, dest_dir, download_target, clobber, sha256, manifest, member_filter):
+          return True
+      except Exception as e:
+        # Whatever was written of the archive so far is kept in the partial
+        # download, so the regular download below resumes from there.
+        errlog(f"Error: Streaming extraction of '{url}' failed: {e}. Retrying with a regular download.")
+
+  download_target = download_archive(url, filename_prefix)
+  if not download_target:
     return False
 
   # Remove the old directory, since we have some SDKs that install into the
   # same directory.  If we didn't do this contents of the previous install
-  # could remain.
+  # could remain.  The old directory is deleted in the background, so that
+  # extracting the new one can start right away.
   if clobber:
-    remove_tree(dest_dir)
+    discard_tree(dest_dir)
 
-  download_target = get_download_target(url, download_dir, filename_prefix)
   if archive.endswith('.zip'):
-    return unzip(download_target, dest_dir)
+    return unzip(download_target, dest_dir, manifest, member_filter)
   else:
-    return untargz(download_target, dest_dir)
+    return untargz(download_target, dest_dir, manifest, member_filter)
 
 
 def to_native_path(p):
@@ -1576,7 +4293,7 @@ def get_required_path(active_tools):
   path_add = [to_native_path(EMSDK_PATH)]
   for tool in active_tools:
     if tool.activated_path:
-      path = to_native_path(tool.expand_vars(tool.activated_path))
+      path = to_native_path(tool.expand_vars(tool.activated_path, activated=True))
       # If the tool has an activated_path_skip attribute then we don't add
       # the tools path to the users path if a program by that name is found
       # in the existing PATH.  This allows us to, for example, add our version
@@ -1643,7 +4360,7 @@ def find_emscripten_root(active_tools):
 
 def fetch_nightly_node_versions():
   url = "https://nodejs.org/download/nightly/"
-  with urlopen(url) as response:
+  with open_url(url) as response:
     html = response.read().decode("utf-8")
 
   # Regex to capture href values like v7.0.0-nightly2016080175c6d9dd95/
@@ -1808,6 +4525,120 @@ def generate_em_config(active_tools, permanently_activate, system):
     print('    echo \'source "%s"\' >> %s' % (emsdk_env, shell_config_file))
 
 
+def release_store_marker():
+  return sdk_path(os.path.join('upstream', '.emsdk_store'))
+
+
+def release_store_enabled():
+  if not hasattr(release_store_enabled, 'enabled'):
+    release_store_enabled.enabled = RELEASE_STORE or os.path.exists(release_store_marker())
+  return release_store_enabled.enabled
+
+
+def current_release_link():
+  return sdk_path(os.path.join('upstream', 'current'))
+
+
+def current_release():
+  """Returns the hash of the release that upstream/current points to, or None
+  if there is no such link."""
+  try:
+    return os.path.basename(os.readlink(current_release_link()).rstrip('/\\'))
+  except OSError:
+    return None
+
+
+def make_directory_link(target, link):
+  """Creates `link` as a link to the directory `target`, which is relative to
+  the directory of `link`.  Creating symlinks on Windows needs a privilege
+  (or developer mode) that users often don't have, so there a junction, which
+  doesn't, is created instead if need be.  Junctions can only have absolute
+  targets.
+  """
+  try:
+    os.symlink(target, link, target_is_directory=True)
+  except OSError as e:
+    if not WINDOWS:
+      raise
+    debug_print(f'cannot create a symlink at {link} ({e}), creating a junction instead')
+    absolute_target = os.path.normpath(os.path.join(os.path.dirname(link), target))
+    subprocess.check_call(['cmd', '/c', 'mklink', '/J', os.path.normpath(link), absolute_target], stdout=subprocess.DEVNULL)
+
+
+def remove_directory_link(link):
+  """Removes a link created by make_directory_link(), if there is one."""
+  if os.path.lexists(link):
+    # On Windows, directory links are removed like directories.
+    if WINDOWS:
+      os.rmdir(link)
+    else:
+      os.unlink(link)
+
+
+def set_current_release(release_hash):
+  """Points upstream/current at the given release in the release store.  The
+  new link is created next to the old one and renamed over it, so (except on
+  Windows) the link always points at a complete release, even while it is
+  being switched.  Windows can't rename over a directory link, so there the old
+  link is removed first, and for a moment there is no upstream/current at all.
+  If the switch is interrupted at that point, running `emsdk activate` again
+  completes it.
+  """
+  if current_release() == release_hash:
+    return
+  link = current_release_link()
+  tmp = f'{link}.{os.getpid()}.tmp'
+  remove_directory_link(tmp)
+  # A relative link keeps working if the emsdk directory is moved.
+  make_directory_link(release_hash, tmp)
+  if WINDOWS:
+    remove_directory_link(link)
+  os.replace(tmp, link)
+
+
+def migrate_to_release_store():
+  """Moves the release that was installed into upstream/ itself, before the
+  release store was used, into upstream/<hash>/, so that it becomes one of
+  the releases in the store instead of being mixed up with them.  If the store
+  already has that release, the old tree is removed instead.
+  """
+  store = sdk_path('upstream')
+  version_file = os.path.join(store, '.emsdk_version')
+  if not os.path.isfile(version_file):
+    return
+  release_hash = read_file(version_file).strip().split('-')[1]
+  dest = os.path.join(store, release_hash)
+  tmp = f'{dest}.{os.getpid()}.tmp'
+  print(f"Moving the release installed in '{store}' into the release store")
+  mkdir_p(tmp)
+  for name in os.listdir(store):
+    path = os.path.join(store, name)
+    if name in {'current', os.path.basename(release_store_marker())} or name.endswith('.tmp') or os.path.isfile(os.path.join(path, '.emsdk_version')):
+      continue
+    os.rename(path, os.path.join(tmp, name))
+  if os.path.exists(dest):
+    remove_tree(tmp)
+  else:
+    os.rename(tmp, dest)
+  if not os.path.exists(release_store_marker()):
+    write_file(release_store_marker(), '')
+  if not current_release():
+    print("Run 'emsdk activate' to use it through upstream/current.")
+
+
+def installed_store_releases():
+  """Returns the hashes of the releases installed in the release store, from
+  the least to the most recently installed."""
+  versions = {}
+  store = sdk_path('upstream')
+  if os.path.isdir(store):
+    for name in os.listdir(store):
+      version_file = os.path.join(store, name, '.emsdk_version')
+      if name != 'current' and not name.endswith('.tmp') and os.path.isfile(version_file):
+        versions[name] = os.path.getmtime(version_file)
+  return sorted(versions, key=versions.get)
+
+
 class Tool:
   os = None
   bitness = None
@@ -1860,9 +4691,14 @@ class Tool:
   def __str__(self):
     return self.name
 
-  def expand_vars(self, str):
+  def expand_vars(self, str, activated=False):
     if '%installation_dir%' in str:
-      str = str.replace('%installation_dir%', sdk_path(self.installation_dir()))
+      installation_dir = self.installation_dir()
+      if activated and self.in_release_store():
+        # Activated releases are used through upstream/current, so that
+        # switching between them only needs that link to be changed.
+        installation_dir = current_release_link()
+      str = str.replace('%installation_dir%', sdk_path(installation_dir))
     if '%macos_app_bundle_prefix%' in str:
       str = str.replace('%macos_app_bundle_prefix%', 'Contents/MacOS/' if MACOS else '')
     if '%actual_installation_dir%' in str:
@@ -1891,10 +4727,17 @@ class Tool:
 
     return any(dep.needs_compilation() for dep in self.dependencies())
 
+  def in_release_store(self):
+    """Returns True if this is an emscripten release that is installed into a
+    directory of its own, upstream/<hash>/, see RELEASE_STORE."""
+    return bool(self.emscripten_releases_hash) and self.install_path == 'upstream' and release_store_enabled()
+
   def installation_path(self):
     """Specifies the target path where this tool will be installed to. This could
     either be a directory or a filename (e.g. in case of node.js)
     """
+    if self.in_release_store():
+      return sdk_path(os.path.join('upstream', self.emscripten_releases_hash))
     if self.install_path:
       pth = self.expand_vars(self.install_path)
       return sdk_path(pth)
@@ -1919,7 +4762,7 @@ class Tool:
       return {}
 
     config = {}
-    expanded = to_unix_path(self.expand_vars(self.activated_cfg))
+    expanded = to_unix_path(self.expand_vars(self.activated_cfg, activated=True))
     for specific_cfg in expanded.split(';'):
       name, value = specific_cfg.split('=')
       config[name] = value.strip("'")
@@ -1929,7 +4772,7 @@ class Tool:
     if not self.activated_env:
       return []
 
-    return self.expand_vars(self.activated_env).split(';')
+    return self.expand_vars(self.activated_env, activated=True).split(';')
 
   def compatible_with_this_arch(self):
     return self.arch == ARCH or not self.arch
@@ -2003,6 +4846,9 @@ class Tool:
     if not self.is_installed():
       return False
 
+    if self.in_release_store() and current_release() != self.emscripten_releases_hash:
+      return False
+
     # All dependencies of this tool must be active as well.
     deps = self.dependencies()
     for tool in deps:
@@ -2037,7 +4883,7 @@ class Tool:
         return False
 
     if self.activated_path:
-      path = to_unix_path(self.expand_vars(self.activated_path))
+      path = to_unix_path(self.expand_vars(self.activated_path, activated=True))
       for p in path:
         path_items = os.environ['PATH'].replace('\\', '/').split(ENVPATH_SEPARATOR)
         if not normalized_contains(path_items, p):
@@ -2058,30 +4904,41 @@ class Tool:
     """Returns True if the Tool was installed of False if was skipped due to
     already being installed.
     """
-    if self.can_be_installed() is not True:
-      exit_with_error(f"The tool '{self}' is not available due to the reason: {self.can_be_installed()}")
+    return install_tools([self])[self]
 
+  def can_install_concurrently(self):
+    """Returns True if this tool can be installed at the same time as other
+    tools.  This is the case for prebuilt archives, which are just downloaded
+    and extracted.  Anything that is built from source, pulled from git or that
+    runs a custom install step is installed on its own.
+    """
     if self.id == 'sdk':
-      return self.install_sdk()
-    else:
-      return self.install_tool()
+      return not self.custom_install_script
+    if self.url is None:
+      return True
+    return (not self.git_branch and not self.custom_install_script and
+            not self.needs_compilation() and self.url.endswith(ARCHIVE_SUFFIXES))
 
-  def install_sdk(self):
-    """Returns True if any SDK component was installed of False all componented
-    were already installed.
+  def downloads_archive(self):
+    """Returns True if this tool is installed from the archive at self.url
+    (rather than built from source, cloned from git or fetched by a custom
+    script).
     """
-    print(f"Installing SDK '{self}'..")
-    installed = False
-
-    for dep in self.dependencies():
-      installed |= dep.install()
-
-    if not installed:
+    return (self.id != 'sdk' and self.url is not None and not self.git_branch and
+            self.url.endswith(ARCHIVE_SUFFIXES) and
+            self.custom_install_script not in {'build_llvm', 'build_ninja', 'build_ccache', 'download_node_nightly', 'download_firefox'})
+
+  def install_sdk(self, components_installed):
+    """Finishes installing an SDK, once all of its components have been
+    installed.  Returns True if any SDK component was installed of False all
+    componented were already installed.
+    """
+    if not components_installed:
       print(f"All SDK components already installed: '{self}'.")
       return False
 
     if self.custom_install_script == 'sdk_post_install':
-      if not sdk_post_install():
+      if not sdk_post_install(self):
         exit_with_error('post-install step failed: sdk_post_install')
 
     print(f"Done installing SDK '{self}'.")
@@ -2101,6 +4958,8 @@ class Tool:
 
     print(f"Installing tool '{self}'..")
 
+    manifest = None
+    tree_cache = from_tree_cache = None
     custom_install_scripts = {
       'build_llvm': build_llvm,
       'build_ninja': build_ninja,
@@ -2113,8 +4972,20 @@ class Tool:
     elif self.git_branch:
       success = git_clone_checkout_and_pull(self.url, self.installation_path(), self.git_branch, getattr(self, 'remote_name', 'origin'))
     elif self.url.endswith(ARCHIVE_SUFFIXES):
-      success = download_and_extract(self.url, self.installation_path(),
-                                     filename_prefix=getattr(self, 'download_prefix', ''))
+      manifest = InstallManifest(self.installation_path(), self.url, INSTALL_PROFILE)
+      # Tools that are built after being extracted are not cached, since the
+      # build could depend on the host.
+      tree_cache = None if self.custom_install_script else get_tree_cache()
+      from_tree_cache = tree_cache and tree_cache.install(urljoin(emsdk_packages_url, self.url), manifest)
+      if not from_tree_cache and INCREMENTAL_UPGRADE and not self.custom_install_script and not self.url.endswith('.zip'):
+        previous = InstallManifest.load(self.installation_path())
+        if previous and previous.profile == INSTALL_PROFILE:
+          manifest.previous = previous
+      success = from_tree_cache or download_and_extract(self.url, self.installation_path(),
+                                                        filename_prefix=getattr(self, 'download_prefix', ''),
+                                                        clobber=not manifest.previous,
+                                                        manifest=manifest,
+                                                        member_filter=profile_member_filter(INSTALL_PROFILE))
     else:
       assert False, 'unhandled url type: ' + self.url
 
@@ -2143,6 +5014,9 @@ class Tool:
       emscripten_version_file_path = os.path.join(to_native_path(self.expand_vars(self.activated_path)), 'emscripten-version.txt')
       version = get_emscripten_release_version(self.emscripten_releases_hash)
       if version:
+        # Replace the file rather than writing to it, in case it is a hard link
+        # into the tree cache.
+        rmfile(emscripten_version_file_path)
         write_file(emscripten_version_file_path, f'"{version}"\n')
 
     print(f"Done installing tool '{self}'.")
@@ -2152,32 +5026,134 @@ class Tool:
     if not self.is_installed(skip_version_check=True):
       exit_with_error(f"installation of '{self}' failed, but no error was detected. Either something went wrong with the installation, or this may indicate an internal emsdk error.")
 
+    archive_digest = tree_cache and not from_tree_cache and self.get_archive_digest()
     self.cleanup_temp_install_files()
+    if manifest:
+      if INSTALL_PROFILES[INSTALL_PROFILE].get('strip') and not from_tree_cache:
+        strip_binaries([manifest.path(relpath) for relpath in manifest.files])
+      # Pick up whatever the post-install steps changed.
+      manifest.refresh()
+      if archive_digest:
+        tree_cache.store(urljoin(emsdk_packages_url, self.url), archive_digest, manifest)
+        # Files that were hard linked into the cache are read-only now.
+        manifest.refresh()
+      manifest.save()
+      if manifest.previous:
+        manifest.finish_upgrade()
     self.update_installed_version()
+    if self.in_release_store() and not os.path.exists(release_store_marker()):
+      write_file(release_store_marker(), '')
     return True
 
+  def get_archive_digest(self):
+    """Returns the SHA-256 of the archive that this tool was installed from,
+    or None if it is neither known in advance nor still on disk."""
+    url = resolve_archive_url(urljoin(emsdk_packages_url, self.url))
+    sha256 = get_expected_sha256(url)
+    if sha256:
+      return sha256
+    download_target = get_download_target(url, download_dir, getattr(self, 'download_prefix', ''))
+    if os.path.isfile(download_target):
+      return sha256_file(download_target)
+    return None
+
   def cleanup_temp_install_files(self):
     if KEEP_DOWNLOADS:
       return
     if self.url.endswith(ARCHIVE_SUFFIXES):
-      download_target = get_download_target(self.url, download_dir, getattr(self, 'download_prefix', ''))
+      download_target = get_download_target(resolve_archive_url(self.url), download_dir, getattr(self, 'download_prefix', ''))
       debug_print(f"Deleting temporary download: {download_target}")
       rmfile(download_target)
+      DownloadJournal.remove(download_target)
 
   def uninstall(self):
     if not self.is_installed():
       print(f"Tool '{self}' was not installed. No need to uninstall.")
       return
+    if self.in_release_store() and current_release() == self.emscripten_releases_hash:
+      remove_directory_link(current_release_link())
     print(f"Uninstalling tool '{self}'..")
     if self.custom_uninstall_script:
       if self.custom_uninstall_script == 'uninstall_binaryen':
         uninstall_binaryen(self)
       else:
         raise Exception(f'Unknown custom_uninstall_script directive "{self.custom_uninstall_script}"!')
-    print(f"Deleting path '{self.installation_path()}'")
-    remove_tree(self.installation_path())
+    manifest = InstallManifest.load(self.installation_path())
+    if manifest:
+      # Only remove what was installed, in case anything else lives in the
+      # same directory.
+      print(f"Deleting installed files from '{self.installation_path()}'")
+      left_behind = manifest.remove_files()
+      if left_behind:
+        print(f"Kept {left_behind} file(s) in '{self.installation_path()}' that were not installed by emsdk.")
+    else:
+      print(f"Deleting path '{self.installation_path()}'")
+      discard_tree(self.installation_path())
     print(f"Done uninstalling '{self}'.")
 
+  def verify(self):
+    """Checks the installed files of this tool against its install manifest.
+    Returns the files that don't match (see InstallManifest.check()), or None
+    if the tool has no manifest.
+    """
+    manifest = InstallManifest.load(self.installation_path())
+    return manifest.check() if manifest else None
+
+  def repair(self):
+    """Restores the installed files of this tool that don't match its install
+    manifest, extracting only those from its archive.  Returns the files that
+    could not be restored, or None if the tool has no manifest.
+    """
+    manifest = InstallManifest.load(self.installation_path())
+    if not manifest:
+      return None
+    problems = manifest.check()
+    damaged = {relpath for relpath in problems if relpath in manifest.files}
+    for relpath in problems:
+      if relpath in manifest.links:
+        path = manifest.path(relpath)
+        if os.path.isdir(path) and not os.path.islink(path):
+          remove_tree(path)
+        rmfile(path)
+        mkdir_p(os.path.dirname(path))
+        os.symlink(manifest.links[relpath], path)
+    if not damaged:
+      return {}
+
+    print(f"Restoring {len(damaged)} file(s) of '{self}' from its archive..")
+    url = resolve_archive_url(urljoin(emsdk_packages_url, self.url))
+    archive = download_archive(url, getattr(self, 'download_prefix', ''))
+    if not archive:
+      return {relpath: problems[relpath] for relpath in damaged}
+    restored = InstallManifest(manifest.root)
+    extract = unzip if url.endswith('.zip') else untargz
+    extract(archive, manifest.root, restored, damaged.__contains__)
+    self.cleanup_temp_install_files()
+    if INSTALL_PROFILES.get(manifest.profile, {}).get('strip'):
+      # Strip the restored binaries again, the same way as when they were
+      # installed.
+      stripped = strip_binaries([restored.path(relpath) for relpath in restored.files])
+      for path, sha256 in zip(stripped, hash_files(stripped), strict=True):
+        restored.record_file(path, os.lstat(path), sha256)
+
+    remaining = {}
+    for relpath in damaged:
+      entry = restored.files.get(relpath)
+      expected = manifest.files[relpath]
+      # Files that were changed by post-install steps can't be restored from
+      # the archive.
+      if entry and entry[0] == expected[0] and entry[2] == expected[2]:
+        # The installed mode can differ from the archive, e.g. for files that
+        # were hard linked into the tree cache.  The restored file is a new one
+        # rather than such a link, so this never changes the cache.
+        path = manifest.path(relpath)
+        os.chmod(path, expected[1])
+        manifest.record_file(path, os.lstat(path), entry[2])
+      else:
+        remaining[relpath] = problems[relpath]
+    manifest.save()
+    return remaining
+
   def dependencies(self):
     deps = []
 
@@ -2197,6 +5173,190 @@ class Tool:
     return deps
 
 
+class LineBufferedOutput:
+  """Wraps an output stream so that lines written by different threads don't
+  get mixed up with each other.  Each thread's output is buffered until it
+  completes a line (or a carriage-return terminated progress update).
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  def write(self, text):
+    pending = getattr(self.local, 'pending', '') + text
+    end = max(pending.rfind('\n'), pending.rfind('\r')) + 1
+    if end:
+      with self.lock:
+        self.stream.write(pending[:end])
+        self.stream.flush()
+    self.local.pending = pending[end:]
+    return len(text)
+
+  def flush(self):
+    self.stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def line_buffered_output():
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = LineBufferedOutput(stdout), LineBufferedOutput(stderr)
+  try:
+    yield
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+
+
+def with_dependencies(tools):
+  """Returns the given tools along with all of their dependencies, ordered so
+  that dependencies come before the tools that need them.
+  """
+  ordered = []
+
+  def add_with_dependencies(tool):
+    for dep in tool.dependencies():
+      add_with_dependencies(dep)
+    if tool not in ordered:
+      ordered.append(tool)
+
+  for tool in tools:
+    add_with_dependencies(tool)
+  return ordered
+
+
+def fetch_tools(tools_to_fetch):
+  """Downloads and verifies the archives that installing the given tools and
+  SDKs would need, without installing anything.  The archives end up in the
+  download cache if one is configured, and in the downloads directory
+  otherwise, where a later install picks them up.  Returns True on success.
+  """
+  tools = []
+  for tool in with_dependencies(tools_to_fetch):
+    if tool.id == 'sdk':
+      continue
+    if tool.can_be_installed() is not True:
+      exit_with_error(f"The tool '{tool}' is not available due to the reason: {tool.can_be_installed()}")
+    if tool.is_installed():
+      print(f"Skipped fetching {tool.name}, already installed.")
+    elif not tool.downloads_archive():
+      print(f"Skipped fetching {tool.name}, it is not installed from a prebuilt archive.")
+    else:
+      tools.append(tool)
+      prefetch_archive_url(tool.url)
+
+  cache = get_download_cache()
+
+  def fetch(tool):
+    url = resolve_archive_url(urljoin(emsdk_packages_url, tool.url))
+    if cache and cache.contains(url, get_expected_sha256(url)):
+      print(f"'{url}' is already in the download cache.")
+      return True
+    file_name = download_archive(url, getattr(tool, 'download_prefix', ''))
+    if file_name and cache and not KEEP_DOWNLOADS:
+      # download_file() has stored a copy in the cache.
+      rmfile(file_name)
+      DownloadJournal.remove(file_name)
+    return file_name is not None
+
+  with line_buffered_output(), thread_pool(max_workers=max(INSTALL_JOBS, 1)) as executor:
+    return all(executor.map(fetch, tools))
+
+
+def fetch_in_background(args):
+  """Runs `emsdk fetch` with the given arguments in a detached process, whose
+  output goes to a log file in the downloads directory.
+  """
+  log_file = sdk_path(download_dir + 'fetch.log')
+  mkdir_p(os.path.dirname(log_file))
+  with open(log_file, 'a') as log:
+    proc = start_detached_process([sys.executable, os.path.abspath(__file__), 'fetch', *args], log)
+  print(f"Fetching in the background (pid {proc.pid}), see '{log_file}' for progress.")
+
+
+def install_tools(tools_to_install):
+  """Installs the given tools and SDKs, along with all of their dependencies.
+
+  Independent tools are downloaded and extracted in parallel, using up to
+  INSTALL_JOBS threads.  A tool is only started once all of its dependencies
+  have been installed, so e.g. the post-install step of an SDK runs once all
+  of its components are in place.  Tools that cannot be installed concurrently
+  (see Tool.can_install_concurrently) act as barriers: they wait for all the
+  tools before them and all the tools after them wait for them.
+
+  Returns a dict that maps each tool to True if it was installed, or False if
+  it was skipped due to already being installed.
+  """
+  ordered = with_dependencies(tools_to_install)
+  for tool in ordered:
+    if tool.can_be_installed() is not True:
+      exit_with_error(f"The tool '{tool}' is not available due to the reason: {tool.can_be_installed()}")
+
+  waits_for = {}
+  for i, tool in enumerate(ordered):
+    blockers = set(tool.dependencies())
+    for earlier in ordered[:i]:
+      if not tool.can_install_concurrently() or not earlier.can_install_concurrently():
+        blockers.add(earlier)
+      elif tool.id != 'sdk' and earlier.id != 'sdk' and tool.installation_path() == earlier.installation_path():
+        # Tools that install into the same directory would clobber each other.
+        blockers.add(earlier)
+    waits_for[tool] = blockers
+
+  results = {}
+
+  def install_one(tool):
+    if tool.id == 'sdk':
+      return tool.install_sdk(any(results[dep] for dep in tool.dependencies()))
+    return tool.install_tool()
+
+  for tool in ordered:
+    if tool.id == 'sdk':
+      print(f"Installing SDK '{tool}'..")
+    elif tool.url and not tool.is_installed():
+      prefetch_archive_url(tool.url)
+
+  import concurrent.futures
+  pending = list(ordered)
+  running = {}
+  error = None
+  with line_buffered_output(), thread_pool(max_workers=max(INSTALL_JOBS, 1)) as executor:
+    try:
+      while pending or running:
+        if error is None:
+          # Only as many tools are handed to the executor as it can run, so
+          # that none are left queued in it to start after a failure.
+          for tool in list(pending):
+            if len(running) >= max(INSTALL_JOBS, 1):
+              break
+            if waits_for[tool].issubset(results):
+              pending.remove(tool)
+              running[executor.submit(install_one, tool)] = tool
+        if not running:
+          break
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          tool = running.pop(future)
+          try:
+            results[tool] = future.result()
+          except BaseException as e:
+            # Don't start anything new, and stop the downloads that are still
+            # in flight.  Their partial downloads are kept for next time.
+            if error is None:
+              error = e
+            downloads_cancelled.set()
+    except BaseException:
+      downloads_cancelled.set()
+      raise
+
+  if error:
+    raise error
+  return results
+
+
 # A global registry of all known Emscripten SDK tools available in the SDK manifest.
 tools = []
 tools_map = {}
@@ -2317,8 +5477,8 @@ def get_emscripten_releases_tot():
   def check_binary(release, os_name, arch, ext):
     url = emscripten_releases_download_url_template % (os_name, release, arch, ext)
     try:
-      urlopen(url)
-      return True
+      with open_url(url, method='HEAD'):
+        return True
     except Exception:
       return False
 
@@ -2399,8 +5559,59 @@ def load_releases_info():
   return load_releases_info.cached_info
 
 
+def load_mirror_checksums():
+  """Loads the digests from the EMSDK_MIRROR_CHECKSUMS file, keyed by the path
+  of the archive relative to emscripten_releases_builds_url.  The file is either
+  JSON in the format of the checksums in emscripten-releases-tags.json, or the
+  output of `sha256sum` run at the top of a mirror.
+  """
+  if not hasattr(load_mirror_checksums, 'checksums'):
+    checksums = {}
+    if MIRROR_CHECKSUMS:
+      try:
+        text = read_file(MIRROR_CHECKSUMS)
+      except OSError as e:
+        exit_with_error(f'failed to read EMSDK_MIRROR_CHECKSUMS file: {e}')
+      try:
+        checksums = json.loads(text)
+      except ValueError:
+        for line in text.splitlines():
+          if not line.strip():
+            continue
+          m = re.fullmatch(r'([0-9a-fA-F]{64}) [ *](?:\./)?(.+)', line.strip())
+          if not m:
+            exit_with_error(f'{MIRROR_CHECKSUMS}: not a sha256sum line: {line}')
+          checksums[m[2]] = m[1].lower()
+      debug_print(f'loaded {len(checksums)} digests from {MIRROR_CHECKSUMS}')
+    load_mirror_checksums.checksums = checksums
+  return load_mirror_checksums.checksums
+
+
+def release_checksums():
+  """Returns the digests of the release archives that are known, from the
+  release metadata, and from EMSDK_MIRROR_CHECKSUMS.  The release metadata wins
+  if they disagree, since the mirrors must not be able to replace upstream
+  archives.
+  """
+  return {**load_mirror_checksums(), **load_releases_info().get('checksums', {})}
+
+
+def get_expected_sha256(url):
+  """Returns the SHA-256 that the release archive at `url` is known to have, or
+  None if we have no record of it.
+  """
+  if not url.startswith(emscripten_releases_builds_url):
+    return None
+  return release_checksums().get(url[len(emscripten_releases_builds_url):])
+
+
 def get_installed_sdk_version():
   version_file = sdk_path(os.path.join('upstream', '.emsdk_version'))
+  if release_store_enabled():
+    releases = installed_store_releases()
+    if releases:
+      # The most recently installed release.
+      version_file = sdk_path(os.path.join('upstream', releases[-1], '.emsdk_version'))
   if not os.path.exists(version_file):
     return None
   version = read_file(version_file)
@@ -2424,6 +5635,8 @@ def load_releases_tags():
   installed = get_installed_sdk_version()
   if installed and installed not in tags:
     tags.append(installed)
+  if release_store_enabled():
+    tags += [h for h in installed_store_releases() if h not in tags]
 
   return tags
 
@@ -2434,7 +5647,67 @@ def load_releases_versions():
   return versions
 
 
+# The files that expand_sdk_manifest() reads.
+MANIFEST_INPUTS = ['emsdk_manifest.json', 'legacy-emscripten-tags.txt', 'llvm-tags-64bit.txt',
+                   'legacy-binaryen-tags.txt', 'emscripten-releases-tags.json']
+
+
+def manifest_cache_key():
+  """Returns what the tools and SDKs that expand_sdk_manifest() finds depend on:
+  the files it reads (and this script), the host, and the releases that are
+  installed, or None if one of the files is missing."""
+  files = []
+  for f in [*MANIFEST_INPUTS, os.path.abspath(__file__)]:
+    try:
+      st = os.stat(sdk_path(f))
+    except OSError:
+      return None
+    files.append((os.path.basename(f), st.st_mtime_ns, st.st_size))
+  store = installed_store_releases() if release_store_enabled() else []
+  return (files, os_name(), ARCH, sys.version, extra_release_tag, get_installed_sdk_version(), store)
+
+
 def load_sdk_manifest():
+  """Fills in the tools and sdks registries, from MANIFEST_CACHE_FILE if it is
+  up to date, otherwise with expand_sdk_manifest() (and then updates the
+  cache)."""
+  key = manifest_cache_key() if MANIFEST_CACHE else None
+  if not key:
+    expand_sdk_manifest()
+    return
+
+  cache_file = sdk_path(MANIFEST_CACHE_FILE)
+  try:
+    with open(cache_file, 'rb') as f:
+      cached_key, cached_tools, cached_sdks = marshal.loads(f.read())
+  except Exception:
+    cached_key = None
+  if cached_key == key:
+    debug_print(f'loading tools and SDKs from {cache_file}')
+    # These were checked for duplicates by add_tool() and add_sdk() when they
+    # were cached.
+    for registry, registry_map, cached in ((tools, tools_map, cached_tools), (sdks, sdks_map, cached_sdks)):
+      for attrs in cached:
+        t = Tool.__new__(Tool)
+        t.__dict__.update(attrs)
+        registry.append(t)
+        registry_map[t.name] = t
+    return
+
+  expand_sdk_manifest()
+  tmp = f'{cache_file}.{os.getpid()}.tmp'
+  try:
+    with open(tmp, 'wb') as f:
+      f.write(marshal.dumps((key, [vars(t) for t in tools], [vars(s) for s in sdks])))
+    os.replace(tmp, cache_file)
+  except (OSError, ValueError) as e:
+    # The SDK directory may be read-only, in which case every command expands
+    # the manifest.
+    debug_print(f'failed to write {cache_file}: {e}')
+    rmfile(tmp)
+
+
+def expand_sdk_manifest():
   try:
     manifest = json.loads(read_file(sdk_path('emsdk_manifest.json')))
   except Exception:
@@ -2604,6 +5877,10 @@ def set_active_tools(tools_to_activate, permanently_activate, system):
       print(f'   {t}')
     print('')
 
+  for tool in tools_to_activate:
+    if tool.in_release_store():
+      set_current_release(tool.emscripten_releases_hash)
+
   generate_em_config(tools_to_activate, permanently_activate, system)
 
   # Construct a .bat or .ps1 script that will be invoked to set env. vars and PATH
@@ -2813,7 +6090,12 @@ def construct_env_with_vars(env_vars_to_add):
   # if no such tool is active.
   # Ignore certain keys that are inputs to emsdk itself.
   ignore_keys = {'EMSDK_POWERSHELL', 'EMSDK_CSH', 'EMSDK_CMD', 'EMSDK_BASH', 'EMSDK_FISH',
-                 'EMSDK_NUM_CORES', 'EMSDK_NOTTY', 'EMSDK_KEEP_DOWNLOADS'}
+                 'EMSDK_NUM_CORES', 'EMSDK_NOTTY', 'EMSDK_KEEP_DOWNLOADS',
+                 'EMSDK_DOWNLOAD_SEGMENTS', 'EMSDK_DOWNLOAD_CACHE', 'EMSDK_DOWNLOAD_CACHE_SIZE',
+                 'EMSDK_STREAM_EXTRACT', 'EMSDK_INSTALL_JOBS', 'EMSDK_MIRRORS', 'EMSDK_MIRROR_CHECKSUMS',
+                 'EMSDK_DOWNLOAD_CONNECTIONS', 'EMSDK_DOWNLOAD_RATE', 'EMSDK_DOWNLOAD_HOST_RATE',
+                 'EMSDK_EXTRACT_JOBS', 'EMSDK_DECOMPRESSOR', 'EMSDK_TREE_CACHE', 'EMSDK_TREE_CACHE_SIZE',
+                 'EMSDK_INCREMENTAL_UPGRADE', 'EMSDK_RELEASE_STORE', 'EMSDK_MANIFEST_CACHE'}
   env_keys_to_add = {pair[0] for pair in env_vars_to_add}
   for key in os.environ:
     if key.startswith('EMSDK_') or key in {'EM_CACHE', 'EM_CONFIG'}:
@@ -2886,6 +6168,15 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
   debug_print('emsdk.py running under `%s`' % sys.executable)
   cmd = args.pop(0)
 
+  if cmd == 'empty_trash':
+    empty_trash()
+    return 0
+  # Finish deleting whatever an earlier, interrupted, run left in the trash.
+  # Only the commands that put things in the trash do this, so that e.g.
+  # construct_env, which runs in every new shell, doesn't start processes.
+  if cmd in {'install', 'uninstall', 'update', 'repair', 'dedupe'}:
+    empty_trash_in_background(check_lock=True)
+
   if cmd in {'help', '--help', '-h'}:
     print(' emsdk: Available commands:')
 
@@ -2933,6 +6224,13 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
                                   yourself.  Default: disabled, i.e. do a full
                                   clone.
 
+                --profile=<name>: Installs only the parts of the release
+                                  archives that the given profile keeps.
+                                  'minimal' leaves out the emscripten test
+                                  suite and strips the symbols from the
+                                  installed binaries (using `strip`).
+                                  Default: 'full', i.e. install everything.
+
                    --build-tests: If enabled, LLVM is built with internal tests
                                   included. Pass this to enable running test
                                   other.test_llvm_lit in the Emscripten test
@@ -2961,10 +6259,43 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
                                   --override-repository emscripten-main@https://github.com/<fork>/emscripten/tree/<refspec>
 
 
+   emsdk fetch [--background] <tool 1> <tool 2> ...
+                                - Downloads and verifies the archives needed
+                                  to install the given tools or SDKs, without
+                                  installing them. They are stored in the
+                                  download cache (see EMSDK_DOWNLOAD_CACHE),
+                                  or in the downloads directory where a later
+                                  'emsdk install' finds them. With
+                                  --background the download continues in a
+                                  detached process.
+
+
    emsdk deactivate tool/sdk    - Removes the given tool or SDK from the current set of activated tools.
 
 
-   emsdk uninstall <tool/sdk>   - Removes the given tool or SDK from disk.''')
+   emsdk uninstall <tool/sdk>   - Removes the given tool or SDK from disk.
+                                  Only the files that emsdk installed are
+                                  removed.
+
+
+   emsdk verify [tool/sdk ...]  - Checks the installed files of the given
+                                  tools or SDKs (default: everything that is
+                                  installed) against the manifest recorded
+                                  when they were installed, and reports any
+                                  files that are missing or were modified.
+
+
+   emsdk repair [tool/sdk ...]  - Restores the damaged files found by
+                                  'emsdk verify', extracting only those files
+                                  from the downloaded archives.
+
+
+   emsdk dedupe [--dry-run]     - Replaces the files that are identical across
+                                  installed tools and versions with reflinks,
+                                  or read-only hard links, to a single copy,
+                                  and reports how much disk space that freed.
+                                  With --dry-run, only reports what would be
+                                  done.''')
 
     if WINDOWS:
       print('''
@@ -3007,6 +6338,65 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
 
    Environment:
       EMSDK_KEEP_DOWNLOADS=1     - if you want to keep the downloaded archives.
+      EMSDK_DOWNLOAD_SEGMENTS=n  - download large files as n parallel byte ranges
+                                   (default: 4, 1 disables segmented downloads).
+      EMSDK_INSTALL_JOBS=n       - install up to n independent tools at the same
+                                   time (default: 4).
+      EMSDK_STREAM_EXTRACT=1     - extract tar archives while they are being
+                                   downloaded.
+      EMSDK_EXTRACT_JOBS=n       - write files on n threads when extracting
+                                   archives (default: number of CPUs, up to
+                                   8).
+      EMSDK_DECOMPRESSOR=name    - decompress tar archives with the given
+                                   program (pixz, xz, pigz or pbzip2), or
+                                   'none' to not use an external program. By
+                                   default a multi-threaded one is picked
+                                   when available on multi-core hosts. If
+                                   the program fails, the archive is
+                                   decompressed in Python instead.
+      EMSDK_DOWNLOAD_CACHE=dir   - share downloaded archives between emsdk
+                                   checkouts (and users) via the given directory.
+      EMSDK_DOWNLOAD_CACHE_SIZE=n - maximum size of the download cache, e.g.
+                                   500M or 20G (default: 10G).
+      EMSDK_TREE_CACHE=dir       - keep the trees extracted from release
+                                   archives in the given directory, so that
+                                   installing them again is instant. Installed
+                                   files share their data with the cache
+                                   (reflinks or read-only hard links) where
+                                   the filesystem allows. Files in emcc's
+                                   cache directory are never hard links.
+      EMSDK_TREE_CACHE_SIZE=n    - maximum size of the extracted tree cache
+                                   (default: 20G).
+      EMSDK_INCREMENTAL_UPGRADE=1 - when installing a release over another one,
+                                   only write the files that changed, and
+                                   remove those that are gone.
+      EMSDK_RELEASE_STORE=1      - install each release into upstream/<hash>/
+                                   instead of replacing upstream/, so that
+                                   switching between installed releases with
+                                   'emsdk activate' is instant (it points the
+                                   upstream/current link at the release).
+                                   Sticks once a release was installed so.
+      EMSDK_MANIFEST_CACHE=0     - don't cache the tools and SDKs listed in
+                                   the manifest and tag files in
+                                   .emsdk_manifest_cache.
+      EMSDK_MIRRORS=url,...      - mirrors of the emscripten release builds to
+                                   download from. The fastest one is used, and
+                                   the others (then upstream) on failure.
+                                   .tar.zst archives on the mirrors are used
+                                   if they decompress faster than .tar.xz
+                                   (needs zstd or the zstandard package) and
+                                   their digests are listed in
+                                   emscripten-releases-tags.json or in
+                                   EMSDK_MIRROR_CHECKSUMS.
+      EMSDK_MIRROR_CHECKSUMS=file - trusted digests of the .tar.zst archives
+                                   on the mirrors, as JSON like the checksums
+                                   in emscripten-releases-tags.json, or as
+                                   sha256sum output from the mirror's root.
+      EMSDK_DOWNLOAD_CONNECTIONS=n - maximum number of connections downloading
+                                   at the same time (default: 16).
+      EMSDK_DOWNLOAD_RATE=n      - limit downloads to n bytes per second, e.g. 5M.
+      EMSDK_DOWNLOAD_HOST_RATE=n - limit all emsdk processes on this machine
+                                   together to n bytes per second.
       EMSDK_NOTTY=1              - override isatty() result (mainly to log progress).
       EMSDK_NUM_CORES=n          - limit parallelism to n cores.
       EMSDK_VERBOSE=1            - very verbose output, useful for debugging.
@@ -3049,11 +6439,18 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
     global TTY_OUTPUT
     TTY_OUTPUT = False
 
+  arg_background = extract_bool_arg('--background')
+
   # Replace meta-packages with the real package names.
-  if cmd in {'update', 'install', 'activate'}:
+  if cmd in {'update', 'install', 'fetch', 'activate', 'verify', 'repair'}:
     activating = cmd == 'activate'
     args = [expand_sdk_name(a, activating=activating) for a in args]
 
+  # A release installed before the release store was used is moved into it
+  # before the installed releases are looked at.
+  if cmd in {'install', 'activate'} and release_store_enabled():
+    migrate_to_release_store()
+
   load_em_config()
   load_sdk_manifest()
 
@@ -3266,7 +6663,7 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
       errlog('The changes made to environment variables only apply to the currently running shell instance. Use the \'emsdk_env.bat\' to re-enter this environment later, or if you\'d like to register this environment permanently, rerun this command with the option --permanent.')
     return 0
   elif cmd == 'install':
-    global BUILD_FOR_TESTING, ENABLE_LLVM_ASSERTIONS, CPU_CORES, GIT_CLONE_SHALLOW
+    global BUILD_FOR_TESTING, ENABLE_LLVM_ASSERTIONS, CPU_CORES, GIT_CLONE_SHALLOW, INSTALL_PROFILE
 
     # Process args
     for i in range(len(args)):
@@ -3281,6 +6678,12 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
       elif args[i] == '--shallow':
         GIT_CLONE_SHALLOW = True
         args[i] = ''
+      elif args[i].startswith('--profile='):
+        INSTALL_PROFILE = args[i].split('=', 1)[1]
+        if INSTALL_PROFILE not in INSTALL_PROFILES:
+          errlog(f"Unknown install profile '{INSTALL_PROFILE}'. Available profiles: {', '.join(INSTALL_PROFILES)}")
+          return 1
+        args[i] = ''
       elif args[i] == '--build-tests':
         BUILD_FOR_TESTING = True
         args[i] = ''
@@ -3299,13 +6702,85 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
       errlog('WARNING: arm64-linux binaries are not available for all releases.')
       errlog('See https://github.com/emscripten-core/emsdk/issues/547')
 
+    tools_to_install = []
+    for t in args:
+      tool = find_tool(t)
+      if tool is None:
+        tool = find_sdk(t)
+      if tool is None:
+        error_on_missing_tool(t)
+      tools_to_install.append(tool)
+    install_tools(tools_to_install)
+    return 0
+  elif cmd == 'fetch':
+    if not args:
+      errlog("Missing parameter. Type 'emsdk fetch <tool name>' to download the archives for a tool or an SDK without installing it.")
+      return 1
+    tools_to_fetch = []
     for t in args:
       tool = find_tool(t)
       if tool is None:
         tool = find_sdk(t)
       if tool is None:
         error_on_missing_tool(t)
-      tool.install()
+      tools_to_fetch.append(tool)
+    if arg_background:
+      fetch_in_background([str(t) for t in tools_to_fetch])
+      return 0
+    if not fetch_tools(tools_to_fetch):
+      errlog('Failed to fetch all archives.')
+      return 1
+    return 0
+  elif cmd in {'verify', 'repair'}:
+    if args:
+      tools_to_check = []
+      for t in args:
+        tool = find_tool(t)
+        if tool is None:
+          tool = find_sdk(t)
+        if tool is None:
+          error_on_missing_tool(t)
+        tools_to_check.append(tool)
+    else:
+      tools_to_check = [t for t in tools if t.is_installed()]
+    all_ok = True
+    for tool in with_dependencies(tools_to_check):
+      if tool.id == 'sdk' or tool.url is None:
+        continue
+      if not tool.is_installed():
+        errlog(f"Tool '{tool}' is not installed.")
+        all_ok = False
+        continue
+      problems = tool.verify() if cmd == 'verify' else tool.repair()
+      if problems is None:
+        print(f"Tool '{tool}' was installed without a file manifest, so it can't be checked.")
+        continue
+      if not problems:
+        print(f"All installed files of '{tool}' are intact.")
+        continue
+      all_ok = False
+      errlog(f"Tool '{tool}' has {len(problems)} damaged file(s):")
+      for relpath, problem in sorted(problems.items()):
+        errlog(f'  {relpath}: {problem}')
+    if not all_ok:
+      if cmd == 'verify':
+        errlog("Run 'emsdk repair' to restore the damaged files.")
+      else:
+        errlog("Some files could not be restored. Uninstall and reinstall the affected tools to fix them.")
+      return 1
+    return 0
+  elif cmd == 'dedupe':
+    dry_run = '--dry-run' in args
+    manifests = []
+    for path in sorted({tool.installation_path() for tool in tools if tool.url}):
+      manifest = InstallManifest.load(path)
+      if manifest:
+        manifests.append(manifest)
+    replaced, reclaimed = dedupe_files(manifests, dry_run)
+    if dry_run:
+      print(f'Would replace {replaced} duplicate file(s) in {len(manifests)} installed tool(s), freeing {reclaimed} Bytes.')
+    else:
+      print(f'Replaced {replaced} duplicate file(s) in {len(manifests)} installed tool(s), freeing {reclaimed} Bytes.')
     return 0
   elif cmd == 'uninstall':
     if not args:
@@ -3322,9 +6797,14 @@ def main(args):  # ruff: ignore[complex-structure, too-many-return-statements, t
   return 1
 
 
-if __name__ == '__main__':
+def entry_point():
+  """Runs the command given on the command line, and exits."""
   try:
     sys.exit(main(sys.argv[1:]))
   except KeyboardInterrupt:
     exit_with_error('aborted by user, exiting')
     sys.exit(1)
+
+
+if __name__ == '__main__':
+  entry_point()
@@ -3,7 +3,9 @@
 # emscripten. It reads emsdk/emscripten-releases-tags.json to get the latest
 # version number. Then, it downloads the prebuilts for that version and computes
 # the sha256sum for the archive. It then puts all this information into the
-# emsdk/bazel/revisions.bzl file.
+# emsdk/bazel/revisions.bzl file, and records the checksums in
+# emsdk/emscripten-releases-tags.json, where emsdk uses them to verify its
+# downloads.
 
 import hashlib
 import json
@@ -28,8 +30,12 @@ def get_latest_info():
     return latest, info['releases'][latest]
 
 
-def get_sha(platform, archive_fmt, latest_hash, arch_suffix=''):
-    r = requests.get(f'{STORAGE_URL}/{platform}/{latest_hash}/wasm-binaries{arch_suffix}.{archive_fmt}')
+def archive_path(platform, archive_fmt, latest_hash, arch_suffix=''):
+    return f'{platform}/{latest_hash}/wasm-binaries{arch_suffix}.{archive_fmt}'
+
+
+def get_sha(path):
+    r = requests.get(f'{STORAGE_URL}/{path}')
     r.raise_for_status()
     print(f'Fetching {r.url}')
     h = hashlib.new('sha256')
@@ -38,15 +44,26 @@ def get_sha(platform, archive_fmt, latest_hash, arch_suffix=''):
     return h.hexdigest()
 
 
-def revisions_item(version, latest_hash):
+def get_shas(latest_hash):
+    paths = {
+        'sha_linux': archive_path('linux', 'tar.xz', latest_hash),
+        'sha_linux_arm64': archive_path('linux', 'tar.xz', latest_hash, '-arm64'),
+        'sha_mac': archive_path('mac', 'tar.xz', latest_hash),
+        'sha_mac_arm64': archive_path('mac', 'tar.xz', latest_hash, '-arm64'),
+        'sha_win': archive_path('win', 'zip', latest_hash),
+    }
+    return {name: (path, get_sha(path)) for name, path in paths.items()}
+
+
+def revisions_item(version, latest_hash, shas):
     return f'''\
     "{version}": struct(
         hash = "{latest_hash}",
-        sha_linux = "{get_sha('linux', 'tar.xz', latest_hash)}",
-        sha_linux_arm64 = "{get_sha('linux', 'tar.xz', latest_hash, '-arm64')}",
-        sha_mac = "{get_sha('mac', 'tar.xz', latest_hash)}",
-        sha_mac_arm64 = "{get_sha('mac', 'tar.xz', latest_hash, '-arm64')}",
-        sha_win = "{get_sha('win', 'zip', latest_hash)}",
+        sha_linux = "{shas['sha_linux'][1]}",
+        sha_linux_arm64 = "{shas['sha_linux_arm64'][1]}",
+        sha_mac = "{shas['sha_mac'][1]}",
+        sha_mac_arm64 = "{shas['sha_mac_arm64'][1]}",
+        sha_win = "{shas['sha_win'][1]}",
     ),
 '''
 
@@ -61,6 +78,19 @@ def insert_revision(item):
         f.write(''.join(lines))
 
 
+def insert_checksums(shas):
+    with open(RELEASES_TAGS_FILE) as f:
+        info = json.load(f)
+
+    checksums = dict(shas.values())
+    checksums.update(info.get('checksums', {}))
+    info['checksums'] = checksums
+
+    with open(RELEASES_TAGS_FILE, 'w') as f:
+        f.write(json.dumps(info, indent=2))
+        f.write('\n')
+
+
 def update_module_version(version):
     with open(BAZEL_MODULE_FILE) as f:
         content = f.read()
@@ -78,10 +108,12 @@ def update_module_version(version):
 def main():
     version, latest_hash = get_latest_info()
     update_module_version(version)
-    item = revisions_item(version, latest_hash)
+    shas = get_shas(latest_hash)
+    item = revisions_item(version, latest_hash, shas)
     print('inserting item:')
     print(item)
     insert_revision(item)
+    insert_checksums(shas)
 
 
 if __name__ == '__main__':
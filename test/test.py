@@ -60,6 +60,7 @@ def checked_call_with_output(cmd, expected=None, unexpected=None, stderr=None, e
   if unexpected:
     for x in listify(unexpected):
       assert x not in stdout, 'unexpected output present: ' + stdout + '\n[[[' + x + ']]]'
+  return stdout
 
 
 def failing_call_with_output(cmd, expected, env=None):
@@ -381,6 +382,100 @@ int main() {
     checked_call_with_output(emsdk + ' install 3.1.55', expected='Downloading:', env=env)
     checked_call_with_output(emsdk + ' install 3.1.54', expected='already downloaded, skipping', unexpected='Downloading:', env=env)
 
+  def test_fetch(self):
+    # `fetch` downloads everything that the install needs, so that the install
+    # itself doesn't download anything.
+    checked_call_with_output(emsdk + ' fetch 3.1.53', expected='Downloading:')
+    checked_call_with_output(emsdk + ' install 3.1.53', expected='already downloaded, skipping', unexpected='Downloading:')
+
+  def test_tree_cache(self):
+    env = os.environ.copy()
+    env['EMSDK_TREE_CACHE'] = tempfile.mkdtemp(prefix='emsdk_tree_cache_')
+    self.addCleanup(remove_tree, env['EMSDK_TREE_CACHE'])
+    # Switching back to a release that was installed before doesn't download or
+    # extract it again.
+    checked_call_with_output(emsdk + ' install 3.1.54', expected='Downloading:', env=env)
+    checked_call_with_output(emsdk + ' install 3.1.55', expected='Downloading:', env=env)
+    checked_call_with_output(emsdk + ' install 3.1.54', expected='from the extracted tree cache', unexpected='Downloading:', env=env)
+    checked_call_with_output(emsdk + ' verify 3.1.54', expected='are intact', env=env)
+
+  def test_incremental_upgrade(self):
+    env = os.environ.copy()
+    env['EMSDK_INCREMENTAL_UPGRADE'] = '1'
+    checked_call_with_output(emsdk + ' install 3.1.54', env=env)
+    checked_call_with_output(emsdk + ' install 3.1.55', expected='unchanged file(s)', env=env)
+    checked_call_with_output(emsdk + ' verify 3.1.55', expected='are intact', env=env)
+
+  def test_verify_and_repair(self):
+    checked_call_with_output(emsdk + ' verify node-24.19.0-64bit', expected='are intact')
+    with open(os.path.join('node', '24.19.0_64bit', 'LICENSE'), 'a') as f:
+      f.write('damaged')
+    failing_call_with_output(emsdk + ' verify node-24.19.0-64bit', expected='LICENSE: size is')
+    checked_call_with_output(emsdk + ' repair node-24.19.0-64bit', expected='Restoring 1 file(s)')
+    checked_call_with_output(emsdk + ' verify node-24.19.0-64bit', expected='are intact')
+
+  def test_install_profile(self):
+    failing_call_with_output(emsdk + ' install --profile=nope node-24.19.0-64bit', expected="Unknown install profile 'nope'")
+    checked_call_with_output(emsdk + ' uninstall node-24.19.0-64bit')
+    checked_call_with_output(emsdk + ' install --profile=minimal node-24.19.0-64bit', expected='Downloading:')
+    checked_call_with_output(emsdk + ' verify node-24.19.0-64bit', expected='are intact')
+
+  def test_dedupe(self):
+    checked_call_with_output(emsdk + ' dedupe --dry-run', expected='Would replace')
+    checked_call_with_output(emsdk + ' dedupe', expected='duplicate file(s)')
+    checked_call_with_output(emsdk + ' verify', expected='are intact')
+
+  def test_release_store(self):
+    # The release store layout sticks once it is used, so use a separate
+    # checkout for it.
+    temp_dir = tempfile.mkdtemp(prefix='emsdk_store_')
+    self.addCleanup(remove_tree, temp_dir)
+    copy_emsdk_to(temp_dir)
+    env = os.environ.copy()
+    env['EMSDK_RELEASE_STORE'] = '1'
+
+    olddir = os.getcwd()
+    try:
+      os.chdir(temp_dir)
+      # A release that was installed into upstream/ before the store was used
+      # is moved into the store.
+      checked_call_with_output(emsdk + ' install 3.1.54')
+      checked_call_with_output(emsdk + ' install 3.1.55', env=env, expected='into the release store')
+      assert not os.path.exists('upstream/emscripten')
+      checked_call_with_output(emsdk + ' install 3.1.54', expected='already installed', unexpected='Downloading:')
+      checked_call_with_output(emsdk + ' activate 3.1.54')
+      assert 'upstream/current/emscripten' in open('.emscripten').read()
+      assert open('upstream/current/emscripten/emscripten-version.txt').read().strip() == '"3.1.54"'
+      # Switching back and forth doesn't need anything to be installed again.
+      checked_call_with_output(emsdk + ' install 3.1.55', expected='already installed', unexpected='Downloading:')
+      checked_call_with_output(emsdk + ' activate 3.1.55')
+      assert open('upstream/current/emscripten/emscripten-version.txt').read().strip() == '"3.1.55"'
+    finally:
+      os.chdir(olddir)
+
+  def test_manifest_cache(self):
+    temp_dir = tempfile.mkdtemp(prefix='emsdk_manifest_cache_')
+    self.addCleanup(remove_tree, temp_dir)
+    copy_emsdk_to(temp_dir)
+
+    olddir = os.getcwd()
+    try:
+      os.chdir(temp_dir)
+      uncached = checked_call_with_output(emsdk + ' list --old', env=dict(os.environ, EMSDK_MANIFEST_CACHE='0'))
+      assert not os.path.exists('.emsdk_manifest_cache')
+      assert checked_call_with_output(emsdk + ' list --old') == uncached
+      assert os.path.exists('.emsdk_manifest_cache')
+      assert checked_call_with_output(emsdk + ' list --old') == uncached
+      # Changing one of the files that the cache was made from invalidates it.
+      with open('emscripten-releases-tags.json') as f:
+        info = json.load(f)
+      info['releases']['9.9.9'] = '0123456789abcdef0123456789abcdef01234567'
+      with open('emscripten-releases-tags.json', 'w') as f:
+        json.dump(info, f)
+      assert 'sdk-releases-0123456789abcdef0123456789abcdef01234567-64bit' in checked_call_with_output(emsdk + ' list --old')
+    finally:
+      os.chdir(olddir)
+
   def test_unicode_path(self):
     temp_dir = tempfile.mkdtemp(prefix='test_työpöytä_')
     self.addCleanup(remove_tree, temp_dir)
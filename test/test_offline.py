@@ -0,0 +1,1347 @@
+#!/usr/bin/env python3
+# Tests of the download and extraction machinery in emsdk.py that don't need
+# network access: downloads are served by a local HTTP server, and archives are
+# built on the fly.  Unlike test.py these don't install anything, and can be
+# run from anywhere.
+import concurrent.futures
+import hashlib
+import http.server
+import importlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+emsdk = importlib.import_module('emsdk')
+
+# Never send requests to the local server through a proxy.
+os.environ['no_proxy'] = '*'
+
+
+class LocalServer:
+  """An HTTP/1.1 server on localhost with keep-alive, range request and ETag
+  support, serving the contents of `files` (a dict of path to bytes).
+
+  Misbehaviour can be injected: if `drop_after` is set, the next response body
+  is cut off after that many bytes, and if `close_idle` is set, connections are
+  closed after each response without telling the client, as servers do when a
+  keep-alive connection times out.
+  """
+
+  def __init__(self):
+    self.files = {}
+    self.requests = []
+    self.connections = 0
+    self.ranges = True
+    self.drop_after = None
+    self.close_idle = False
+    self.lock = threading.Lock()
+    server = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def setup(self):
+        super().setup()
+        with server.lock:
+          server.connections += 1
+
+      def log_message(self, *args):
+        pass
+
+      def do_HEAD(self):
+        server.respond(self, body=False)
+
+      def do_GET(self):
+        server.respond(self, body=True)
+
+    self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+    self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  @staticmethod
+  def etag(data):
+    return '"%s"' % hashlib.sha256(data).hexdigest()[:16]
+
+  def ranges_requested(self, path):
+    return [headers['Range'] for _, p, headers in self.requests if p == path and 'Range' in headers]
+
+  def respond(self, handler, body):
+    path = handler.path.lstrip('/')
+    with self.lock:
+      self.requests.append((handler.command, path, dict(handler.headers)))
+      data = self.files.get(path)
+      drop_after = self.drop_after if body else None
+      if drop_after is not None:
+        self.drop_after = None
+    if data is None:
+      handler.send_response(404)
+      handler.send_header('Content-Length', '0')
+      handler.end_headers()
+      return
+
+    etag = self.etag(data)
+    start, end = 0, len(data)
+    m = re.fullmatch(r'bytes=(\d+)-(\d*)', handler.headers.get('Range', ''))
+    partial = m and self.ranges and handler.headers.get('If-Range', etag) == etag
+    if partial:
+      start = int(m[1])
+      end = min(int(m[2]) + 1 if m[2] else len(data), len(data))
+    handler.send_response(206 if partial else 200)
+    handler.send_header('Content-Length', str(end - start))
+    handler.send_header('ETag', etag)
+    if self.ranges:
+      handler.send_header('Accept-Ranges', 'bytes')
+    if partial:
+      handler.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(data)}')
+    handler.end_headers()
+    if body:
+      if drop_after is not None:
+        end = start + drop_after
+        handler.close_connection = True
+      handler.wfile.write(data[start:end])
+    if self.close_idle:
+      handler.close_connection = True
+
+
+def random_bytes(size, seed=0):
+  return random.Random(seed).randbytes(size)
+
+
+class OfflineTestCase(unittest.TestCase):
+  def setUp(self):
+    self.server = LocalServer()
+    self.addCleanup(self.server.stop)
+    self.temp_dir = tempfile.mkdtemp(prefix='emsdk_offline_')
+    self.addCleanup(emsdk.remove_tree, self.temp_dir)
+    # Downloads from this test never come from the user's download cache.
+    self.patch('DOWNLOAD_CACHE_DIR', None)
+    self.patch('MACOS', False)
+    self.forget_download_cache()
+    self.addCleanup(self.forget_download_cache)
+
+  def forget_download_cache(self):
+    if hasattr(emsdk.get_download_cache, 'cache'):
+      del emsdk.get_download_cache.cache
+
+  def patch(self, name, value):
+    """Sets emsdk.<name> to `value` for the duration of the test."""
+    patcher = mock.patch.object(emsdk, name, value)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def path(self, *parts):
+    return os.path.join(self.temp_dir, *parts)
+
+  def serve(self, name, data):
+    self.server.files[name] = data
+    return self.server.url + name
+
+  def download(self, url):
+    return emsdk.download_file(url, self.path('downloads') + '/')
+
+  def read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+
+class Segments(OfflineTestCase):
+  def test_split_into_segments(self):
+    mib = 1024 * 1024
+    # A single range is cut in half until there are enough pieces.
+    segments = emsdk.split_into_segments([(0, 10 * mib + 3)], 4)
+    self.assertEqual(len(segments), 4)
+    self.assertEqual(segments[0][0], 0)
+    self.assertEqual(segments[-1][1], 10 * mib + 3)
+    for (_, end), (start, _) in itertools.pairwise(segments):
+      self.assertEqual(end, start)
+    # Existing gaps are kept, and small ranges are never split.
+    segments = emsdk.split_into_segments([(0, 100), (3 * mib, 7 * mib + 1)], 4)
+    self.assertEqual(segments, [(0, 100), (3 * mib, 5 * mib), (5 * mib, 6 * mib), (6 * mib, 7 * mib + 1)])
+    self.assertEqual(emsdk.split_into_segments([(0, mib)], 8), [(0, mib)])
+
+  def test_segmented_download(self):
+    self.patch('DOWNLOAD_SEGMENTS', 4)
+    self.patch('DOWNLOAD_SEGMENT_MIN_SIZE', 1024 * 1024)
+    data = random_bytes(5 * 1024 * 1024 + 3)
+    url = self.serve('big.bin', data)
+    file_name = self.download(url)
+    self.assertEqual(self.read(file_name), data)
+    self.assertEqual(emsdk.DownloadJournal.load(file_name).sha256, hashlib.sha256(data).hexdigest())
+
+    # The first request fetches the start of the file, and the others must
+    # cover the rest of it without gaps or overlaps.
+    ranges = sorted((int(a), int(b)) for a, b in (re.fullmatch(r'bytes=(\d+)-(\d+)', r).groups() for r in self.server.ranges_requested('big.bin')))
+    self.assertEqual(len(ranges), 3)
+    self.assertEqual(ranges[-1][1], len(data) - 1)
+    for (_, end), (start, _) in itertools.pairwise(ranges):
+      self.assertEqual(end + 1, start)
+    # All of them are conditional on the file not having changed.
+    for _method, _path, headers in self.server.requests:
+      if 'Range' in headers:
+        self.assertEqual(headers['If-Range'], LocalServer.etag(data))
+
+  def test_no_range_support(self):
+    self.patch('DOWNLOAD_SEGMENT_MIN_SIZE', 1024 * 1024)
+    self.server.ranges = False
+    data = random_bytes(3 * 1024 * 1024)
+    file_name = self.download(self.serve('big.bin', data))
+    self.assertEqual(self.read(file_name), data)
+    self.assertEqual(len(self.server.requests), 1)
+
+  def test_missing_file(self):
+    self.assertIsNone(self.download(self.server.url + 'missing.bin'))
+
+  def test_sha256_mismatch(self):
+    url = self.serve('small.bin', b'hello')
+    self.assertIsNone(emsdk.download_file(url, self.path('downloads') + '/', sha256='0' * 64))
+    self.assertFalse(os.path.exists(self.path('downloads', 'small.bin')))
+
+
+class Mirrors(OfflineTestCase):
+  """Two mirrors of the release builds, a/ and b/, and upstream."""
+
+  def setUp(self):
+    super().setUp()
+    self.upstream = self.server.url + 'upstream/'
+    self.mirrors = [self.server.url + 'a/', self.server.url + 'b/']
+    self.patch('emscripten_releases_builds_url', self.upstream)
+    self.patch('MIRRORS', self.mirrors)
+    self.patch('download_dir', self.path('downloads') + '/')
+    # Which mirror is fastest is decided here, rather than by the timing of
+    # requests to the same local server.
+    self.probes = []
+    self.timings = {self.mirrors[0]: 0.1, self.mirrors[1]: 0.2, self.upstream: 0.3}
+    self.real_probe_mirror = emsdk.probe_mirror
+    self.patch('probe_mirror', self.probe_mirror)
+    self.data = random_bytes(100000)
+    for server_dir in ('a', 'b', 'upstream'):
+      self.serve(f'{server_dir}/linux/abc/wasm-binaries.tar.xz', self.data)
+    self.url = self.upstream + 'linux/abc/wasm-binaries.tar.xz'
+
+  def probe_mirror(self, mirror, path):
+    self.probes.append(mirror + path)
+    return self.timings[mirror]
+
+  def requested_dirs(self):
+    return [path.split('/')[0] for method, path, _ in self.server.requests if method == 'GET']
+
+  def test_ranking(self):
+    self.timings = {self.mirrors[0]: 0.5, self.mirrors[1]: None, self.upstream: 0.2}
+    # Unreachable mirrors go last.
+    self.assertEqual(emsdk.get_mirror_urls(self.url),
+                     [m + 'linux/abc/wasm-binaries.tar.xz' for m in (self.upstream, self.mirrors[0], self.mirrors[1])])
+    # The mirrors are probed with the file that is going to be downloaded.
+    self.assertEqual(sorted(self.probes), sorted(m + 'linux/abc/wasm-binaries.tar.xz' for m in [*self.mirrors, self.upstream]))
+    # Other downloads don't come from the release builds.
+    self.assertEqual(emsdk.get_mirror_urls('https://example.com/node.tar.xz'), ['https://example.com/node.tar.xz'])
+
+  def test_unreachable_mirror(self):
+    self.patch('probe_mirror', self.real_probe_mirror)
+    stopped = LocalServer()
+    stopped.stop()
+    self.assertEqual(emsdk.rank_mirrors([stopped.url, self.mirrors[0]], 'linux/abc/wasm-binaries.tar.xz'),
+                     [self.mirrors[0], stopped.url])
+
+  def test_probe_ttl(self):
+    mirrors = [*self.mirrors, self.upstream]
+    self.assertEqual(emsdk.rank_mirrors(mirrors, 'x'), mirrors)
+    self.assertEqual(len(self.probes), 3)
+    probe = json.loads(self.read(self.path('downloads', 'mirrors.json')))
+    self.assertEqual(probe['ranking'], mirrors)
+
+    # The ranking is remembered, even if the timings have changed since.
+    self.timings[self.mirrors[0]] = 1
+    self.assertEqual(emsdk.rank_mirrors(mirrors, 'x'), mirrors)
+    self.assertEqual(len(self.probes), 3)
+
+    # Once the result is older than MIRROR_PROBE_TTL, the mirrors are probed
+    # again.
+    self.patch('MIRROR_PROBE_TTL', 0)
+    self.assertEqual(emsdk.rank_mirrors(mirrors, 'x'), [self.mirrors[1], self.upstream, self.mirrors[0]])
+    self.assertEqual(len(self.probes), 6)
+
+    # As is a different list of mirrors.
+    self.patch('MIRROR_PROBE_TTL', 60 * 60)
+    self.assertEqual(emsdk.rank_mirrors(mirrors[:2], 'x'), [self.mirrors[1], self.mirrors[0]])
+    self.assertEqual(len(self.probes), 8)
+    self.assertEqual(emsdk.rank_mirrors(mirrors[:2], 'x'), [self.mirrors[1], self.mirrors[0]])
+    self.assertEqual(len(self.probes), 8)
+
+  def test_single_mirror_not_probed(self):
+    self.assertEqual(emsdk.rank_mirrors([self.upstream], 'x'), [self.upstream])
+    self.assertEqual(self.probes, [])
+    self.assertFalse(os.path.exists(self.path('downloads', 'mirrors.json')))
+
+  def test_failover_on_missing_file(self):
+    del self.server.files['a/linux/abc/wasm-binaries.tar.xz']
+    file_name = self.download(self.url)
+    self.assertEqual(self.read(file_name), self.data)
+    self.assertEqual(self.requested_dirs(), ['a', 'b'])
+
+  def test_failover_on_dropped_connection(self):
+    self.server.drop_after = 1000
+    file_name = self.download(self.url)
+    self.assertEqual(self.read(file_name), self.data)
+    self.assertEqual(self.requested_dirs(), ['a', 'b'])
+    # The partial download from a/ was not mixed into the one from b/.
+    self.assertNotIn('Range', self.server.requests[-1][2])
+
+  def test_failover_on_wrong_digest(self):
+    self.serve('a/linux/abc/wasm-binaries.tar.xz', b'tampered' + self.data)
+    file_name = emsdk.download_file(self.url, self.path('downloads') + '/', sha256=sha256(self.data))
+    self.assertEqual(self.read(file_name), self.data)
+    self.assertEqual(self.requested_dirs(), ['a', 'b'])
+
+  def test_all_mirrors_fail(self):
+    for server_dir in ('a', 'b', 'upstream'):
+      del self.server.files[f'{server_dir}/linux/abc/wasm-binaries.tar.xz']
+    self.assertIsNone(self.download(self.url))
+    self.assertEqual(self.requested_dirs(), ['a', 'b', 'upstream'])
+    self.assertFalse(os.path.exists(self.path('downloads', 'wasm-binaries.tar.xz')))
+
+
+class Resume(OfflineTestCase):
+  def interrupted_download(self, data, drop_after):
+    """Starts downloading `data`, and returns its URL and the name of the file
+    it is downloaded to once the connection has dropped."""
+    url = self.serve('file.bin', data)
+    self.server.drop_after = drop_after
+    self.assertIsNone(self.download(url))
+    file_name = self.path('downloads', 'file.bin')
+    journal = emsdk.DownloadJournal.load(file_name)
+    self.assertEqual(journal.ranges, [(0, drop_after)])
+    self.assertFalse(journal.complete)
+    self.assertFalse(os.path.exists(file_name))
+    return url, file_name
+
+  def test_resume(self):
+    data = random_bytes(3 * 1024 * 1024)
+    url, file_name = self.interrupted_download(data, 1024 * 1024 + 5)
+    self.server.requests.clear()
+    self.assertEqual(self.download(url), file_name)
+    self.assertEqual(self.read(file_name), data)
+    self.assertEqual(emsdk.DownloadJournal.load(file_name).sha256, hashlib.sha256(data).hexdigest())
+    # Only the missing part was downloaded again.
+    self.assertEqual(len(self.server.requests), 1)
+    self.assertEqual(self.server.requests[0][2]['Range'], f'bytes={1024 * 1024 + 5}-{len(data) - 1}')
+    self.assertEqual(self.server.requests[0][2]['If-Range'], LocalServer.etag(data))
+
+  def test_resume_after_file_changed(self):
+    data = random_bytes(3 * 1024 * 1024)
+    url, file_name = self.interrupted_download(data, 1024 * 1024)
+    # The file changes on the server, keeping its size, so only the ETag tells
+    # that the partial download can't be continued.
+    new_data = random_bytes(len(data), seed=1)
+    self.server.files['file.bin'] = new_data
+    self.server.requests.clear()
+    self.assertEqual(self.download(url), file_name)
+    self.assertEqual(self.read(file_name), new_data)
+    self.assertEqual(emsdk.DownloadJournal.load(file_name).sha256, hashlib.sha256(new_data).hexdigest())
+    # The server ignored the range request, so the download started over.
+    self.assertEqual(self.server.requests[0][2]['If-Range'], LocalServer.etag(data))
+    self.assertNotIn('Range', self.server.requests[1][2])
+
+  def test_no_resume_from_other_url(self):
+    data = random_bytes(2 * 1024 * 1024)
+    _, file_name = self.interrupted_download(data, 1024 * 1024)
+    # Same file name, different URL.
+    other_url = self.serve('other/file.bin', random_bytes(len(data), seed=2))
+    self.server.requests.clear()
+    self.assertEqual(self.download(other_url), file_name)
+    self.assertEqual(self.read(file_name), self.server.files['other/file.bin'])
+    self.assertNotIn('Range', self.server.requests[0][2])
+
+  def test_complete_download_is_reused(self):
+    data = random_bytes(1000)
+    url = self.serve('file.bin', data)
+    file_name = self.download(url)
+    self.server.requests.clear()
+    self.assertEqual(emsdk.download_file(url, self.path('downloads') + '/', sha256=hashlib.sha256(data).hexdigest()), file_name)
+    self.assertEqual(self.server.requests, [])
+    # A truncated file is not mistaken for a complete one.
+    with open(file_name, 'r+b') as f:
+      f.truncate(10)
+    self.assertEqual(self.download(url), file_name)
+    self.assertEqual(self.read(file_name), data)
+
+
+class Cache(OfflineTestCase):
+  def make_file(self, name, data):
+    path = self.path(name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def test_lru_eviction(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=3000)
+    files = {name: self.make_file(name, random_bytes(1000, seed=i)) for i, name in enumerate('abcd')}
+    # A clock that ticks once per call, so that the order in which the objects
+    # were used is unambiguous.
+    with mock.patch.object(emsdk.time, 'time', side_effect=itertools.count(1000)):
+      for name in 'abc':
+        cache.store('http://example.com/' + name, files[name])
+      # Using `a` makes `b` the least recently used object...
+      self.assertTrue(cache.fetch('http://example.com/a', self.path('fetched_a')))
+      # ... which is evicted to make room for `d`.
+      cache.store('http://example.com/d', files['d'])
+
+    self.assertFalse(cache.contains('http://example.com/b'))
+    self.assertFalse(os.path.exists(cache.object_path(hashlib.sha256(self.read(files['b'])).hexdigest())))
+    self.assertFalse(cache.fetch('http://example.com/b', self.path('fetched_b')))
+    for name in 'acd':
+      self.assertTrue(cache.fetch('http://example.com/' + name, self.path('fetched_' + name)))
+      self.assertEqual(self.read(self.path('fetched_' + name)), self.read(files[name]))
+    with open(cache.index_file) as f:
+      self.assertEqual(json.load(f)['stats'], {'hits': 4, 'misses': 1})
+
+  def test_too_large_to_cache(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=10)
+    cache.store('http://example.com/big', self.make_file('big', random_bytes(11)))
+    self.assertFalse(cache.contains('http://example.com/big'))
+
+  def test_lock_contention(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024)
+    cache.store('http://example.com/first', self.make_file('first', b'first'))
+    # Another process holding the lock holds up any change to the cache.
+    other = emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024)
+    with emsdk.file_lock(cache.lock_file):
+      thread = threading.Thread(target=other.store, args=('http://example.com/second', self.make_file('second', b'second')))
+      thread.start()
+      thread.join(0.5)
+      self.assertTrue(thread.is_alive())
+      self.assertFalse(cache.contains('http://example.com/second'))
+    thread.join()
+    self.assertTrue(cache.contains('http://example.com/second'))
+
+    # Many writers at once, each with a cache object of its own like separate
+    # processes would have, don't lose each other's updates to the index.
+    def store(i):
+      emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024).store(f'http://example.com/{i}', self.make_file(str(i), random_bytes(100, seed=i)))
+
+    threads = [threading.Thread(target=store, args=(i,)) for i in range(16)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    for i in range(16):
+      self.assertTrue(cache.contains(f'http://example.com/{i}'))
+
+  def test_download_through_cache(self):
+    self.patch('DOWNLOAD_CACHE_DIR', self.path('cache'))
+    data = random_bytes(1000)
+    url = self.serve('file.bin', data)
+    file_name = self.download(url)
+    self.assertTrue(emsdk.get_download_cache().contains(url))
+    # Another checkout gets the file from the cache, without a request.
+    self.server.requests.clear()
+    other = emsdk.download_file(url, self.path('other_downloads') + '/', sha256=hashlib.sha256(data).hexdigest())
+    self.assertEqual(self.server.requests, [])
+    self.assertEqual(self.read(other), self.read(file_name))
+    # An archive with the wrong digest is not served from the cache.
+    self.assertFalse(emsdk.get_download_cache().fetch(url, self.path('third'), sha256='0' * 64))
+
+  def replace_object(self, cache, sha256, data):
+    """Replaces a cached object, like another user could by renaming their
+    own file over it."""
+    tmp = self.make_file('replacement', data)
+    os.replace(tmp, cache.object_path(sha256))
+
+  @unittest.skipIf(sys.platform.startswith('win'), 'needs unix permissions')
+  def test_sticky_directories(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024)
+    data = b'data'
+    cache.store('http://example.com/file', self.make_file('file', data))
+    self.assertEqual(stat.S_IMODE(os.stat(cache.objects_dir).st_mode), 0o1777)
+    self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(cache.object_path(sha256(data)))).st_mode), 0o1777)
+
+  def test_replaced_object_without_digest(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024)
+    data = b'data'
+    cache.store('http://example.com/file', self.make_file('file', data))
+    self.replace_object(cache, sha256(data), b'evil')
+    # Without a digest to check it against, the object is hashed again.
+    self.assertFalse(cache.fetch('http://example.com/file', self.path('fetched')))
+    self.assertFalse(os.path.exists(self.path('fetched')))
+
+  def test_object_of_other_user(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024)
+    data = b'data'
+    cache.store('http://example.com/file', self.make_file('file', data))
+    self.replace_object(cache, sha256(data), b'evil')
+    # Objects of this user are trusted to match their name when the digest is
+    # known, but those of other users are hashed again.
+    with mock.patch.object(emsdk.DownloadCache, 'owned_by_others', return_value=True):
+      self.assertFalse(cache.fetch('http://example.com/file', self.path('fetched'), sha256(data)))
+    self.replace_object(cache, sha256(data), data)
+    with mock.patch.object(emsdk.DownloadCache, 'owned_by_others', return_value=True):
+      self.assertTrue(cache.fetch('http://example.com/file', self.path('fetched'), sha256(data)))
+    self.assertEqual(self.read(self.path('fetched')), data)
+
+  def test_copied_on_windows(self):
+    cache = emsdk.DownloadCache(self.path('cache'), max_size=1024 * 1024)
+    data = b'data'
+    cache.store('http://example.com/file', self.make_file('file', data))
+    self.patch('WINDOWS', True)
+    self.assertTrue(cache.fetch('http://example.com/file', self.path('fetched')))
+    # A hard link would share the read-only mode of the object, and could not
+    # be deleted on Windows.
+    self.assertNotEqual(os.stat(self.path('fetched')).st_ino, os.stat(cache.object_path(sha256(data))).st_ino)
+    self.assertTrue(os.stat(self.path('fetched')).st_mode & stat.S_IWRITE)
+
+
+class KeepAlive(OfflineTestCase):
+  def get(self, pool, url, method='GET'):
+    with pool.request(url, {}, method, 10) as u:
+      return u.read()
+
+  def test_loaded_on_first_request(self):
+    # Commands that make no requests don't pay for loading http.client and the
+    # CA certificates.
+    code = ('import sys; sys.path.insert(0, sys.argv[1]); import emsdk; '
+            'print(sorted(m for m in ("http.client", "ssl", "urllib.request") if m in sys.modules))')
+    self.assertEqual(subprocess.check_output([sys.executable, '-c', code, root_dir], text=True).strip(), '[]')
+    if hasattr(emsdk.get_connection_pool, 'pool'):
+      del emsdk.get_connection_pool.pool
+    url = self.serve('file.bin', b'hello')
+    with emsdk.open_url(url) as u:
+      self.assertEqual(u.read(), b'hello')
+    self.assertIsInstance(emsdk.get_connection_pool.pool, emsdk.ConnectionPool)
+
+  def test_connection_reuse(self):
+    pool = emsdk.ConnectionPool()
+    url = self.serve('file.bin', b'hello')
+    self.assertEqual(self.get(pool, url), b'hello')
+    # A HEAD response has no body, but still gives back its connection.
+    self.assertEqual(self.get(pool, url, 'HEAD'), b'')
+    self.assertEqual(self.get(pool, url), b'hello')
+    self.assertEqual(self.server.connections, 1)
+
+  def test_partly_read_response(self):
+    pool = emsdk.ConnectionPool()
+    url = self.serve('file.bin', random_bytes(100000))
+    with pool.request(url, {}, 'GET', 10) as u:
+      u.read(10)
+    # The rest of that body is still in the connection, so it can't be used
+    # for the next request.
+    self.assertEqual(self.get(pool, url), self.server.files['file.bin'])
+    self.assertEqual(self.server.connections, 2)
+
+  def test_reconnect_after_server_closes(self):
+    pool = emsdk.ConnectionPool()
+    self.server.close_idle = True
+    url = self.serve('file.bin', b'hello')
+    for _ in range(3):
+      self.assertEqual(self.get(pool, url), b'hello')
+    self.assertEqual(self.server.connections, 3)
+
+  def test_errors(self):
+    pool = emsdk.ConnectionPool()
+    url = self.serve('file.bin', b'hello')
+    with self.assertRaises(emsdk.HTTPError) as e:
+      self.get(pool, self.server.url + 'missing')
+    self.assertEqual(e.exception.code, 404)
+    # The connection can still be used after an error status.
+    self.assertEqual(self.get(pool, url), b'hello')
+    self.assertEqual(self.server.connections, 1)
+
+
+class Scheduler(OfflineTestCase):
+  def test_host_rate(self):
+    scheduler = emsdk.DownloadScheduler(4, rate=None, host_rate=1000)
+    scheduler.host_dir = self.path('host')
+    counts = []
+
+    def count_host_processes():
+      counts.append(threading.get_ident())
+      time.sleep(0.1)
+      return 4
+
+    # Segment threads asking for the rate at the same time count the
+    # processes on the host only once between them.
+    with mock.patch.object(scheduler, 'count_host_processes', count_host_processes):
+      with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        rates = list(executor.map(lambda _: scheduler.current_rate(), range(8)))
+    self.assertEqual(len(counts), 1)
+    self.assertEqual(rates, [250] * 8)
+
+  def test_count_host_processes(self):
+    scheduler = emsdk.DownloadScheduler(4, host_rate=1000)
+    scheduler.host_dir = self.path('host')
+    os.makedirs(scheduler.host_dir)
+    for name, age in (('1', 1), ('2', 10), ('3', 100)):
+      marker = os.path.join(scheduler.host_dir, name)
+      with open(marker, 'w'):
+        pass
+      os.utime(marker, (time.time() - age, time.time() - age))
+    # This process, and the one that was active a second ago.  The marker of
+    # one that has been gone for a while is cleaned up.
+    self.assertEqual(scheduler.count_host_processes(), 2)
+    self.assertEqual(sorted(os.listdir(scheduler.host_dir)), sorted(['1', '2', str(os.getpid())]))
+    self.assertEqual(scheduler.current_rate(), 500)
+
+  def test_connection_cap(self):
+    # With a single connection, no response may be open while another
+    # download has the slot: not the first request of a download, a resumed
+    # one, nor a streamed archive.
+    self.patch('DOWNLOAD_SEGMENTS', 4)
+    self.patch('DOWNLOAD_SEGMENT_MIN_SIZE', 1024 * 1024)
+    self.patch('get_download_scheduler', mock.Mock(return_value=emsdk.DownloadScheduler(1)))
+    lock = threading.Lock()
+    open_responses = 0
+    peak = 0
+    open_url = emsdk.open_url
+
+    def counting_open_url(url, headers=None, method=None, **kwargs):
+      nonlocal open_responses, peak
+      u = open_url(url, headers, method, **kwargs)
+      if method == 'HEAD':
+        return u
+      with lock:
+        open_responses += 1
+        peak = max(peak, open_responses)
+      close = u.close
+
+      def counted_close():
+        nonlocal open_responses
+        if u.close is counted_close:
+          u.close = close
+          with lock:
+            open_responses -= 1
+        close()
+
+      u.close = counted_close
+      return u
+
+    self.patch('open_url', counting_open_url)
+    files = {f'{i}.bin': random_bytes(3 * 1024 * 1024, seed=i) for i in range(3)}
+    for name, data in files.items():
+      self.serve(name, data)
+    self.server.drop_after = 1024 * 1024
+    self.assertIsNone(self.download(self.server.url + '2.bin'))
+    archive = self.read(make_tar(self.path('archive.tar.gz'), [tar_member('pkg/a', data=b'a')]))
+    archive_url = self.serve('archive.tar.gz', archive)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      downloads = [executor.submit(self.download, self.server.url + name) for name in files]
+      streamed = executor.submit(emsdk.stream_download_and_extract, archive_url, self.path('extracted'),
+                                 self.path('archive.tar.gz.kept'), False)
+      for name, future in zip(files, downloads, strict=True):
+        self.assertEqual(self.read(future.result()), files[name])
+      self.assertTrue(streamed.result())
+    self.assertEqual(self.read(self.path('extracted', 'a')), b'a')
+    self.assertEqual(open_responses, 0)
+    self.assertEqual(peak, 1)
+
+
+class FakeResponse(io.BytesIO):
+  """A response body that records the buffers it is asked to read into."""
+
+  def __init__(self, data):
+    super().__init__(data)
+    self.buffers = []
+
+  def readinto(self, buffer):
+    self.buffers.append(buffer)
+    return super().readinto(buffer)
+
+
+class CopyResponse(OfflineTestCase):
+  def setUp(self):
+    super().setUp()
+    self.updates = []
+    self.progress = mock.Mock(update=self.updates.append)
+
+  def copy(self, data, offset=0, length=None, file_size=None):
+    file_name = self.path('file.bin')
+    journal = emsdk.DownloadJournal(file_name, 'http://example.com/file.bin', file_size)
+    response = FakeResponse(data)
+    with open(journal.part_path(file_name), 'wb') as f:
+      emsdk.preallocate(f, file_size or 0)
+      f.seek(offset)
+      emsdk.copy_response(response, f, self.progress, journal, offset=offset, length=length)
+    return journal, response
+
+  def test_copy(self):
+    data = random_bytes(5 * 1024 * 1024 + 1)
+    journal, response = self.copy(data, file_size=len(data))
+    self.assertEqual(self.read(journal.part_path(journal.file_name)), data)
+    self.assertEqual(journal.ranges, [(0, len(data))])
+    self.assertEqual(journal.hasher.hexdigest(), hashlib.sha256(data).hexdigest())
+    self.assertEqual(sum(self.updates), len(data))
+
+    # All chunks are read into the same buffer, in chunks that grow while the
+    # data arrives quickly.
+    sizes = [len(b) for b in response.buffers]
+    self.assertEqual(sizes[0], emsdk.DOWNLOAD_MIN_BLOCK_SIZE)
+    self.assertEqual(sizes[1], 2 * emsdk.DOWNLOAD_MIN_BLOCK_SIZE)
+    self.assertEqual(max(sizes), emsdk.DOWNLOAD_MAX_BLOCK_SIZE)
+    self.assertEqual(len({id(b.obj) for b in response.buffers}), 1)
+
+  def test_copy_segment(self):
+    # Copying a segment into the middle of a preallocated file stops at the
+    # end of the segment, even though the response has more data.
+    data = random_bytes(300000)
+    journal, response = self.copy(data, offset=1000, length=200000, file_size=400000)
+    content = self.read(journal.part_path(journal.file_name))
+    self.assertEqual(len(content), 400000)
+    self.assertEqual(content[1000:201000], data[:200000])
+    self.assertEqual(content[:1000], bytes(1000))
+    self.assertEqual(journal.ranges, [(1000, 201000)])
+    self.assertEqual(response.tell(), 200000)
+    self.assertEqual(journal.missing_ranges(), [(0, 1000), (201000, 400000)])
+
+  def test_connection_closed_early(self):
+    with self.assertRaisesRegex(Exception, 'connection closed with 100 bytes still to go'):
+      self.copy(random_bytes(1000), length=1100, file_size=1100)
+
+  def test_cancelled(self):
+    emsdk.downloads_cancelled.set()
+    self.addCleanup(emsdk.downloads_cancelled.clear)
+    with self.assertRaisesRegex(Exception, 'download aborted'):
+      self.copy(random_bytes(1000))
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'needs unix permissions')
+class TreeCacheLinks(OfflineTestCase):
+  """The tree cache, with hard links as the cheapest way to share files."""
+
+  def setUp(self):
+    super().setUp()
+    self.patch('clone_methods', lambda: ['link', 'copy'])
+    self.addCleanup(make_writable, self.temp_dir)
+    self.url = self.server.url + 'wasm-binaries.tar.xz'
+    self.files = {
+      'bin/clang': (b'clang', 0o755),
+      'emscripten/emcc.py': (b'emcc', 0o644),
+      'emscripten/cache/sysroot/lib/libc.a': (b'libc', 0o644),
+    }
+
+  def make_tree(self, root):
+    for relpath, (data, mode) in self.files.items():
+      path = os.path.join(root, *relpath.split('/'))
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'wb') as f:
+        f.write(data)
+      os.chmod(path, mode)
+    manifest = emsdk.InstallManifest(root, 'wasm-binaries.tar.xz')
+    manifest.refresh()
+    return manifest
+
+  def check_tree(self, manifest, cache):
+    tree = cache.tree_dir('digest')
+    for relpath, (data, mode) in self.files.items():
+      path = manifest.path(relpath)
+      cached = os.path.join(tree, *relpath.split('/'))
+      st = os.stat(path)
+      if relpath.startswith('emscripten/cache/'):
+        # emcc writes to these, so they must stay writable, and separate from
+        # the cache.
+        self.assertNotEqual(st.st_ino, os.stat(cached).st_ino)
+        self.assertEqual(stat.S_IMODE(st.st_mode), mode)
+      else:
+        self.assertEqual(st.st_ino, os.stat(cached).st_ino)
+        self.assertEqual(stat.S_IMODE(st.st_mode), mode & ~0o222)
+      self.assertEqual(self.read(path), data)
+    # The modes of the links are part of the manifest, so verifying the tree
+    # finds nothing wrong with it.
+    manifest.refresh()
+    self.assertEqual(manifest.check(), {})
+
+  def test_store_and_install(self):
+    cache = emsdk.TreeCache(self.path('cache'), 1024 * 1024)
+    installed = self.make_tree(self.path('install'))
+    cache.store(self.url, 'digest', installed)
+    self.check_tree(installed, cache)
+
+    again = emsdk.InstallManifest(self.path('again'))
+    self.assertTrue(cache.install(self.url, again))
+    self.check_tree(again, cache)
+
+    # Writing to the emscripten cache of one install changes neither the tree
+    # cache nor the other install.
+    with open(again.path('emscripten/cache/sysroot/lib/libc.a'), 'ab') as f:
+      f.write(b' rebuilt')
+    self.assertEqual(self.read(installed.path('emscripten/cache/sysroot/lib/libc.a')), b'libc')
+    self.assertEqual(self.read(os.path.join(cache.tree_dir('digest'), 'emscripten', 'cache', 'sysroot', 'lib', 'libc.a')), b'libc')
+
+  def test_dedupe(self):
+    first = self.make_tree(self.path('first'))
+    second = self.make_tree(self.path('second'))
+    replaced, _ = emsdk.dedupe_files([first, second])
+    self.assertEqual(replaced, 2)
+    self.assertNotEqual(os.stat(first.path('emscripten/cache/sysroot/lib/libc.a')).st_ino,
+                        os.stat(second.path('emscripten/cache/sysroot/lib/libc.a')).st_ino)
+    self.assertEqual(os.stat(first.path('bin/clang')).st_ino, os.stat(second.path('bin/clang')).st_ino)
+    self.assertEqual(first.check(), {})
+    self.assertEqual(second.check(), {})
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'needs symlinks')
+class ReleaseStore(OfflineTestCase):
+  def setUp(self):
+    super().setUp()
+    self.patch('EMSDK_PATH', self.temp_dir)
+    self.old = 'a' * 40
+    self.new = 'b' * 40
+
+  def install(self, root, release_hash):
+    os.makedirs(os.path.join(root, 'emscripten'))
+    with open(os.path.join(root, 'emscripten', 'emcc.py'), 'w') as f:
+      f.write(release_hash)
+    with open(os.path.join(root, '.emsdk_version'), 'w') as f:
+      f.write(f'releases-{release_hash}-64bit\n')
+
+  def test_migrate(self):
+    # A release installed before the store was used, and one in the store.
+    self.install(self.path('upstream'), self.old)
+    self.install(self.path('upstream', self.new), self.new)
+    emsdk.migrate_to_release_store()
+    self.assertEqual(sorted(os.listdir(self.path('upstream'))), ['.emsdk_store', self.old, self.new])
+    self.assertEqual(self.read(self.path('upstream', self.old, 'emscripten', 'emcc.py')), self.old.encode())
+    self.assertEqual(sorted(emsdk.installed_store_releases()), [self.old, self.new])
+    # Nothing is left to move.
+    emsdk.migrate_to_release_store()
+    self.assertEqual(sorted(os.listdir(self.path('upstream'))), ['.emsdk_store', self.old, self.new])
+
+  def test_migrate_release_in_store(self):
+    # The release in upstream/ itself is also in the store already.
+    self.install(self.path('upstream'), self.new)
+    self.install(self.path('upstream', self.new), self.new)
+    emsdk.migrate_to_release_store()
+    self.assertEqual(sorted(os.listdir(self.path('upstream'))), ['.emsdk_store', self.new])
+
+  def test_switch(self):
+    self.install(self.path('upstream', self.old), self.old)
+    self.install(self.path('upstream', self.new), self.new)
+    self.assertIsNone(emsdk.current_release())
+    emsdk.set_current_release(self.old)
+    self.assertEqual(emsdk.current_release(), self.old)
+    self.assertEqual(os.readlink(self.path('upstream', 'current')), self.old)
+    emsdk.set_current_release(self.new)
+    self.assertEqual(self.read(self.path('upstream', 'current', 'emscripten', 'emcc.py')), self.new.encode())
+    self.assertEqual(sorted(os.listdir(self.path('upstream'))), [self.old, self.new, 'current'])
+
+  def test_leftover_link(self):
+    # A switch that was interrupted leaves its temporary link behind, which is
+    # not a release of its own.
+    self.install(self.path('upstream', self.old), self.old)
+    os.symlink(self.old, self.path('upstream', 'current.123.tmp'))
+    self.assertEqual(emsdk.installed_store_releases(), [self.old])
+
+
+class InstallTool(OfflineTestCase):
+  """Installing tools that don't come from an archive."""
+
+  def setUp(self):
+    super().setUp()
+    self.patch('EMSDK_PATH', self.temp_dir)
+
+  def fake_install(self, *_args):
+    os.makedirs(self.path('fake', 'bin'), exist_ok=True)
+    with open(self.path('fake', 'bin', 'tool'), 'w') as f:
+      f.write('tool')
+    return True
+
+  def test_git_branch(self):
+    self.patch('git_clone_checkout_and_pull', self.fake_install)
+    tool = emsdk.Tool({'id': 'fake', 'version': 'main', 'url': 'https://example.com/fake.git',
+                       'git_branch': 'main', 'install_path': 'fake', 'activated_path': '%installation_dir%/bin'})
+    self.assertTrue(tool.install_tool())
+    self.assertTrue(tool.is_installed())
+
+  def test_custom_install_script(self):
+    self.patch('download_node_nightly', self.fake_install)
+    tool = emsdk.Tool({'id': 'fake', 'version': 'nightly', 'url': 'https://example.com/fake.tar.gz',
+                       'git_branch': 'nightly', 'install_path': 'fake', 'custom_install_script': 'download_node_nightly'})
+    self.assertTrue(tool.install_tool())
+    self.assertTrue(tool.is_installed())
+
+
+class InstallTools(OfflineTestCase):
+  """install_tools() with fake tools, which record when they start and end."""
+
+  def setUp(self):
+    super().setUp()
+    self.patch('EMSDK_PATH', self.temp_dir)
+    self.patch('INSTALL_JOBS', 4)
+    self.patch('tools_map', {})
+    self.patch('prefetch_archive_url', mock.Mock())
+    self.addCleanup(emsdk.downloads_cancelled.clear)
+    self.events = []
+    self.actions = {}
+    patcher = mock.patch.object(emsdk.Tool, 'install_tool', autospec=True, side_effect=self.fake_install)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def add_tool(self, name, deps=(), action=None, **data):
+    tool = emsdk.Tool({'id': name, 'install_path': name, 'deps': list(deps), **data})
+    emsdk.tools_map[str(tool)] = tool
+    if action:
+      self.actions[name] = action
+    return tool
+
+  def fake_install(self, tool):
+    self.events.append(('start', tool.id))
+    try:
+      self.actions.get(tool.id, lambda: time.sleep(0.05))()
+    finally:
+      self.events.append(('end', tool.id))
+    return True
+
+  def assert_before(self, first, then):
+    self.assertLess(self.events.index(first), self.events.index(then))
+
+  def test_dependencies_first(self):
+    # a and b wait for each other, so they must be installed at the same time.
+    both_running = threading.Barrier(2, timeout=5)
+    a = self.add_tool('a', action=both_running.wait)
+    b = self.add_tool('b', action=both_running.wait)
+    c = self.add_tool('c', deps=['a', 'b'])
+    self.assertEqual(emsdk.install_tools([c]), {a: True, b: True, c: True})
+    self.assert_before(('end', 'a'), ('start', 'c'))
+    self.assert_before(('end', 'b'), ('start', 'c'))
+
+  def test_shared_installation_path(self):
+    # x and y install into the same directory, but z is independent of both.
+    x_and_z_running = threading.Barrier(2, timeout=5)
+    x = self.add_tool('x', install_path='shared', action=x_and_z_running.wait)
+    y = self.add_tool('y', install_path='shared')
+    z = self.add_tool('z', action=x_and_z_running.wait)
+    emsdk.install_tools([x, y, z])
+    self.assert_before(('end', 'x'), ('start', 'y'))
+
+  def test_not_concurrent(self):
+    a = self.add_tool('a')
+    git = self.add_tool('git', url='https://example.com/git.git', git_branch='main')
+    b = self.add_tool('b')
+    self.assertFalse(git.can_install_concurrently())
+    emsdk.install_tools([a, git, b])
+    self.assertEqual(self.events, [('start', 'a'), ('end', 'a'), ('start', 'git'), ('end', 'git'),
+                                   ('start', 'b'), ('end', 'b')])
+
+  def test_failure_cancels_the_rest(self):
+    self.patch('INSTALL_JOBS', 2)
+    cancelled = []
+
+    def fail():
+      raise Exception('bad download')
+
+    def download_until_cancelled():
+      cancelled.append(emsdk.downloads_cancelled.wait(5))
+      raise Exception('download aborted')
+
+    bad = self.add_tool('bad', action=fail)
+    slow = self.add_tool('slow', action=download_until_cancelled)
+    later = self.add_tool('later')
+    after_bad = self.add_tool('after_bad', deps=['bad'])
+    with self.assertRaisesRegex(Exception, 'bad download'):
+      emsdk.install_tools([bad, slow, later, after_bad])
+    # The download in progress was stopped, and nothing else was started.
+    self.assertEqual(cancelled, [True])
+    self.assertEqual(sorted(tool for event, tool in self.events if event == 'start'), ['bad', 'slow'])
+
+
+def sha256(data):
+  return hashlib.sha256(data).hexdigest()
+
+
+class Startup(OfflineTestCase):
+  @unittest.skipIf(emsdk.WINDOWS, 'runs the POSIX emsdk script')
+  def test_construct_env(self):
+    # emsdk_env.sh runs this on every shell startup, so it shouldn't load more
+    # than it needs, and should only expand the manifest once.
+    for f in ['emsdk', 'emsdk.py', *emsdk.MANIFEST_INPUTS]:
+      shutil.copy2(os.path.join(root_dir, f), self.path(f))
+    env = dict(os.environ, EMSDK_VERBOSE='1', PYTHONPROFILEIMPORTTIME='1', EMSDK_PYTHON=sys.executable)
+    env.pop('EMSDK_MANIFEST_CACHE', None)
+    for run in range(2):
+      result = subprocess.run([self.path('emsdk'), 'construct_env'], env=env, cwd=self.temp_dir,
+                              capture_output=True, text=True, check=True)
+      self.assertIn(f'EMSDK={self.temp_dir}', result.stdout.replace('"', '').replace("'", ''))
+      imported = re.findall(r'^import time:.*\|\s*(\S+)$', result.stderr, re.M)
+      self.assertIn('emsdk', imported)
+      for module in ['concurrent.futures', 'logging', 'http.client', 'ssl', 'urllib.request']:
+        self.assertNotIn(module, imported)
+      self.assertTrue(os.path.isfile(self.path(emsdk.MANIFEST_CACHE_FILE)))
+      self.assertEqual('loading tools and SDKs from' in result.stderr, run == 1)
+
+
+class ArchiveFormats(OfflineTestCase):
+  """A mirror offering .tar.zst versions of the release archives."""
+
+  def setUp(self):
+    super().setUp()
+    self.patch('emscripten_releases_builds_url', self.server.url + 'upstream/')
+    self.patch('MIRRORS', [self.server.url + 'mirror/'])
+    self.patch('download_dir', self.path('downloads') + '/')
+    self.patch('find_zstd_decoder', lambda: 'zstd')
+    self.patch('measure_decode_speeds', lambda: {'tar.zst': 1000, 'tar.xz': 10})
+    self.xz = random_bytes(1000, seed=1)
+    self.zst = random_bytes(1000, seed=2)
+    for server_dir in ('upstream', 'mirror'):
+      self.serve(f'{server_dir}/linux/abc/wasm-binaries.tar.xz', self.xz)
+    self.xz_url = emsdk.emscripten_releases_builds_url + 'linux/abc/wasm-binaries.tar.xz'
+    self.zst_url = emsdk.emscripten_releases_builds_url + 'linux/abc/wasm-binaries.tar.zst'
+
+  def set_checksums(self, checksums):
+    patcher = mock.patch.object(emsdk.load_releases_info, 'cached_info', {'checksums': checksums}, create=True)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def set_mirror_checksums(self, text):
+    with open(self.path('checksums'), 'w') as f:
+      f.write(text)
+    self.patch('MIRROR_CHECKSUMS', self.path('checksums'))
+    self.forget_mirror_checksums()
+    self.addCleanup(self.forget_mirror_checksums)
+
+  def forget_mirror_checksums(self):
+    if hasattr(emsdk.load_mirror_checksums, 'checksums'):
+      del emsdk.load_mirror_checksums.checksums
+
+  def test_unverifiable_zst_is_not_used(self):
+    # The mirror has a .tar.zst that nothing is known about, and which does
+    # not have the contents of the .tar.xz.
+    self.serve('mirror/linux/abc/wasm-binaries.tar.zst', b'tampered' + self.zst)
+    self.set_checksums({'linux/abc/wasm-binaries.tar.xz': sha256(self.xz),
+                        'linux/other/wasm-binaries.tar.zst': sha256(self.zst)})
+    self.assertEqual(emsdk.archive_formats(), ['tar.zst', 'tar.xz', 'tbz2'])
+    self.assertEqual(emsdk.probe_archive_url(self.xz_url), self.xz_url)
+    self.assertFalse([r for r in self.server.requests if r[1].endswith('.tar.zst')])
+
+    file_name = emsdk.download_archive(self.zst_url)
+    self.assertTrue(file_name.endswith('.tar.xz'))
+    self.assertEqual(self.read(file_name), self.xz)
+    self.assertFalse([r for r in self.server.requests if r[1].endswith('.tar.zst')])
+
+  def test_tampered_zst_is_rejected(self):
+    self.serve('mirror/linux/abc/wasm-binaries.tar.zst', b'tampered' + self.zst)
+    self.set_checksums({'linux/abc/wasm-binaries.tar.xz': sha256(self.xz),
+                        'linux/abc/wasm-binaries.tar.zst': sha256(self.zst)})
+    self.assertEqual(emsdk.probe_archive_url(self.xz_url), self.zst_url)
+    file_name = emsdk.download_archive(self.zst_url)
+    self.assertTrue(file_name.endswith('.tar.xz'))
+    self.assertEqual(self.read(file_name), self.xz)
+    self.assertFalse(os.path.exists(self.path('downloads', 'wasm-binaries.tar.zst')))
+
+  def test_verified_zst(self):
+    self.serve('mirror/linux/abc/wasm-binaries.tar.zst', self.zst)
+    self.set_checksums({'linux/abc/wasm-binaries.tar.xz': sha256(self.xz),
+                        'linux/abc/wasm-binaries.tar.zst': sha256(self.zst)})
+    self.assertEqual(emsdk.probe_archive_url(self.xz_url), self.zst_url)
+    file_name = emsdk.download_archive(self.zst_url)
+    self.assertTrue(file_name.endswith('.tar.zst'))
+    self.assertEqual(self.read(file_name), self.zst)
+
+  def test_mirror_checksums(self):
+    # Only the mirror's own list of digests knows about the .tar.zst, in either
+    # of the formats it can be in.
+    self.serve('mirror/linux/abc/wasm-binaries.tar.zst', self.zst)
+    self.set_checksums({'linux/abc/wasm-binaries.tar.xz': sha256(self.xz)})
+    for text in (json.dumps({'linux/abc/wasm-binaries.tar.zst': sha256(self.zst)}),
+                 f'{sha256(b"other")}  ./linux/other/wasm-binaries.tar.zst\n\n'
+                 f'{sha256(self.zst).upper()} *./linux/abc/wasm-binaries.tar.zst\n'):
+      self.set_mirror_checksums(text)
+      self.assertEqual(emsdk.archive_formats(), ['tar.zst', 'tar.xz', 'tbz2'])
+      self.assertEqual(emsdk.get_expected_sha256(self.zst_url), sha256(self.zst))
+    self.assertEqual(emsdk.probe_archive_url(self.xz_url), self.zst_url)
+    file_name = emsdk.download_archive(self.zst_url)
+    self.assertTrue(file_name.endswith('.tar.zst'))
+    self.assertEqual(self.read(file_name), self.zst)
+
+  def test_mirror_checksums_cannot_replace_upstream(self):
+    self.set_checksums({'linux/abc/wasm-binaries.tar.xz': sha256(self.xz)})
+    self.set_mirror_checksums(f'{sha256(b"other")}  linux/abc/wasm-binaries.tar.xz\n')
+    self.assertEqual(emsdk.get_expected_sha256(self.xz_url), sha256(self.xz))
+
+  def test_invalid_mirror_checksums(self):
+    self.set_mirror_checksums('not a digest  linux/abc/wasm-binaries.tar.zst\n')
+    with self.assertRaises(SystemExit):
+      emsdk.get_expected_sha256(self.zst_url)
+
+  def test_no_zst_without_digests(self):
+    self.set_checksums({'linux/abc/wasm-binaries.tar.xz': sha256(self.xz)})
+    self.assertEqual(emsdk.archive_formats(), ['tar.xz', 'tbz2'])
+
+
+def make_writable(tree):
+  """Makes the directories in `tree` writable again, so that it can be
+  removed."""
+  for root, dirs, _ in os.walk(tree):
+    for d in dirs:
+      path = os.path.join(root, d)
+      if not os.path.islink(path):
+        os.chmod(path, 0o755)
+
+
+def snapshot(tree):
+  """Returns what there is to compare about the files in `tree`: their type,
+  permissions, modification time and contents (or link target), and which of
+  them are hard links to each other."""
+  entries = {}
+  inodes = {}
+  for root, dirs, files in os.walk(tree):
+    for name in dirs + files:
+      path = os.path.join(root, name)
+      rel = os.path.relpath(path, tree)
+      st = os.lstat(path)
+      if stat.S_ISLNK(st.st_mode):
+        entries[rel] = ('link', os.readlink(path), int(st.st_mtime))
+      elif stat.S_ISDIR(st.st_mode):
+        entries[rel] = ('dir', stat.S_IMODE(st.st_mode), int(st.st_mtime))
+      else:
+        with open(path, 'rb') as f:
+          entries[rel] = ('file', stat.S_IMODE(st.st_mode), int(st.st_mtime), f.read())
+        inodes.setdefault(st.st_ino, set()).add(rel)
+  hard_links = sorted(sorted(group) for group in inodes.values() if len(group) > 1)
+  return entries, hard_links
+
+
+def tar_member(name, type=tarfile.REGTYPE, data=b'', mode=0o644, mtime=1500000000, linkname=''):
+  info = tarfile.TarInfo(name)
+  info.type = type
+  info.mode = mode
+  info.mtime = mtime
+  info.linkname = linkname
+  info.size = len(data)
+  return info, io.BytesIO(data) if data else None
+
+
+def make_tar(file_name, members):
+  with tarfile.open(file_name, 'w:gz') as tar:
+    for info, data in members:
+      tar.addfile(info, data)
+  return file_name
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'compares against the output of tar')
+class TarExtraction(OfflineTestCase):
+  def setUp(self):
+    super().setUp()
+    self.addCleanup(make_writable, self.temp_dir)
+    # tar applies the umask, while emsdk always extracts as if it was 022.
+    self.addCleanup(os.umask, os.umask(0o022))
+    # Files larger than this are streamed to disk rather than buffered.
+    mock.patch.object(emsdk.TarExtractor, 'MAX_BUFFERED_FILE_SIZE', 1000).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def tar_strip(self, archive, dest):
+    os.makedirs(dest)
+    cmd = ['tar', '-xf', archive, '--strip-components', '1', '-C', dest]
+    if os.name == 'posix' and os.geteuid() == 0:
+      # As root, tar would otherwise keep the permissions regardless of the
+      # umask, and the owners from the archive.
+      cmd += ['--no-same-permissions', '--no-same-owner']
+    subprocess.check_call(cmd)
+
+  def test_same_as_tar(self):
+    archive = make_tar(self.path('archive.tar.gz'), [
+      tar_member('pkg/', tarfile.DIRTYPE, mode=0o755, mtime=1400000000),
+      tar_member('pkg/bin/', tarfile.DIRTYPE, mode=0o755, mtime=1400000001),
+      tar_member('pkg/bin/tool', data=b'#!/bin/sh\n', mode=0o755, mtime=1400000002),
+      tar_member('pkg/bin/tool-alias', tarfile.LNKTYPE, linkname='pkg/bin/tool'),
+      tar_member('pkg/bin/big', data=random_bytes(5000), mode=0o644, mtime=1400000003),
+      tar_member('pkg/lib/', tarfile.DIRTYPE, mode=0o750, mtime=1400000004),
+      tar_member('pkg/lib/data.txt', data=b'data', mode=0o640, mtime=1400000005),
+      tar_member('pkg/lib/current', tarfile.SYMTYPE, linkname='data.txt', mtime=1400000006),
+      tar_member('pkg/lib/dangling', tarfile.SYMTYPE, linkname='../missing', mtime=1400000007),
+      tar_member('pkg/lib/empty', mtime=1400000008),
+      tar_member('pkg/readonly/', tarfile.DIRTYPE, mode=0o555, mtime=1400000009),
+      tar_member('pkg/readonly/file', data=b'ro', mode=0o444, mtime=1400000010),
+      tar_member('pkg/readonly/sub/', tarfile.DIRTYPE, mode=0o555, mtime=1400000011),
+      tar_member('pkg/readonly/sub/file', data=b'ro', mode=0o444, mtime=1400000012),
+      # An absolute name is extracted inside the directory, like tar does
+      # after removing the leading slash.
+      tar_member('/pkg/absolute', data=b'abs', mtime=1400000013),
+    ])
+    self.tar_strip(archive, self.path('tar'))
+    expected = snapshot(self.path('tar'))
+    self.assertEqual(expected[1], [['bin/tool', 'bin/tool-alias']])
+
+    for jobs in (1, 4):
+      self.patch('EXTRACT_JOBS', jobs)
+      dest = self.path(f'emsdk_{jobs}')
+      self.assertTrue(emsdk.untargz(archive, dest))
+      self.assertEqual(snapshot(dest), expected)
+      # Unlike tar, the directory itself gets the time of the stripped
+      # top level directory.
+      self.assertEqual(int(os.stat(dest).st_mtime), 1400000000)
+
+  def test_unsafe_members(self):
+    for members in ([tar_member('pkg/../escaped', data=b'x')],
+                    [tar_member('pkg/sub/../../escaped', data=b'x')],
+                    [tar_member('pkg/file', data=b'x'),
+                     tar_member('pkg/escaped', tarfile.LNKTYPE, linkname='pkg/../../outside')]):
+      archive = make_tar(self.path('unsafe.tar.gz'), members)
+      dest = self.path('unsafe', 'dest')
+      self.assertFalse(emsdk.untargz(archive, dest))
+      self.assertFalse(os.path.exists(self.path('unsafe', 'escaped')))
+      self.assertFalse(os.path.exists(self.path('escaped')))
+      emsdk.remove_tree(self.path('unsafe'))
+
+
+class ExternalDecompressor(OfflineTestCase):
+  def setUp(self):
+    super().setUp()
+    self.patch('failed_decompressors', set())
+    self.archive = make_tar(self.path('archive.tar.gz'), [
+      tar_member('pkg/', tarfile.DIRTYPE, mode=0o755),
+      tar_member('pkg/a', data=random_bytes(300000, seed=1)),
+      tar_member('pkg/b', data=random_bytes(300000, seed=2)),
+    ])
+
+  def use_decompressor(self, script):
+    """Makes emsdk decompress .tar.gz archives by running the Python `script`."""
+    cmd = [sys.executable, '-c', script]
+    self.patch('EXTERNAL_DECOMPRESSORS', [(('.gz',), [cmd])])
+    self.patch('DECOMPRESSOR', 'auto')
+    mock.patch('os.cpu_count', return_value=4).start()
+    self.addCleanup(mock.patch.stopall)
+    return cmd
+
+  def check_extracted(self, dest):
+    self.assertEqual(sorted(os.listdir(dest)), ['a', 'b'])
+    self.assertEqual(self.read(os.path.join(dest, 'a')), random_bytes(300000, seed=1))
+    self.assertEqual(self.read(os.path.join(dest, 'b')), random_bytes(300000, seed=2))
+
+  def test_working_decompressor(self):
+    cmd = self.use_decompressor('import gzip, sys; sys.stdout.buffer.write(gzip.decompress(sys.stdin.buffer.read()))')
+    self.assertEqual(emsdk.find_external_decompressor(self.archive), cmd)
+    self.assertTrue(emsdk.untargz(self.archive, self.path('dest')))
+    self.check_extracted(self.path('dest'))
+    self.assertFalse(emsdk.failed_decompressors)
+
+  def test_failing_decompressor(self):
+    self.use_decompressor('import sys; sys.stdin.buffer.read(); sys.exit(3)')
+    self.assertTrue(emsdk.untargz(self.archive, self.path('dest')))
+    self.check_extracted(self.path('dest'))
+    # The program is not tried again.
+    self.assertIsNone(emsdk.find_external_decompressor(self.archive))
+
+  def test_crashing_decompressor(self):
+    # Writes out half of the tar before crashing, which leaves a partially
+    # extracted file behind.
+    self.use_decompressor('import gzip, os, sys\n'
+                          'data = gzip.decompress(sys.stdin.buffer.read())\n'
+                          'sys.stdout.buffer.write(data[:len(data) // 2])\n'
+                          'sys.stdout.flush()\n'
+                          'os.abort()')
+    self.assertTrue(emsdk.untargz(self.archive, self.path('dest')))
+    self.check_extracted(self.path('dest'))
+
+  def test_corrupt_archive(self):
+    # When the archive itself is broken, the built-in decompressor fails too.
+    self.use_decompressor('import sys; sys.stdin.buffer.read(); sys.exit(1)')
+    with open(self.archive, 'r+b') as f:
+      f.seek(100)
+      f.write(b'corrupt' * 10)
+    self.assertFalse(emsdk.untargz(self.archive, self.path('dest')))
+
+
+def zip_member(name, data=b'', mode=0o100644):
+  info = zipfile.ZipInfo(name, date_time=(2020, 1, 1, 0, 0, 0))
+  info.external_attr = mode << 16
+  if stat.S_ISDIR(mode):
+    info.external_attr |= 0x10  # MS-DOS directory flag
+  info.compress_type = zipfile.ZIP_DEFLATED
+  return info, data
+
+
+def make_zip(file_name, members):
+  with zipfile.ZipFile(file_name, 'w') as zf:
+    for info, data in members:
+      zf.writestr(info, data)
+  return file_name
+
+
+class ZipExtraction(OfflineTestCase):
+  def setUp(self):
+    super().setUp()
+    self.addCleanup(make_writable, self.temp_dir)
+
+  def mode(self, *parts):
+    return stat.S_IMODE(os.lstat(self.path(*parts)).st_mode)
+
+  @unittest.skipIf(sys.platform.startswith('win'), 'needs unix permissions and symlinks')
+  def test_permissions_and_symlinks(self):
+    archive = make_zip(self.path('archive.zip'), [
+      zip_member('pkg/', mode=0o40755),
+      zip_member('pkg/bin/tool', b'#!/bin/sh\n', mode=0o100755),
+      zip_member('pkg/lib/data.txt', b'data', mode=0o100640),
+      zip_member('pkg/lib/current', b'data.txt', mode=0o120777),
+      zip_member('pkg/readonly/', mode=0o40555),
+      zip_member('pkg/readonly/file', b'ro', mode=0o100444),
+    ] + [zip_member(f'pkg/many/{i}', random_bytes(i * 100, seed=i)) for i in range(20)])
+
+    for jobs in (1, 4):
+      self.patch('EXTRACT_JOBS', jobs)
+      dest = f'dest_{jobs}'
+      self.assertTrue(emsdk.unzip(archive, self.path(dest)))
+      self.assertEqual(self.mode(dest, 'bin', 'tool'), 0o755)
+      self.assertEqual(self.mode(dest, 'lib', 'data.txt'), 0o640)
+      self.assertEqual(self.mode(dest, 'readonly'), 0o555)
+      self.assertEqual(self.mode(dest, 'readonly', 'file'), 0o444)
+      self.assertTrue(os.path.islink(self.path(dest, 'lib', 'current')))
+      self.assertEqual(os.readlink(self.path(dest, 'lib', 'current')), 'data.txt')
+      self.assertEqual(self.read(self.path(dest, 'lib', 'current')), b'data')
+      for i in range(20):
+        self.assertEqual(self.read(self.path(dest, 'many', str(i))), random_bytes(i * 100, seed=i))
+
+  def test_common_subdir(self):
+    archive = make_zip(self.path('archive.zip'), [
+      zip_member('pkg/a', b'a'),
+      zip_member('pkg/sub/b', b'b'),
+    ])
+    self.assertTrue(emsdk.unzip(archive, self.path('dest')))
+    self.assertEqual(sorted(os.listdir(self.path('dest'))), ['a', 'sub'])
+    self.assertEqual(self.read(self.path('dest', 'sub', 'b')), b'b')
+    self.assertFalse(os.path.exists(self.path('unzip_temp')))
+
+    archive = make_zip(self.path('flat.zip'), [
+      zip_member('pkg/a', b'a'),
+      zip_member('b', b'b'),
+    ])
+    self.assertTrue(emsdk.unzip(archive, self.path('flat')))
+    self.assertEqual(sorted(os.listdir(self.path('flat'))), ['b', 'pkg'])
+
+  def test_member_filter(self):
+    archive = make_zip(self.path('archive.zip'), [
+      zip_member('pkg/keep/a', b'a'),
+      zip_member('pkg/skip/b', b'b'),
+    ])
+    self.assertTrue(emsdk.unzip(archive, self.path('dest'), member_filter=lambda name: name.startswith('keep/')))
+    self.assertEqual(os.listdir(self.path('dest')), ['keep'])
+
+  def test_unsafe_member(self):
+    archive = make_zip(self.path('archive.zip'), [
+      zip_member('pkg/a', b'a'),
+      zip_member('pkg/../../escaped', b'x'),
+    ])
+    self.assertFalse(emsdk.unzip(archive, self.path('unsafe', 'dest')))
+    self.assertFalse(os.path.exists(self.path('unsafe', 'escaped')))
+    self.assertFalse(os.path.exists(self.path('escaped')))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)